@@ -40,12 +40,68 @@ USER_PARAMETERS = 'user-environments/tripleoclient-parameters.yaml'
 DEFAULT_ENV_DIRECTORY = os.path.join(os.environ.get('HOME', '~/'),
                                      '.tripleo', 'environments')
 
+# Local cache of the data downloaded by the client, e.g. the plan files
+CACHE_DIRECTORY = os.path.join(
+    os.environ.get('XDG_CACHE_HOME',
+                   os.path.join(os.environ.get('HOME', '~/'), '.cache')),
+    'tripleoclient')
+PLAN_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, 'plans')
+ENVIRONMENT_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, 'environments')
+# Progress of the monitoring of the stacks, to attach to them again later
+STACK_STATE_DIRECTORY = os.path.join(CACHE_DIRECTORY, 'stacks')
+# Timings of the previous stack creates and updates, used to estimate the
+# time left, and how many runs of each action are kept
+STACK_HISTORY_DIRECTORY = os.path.join(CACHE_DIRECTORY, 'stack-history')
+STACK_HISTORY_RUNS = 5
+
+# ioctl request cloning a file with a reflink (linux/fs.h)
+FICLONE = 0x40049409
+
 TRIPLEO_PUPPET_MODULES = "/usr/share/openstack-puppet/modules/"
 PUPPET_MODULES = "/etc/puppet/modules/"
 PUPPET_BASE = "/etc/puppet/"
 
 STACK_TIMEOUT = 240
 
+# Number of objects transferred to or from Swift at once
+SWIFT_TRANSFER_CONCURRENCY = 8
+
+# Number of environment files resolved in parallel
+ENVIRONMENT_PROCESSING_CONCURRENCY = 8
+
+# Number of Mistral actions run at once by call_actions, below the size of
+# the connection pool of the HTTP session shared by the Mistral client
+MISTRAL_ACTION_CONCURRENCY = 8
+
+# Shortest time between two lookups of the state of a workflow execution
+# while its progress messages are received
+WORKFLOW_STATUS_CHECK_INTERVAL = 10
+
+# Longest wait between two listings of the events of a stack, reached by
+# backing off from the poll period while no new event comes
+STACK_POLL_MAX_PERIOD = 60
+# Number of listings without new events after which the status of the
+# stack itself is looked up
+STACK_POLL_STATUS_CHECK_POLLS = 2
+
+# Number of Heat requests listing nested stacks and their events at once,
+# and the nesting depth of the stacks searched for failed resources
+STACK_EVENTS_CONCURRENCY = 8
+STACK_FAILURES_NESTED_DEPTH = 5
+
+# Resources created or updated for each node of a stack, estimated before
+# there are timings of previous runs
+STACK_PROGRESS_RESOURCES_PER_NODE = 40
+
+# Attempts to open the messaging websocket again after it was closed while
+# waiting for a workflow, and the longest wait between two attempts
+WEBSOCKET_RECONNECT_ATTEMPTS = 5
+WEBSOCKET_RECONNECT_MAX_INTERVAL = 10
+
+# Shortest time without messages from a workflow execution recorded as an
+# idle gap in the workflow timings
+WORKFLOW_TIMINGS_IDLE_GAP = 30
+
 IRONIC_HTTP_BOOT_BIND_MOUNT = '/var/lib/ironic/httpboot'
 
 # The default ffwd upgrade ansible playbooks generated from heat stack output
@@ -73,7 +129,17 @@ FFWD_UPGRADE_PREPARE_SCRIPT = ("#!/bin/bash \n"
 
 ENABLE_SSH_ADMIN_TIMEOUT = 600
 ENABLE_SSH_ADMIN_STATUS_INTERVAL = 5
+# Longest interval between two checks of the enable_ssh_admin workflow
+ENABLE_SSH_ADMIN_POLL_MAX_INTERVAL = 15
 ENABLE_SSH_ADMIN_SSH_PORT_TIMEOUT = 300
+# Seconds a single connection attempt to the ssh port may take, and the
+# longest wait between two attempts to the same host
+ENABLE_SSH_ADMIN_SSH_PORT_CONNECT_TIMEOUT = 5
+ENABLE_SSH_ADMIN_SSH_PORT_MAX_INTERVAL = 10
+# Number of hosts whose ssh port is probed at the same time
+ENABLE_SSH_ADMIN_SSH_PORT_CONCURRENCY = 256
+# Number of hosts the short term ssh key is inserted or removed in parallel
+ENABLE_SSH_ADMIN_CONCURRENCY = 32
 
 ADDITIONAL_ARCHITECTURES = ['ppc64le']
 
@@ -102,6 +102,10 @@ class WorkflowActionError(Base):
         super(WorkflowActionError, self).__init__(message)
 
 
+class ObjectTransferError(Base):
+    """Transferring objects to or from Swift failed"""
+
+
 class DownloadError(Base):
     """Download attempt failed"""
 
@@ -83,7 +83,8 @@ def export_stack(heat, stack, should_filter=False,
     }
 
     data = {}
-    heat_stack = oooutils.get_stack(heat, stack)
+    # Only a few of the outputs are exported, they are fetched one by one
+    heat_stack = oooutils.get_stack(heat, stack, resolve_outputs=False)
 
     for export_key, export_param in export_data.items():
         param = export_param["parameter"]
@@ -15,16 +15,23 @@
 
 """OpenStackClient Plugin interface"""
 
+import argparse
+import atexit
+import functools
 import json
 import logging
 import socket
+import threading
+import time
 import uuid
 
 from osc_lib import utils
+from six.moves import queue
 from swiftclient import client as swift_client
 import websocket
 
 from tripleoclient import exceptions
+from tripleoclient import timings
 
 LOG = logging.getLogger(__name__)
 
@@ -37,6 +44,13 @@ API_VERSIONS = {
     '1': 'tripleoclient.plugin'
 }
 
+# Lifetime in seconds of the subscriptions to the messaging queues
+SUBSCRIPTION_TTL = 10000
+
+# Number of messages of executions nobody waits for kept by each
+# subscription to a shared messaging websocket, the oldest are dropped
+BACKLOG_SIZE = 1000
+
 
 def make_client(instance):
     return ClientWrapper(instance)
@@ -62,9 +76,33 @@ def build_option_parser(parser):
         help='TripleO Client API version, default=' +
              DEFAULT_TRIPLEOCLIENT_API_VERSION +
              ' (Env: OS_TRIPLEOCLIENT_API_VERSION)')
+    parser.add_argument(
+        '--timings',
+        action=_TimingsAction,
+        nargs=0,
+        help='Print a table of the time taken by the TripleO workflows and '
+             'actions when the command exits')
+    parser.add_argument(
+        '--timings-file',
+        metavar='<timings-file>',
+        action=_TimingsAction,
+        help='Append a JSON record of the time taken by each TripleO '
+             'workflow and action to this file when the command exits')
     return parser
 
 
+class _TimingsAction(argparse.Action):
+    """Enable the workflow timings as soon as the option is parsed"""
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        if values:
+            setattr(namespace, self.dest, values)
+            timings.TIMINGS.enable(path=values)
+        else:
+            setattr(namespace, self.dest, True)
+            timings.TIMINGS.enable(summary=True)
+
+
 class WebsocketClient(object):
 
     def __init__(self, instance, queue_name="tripleo", cacert=None):
@@ -100,15 +138,20 @@ class WebsocketClient(object):
         # create and subscribe to a queue
         # NOTE: if the queue exists it will 204
         self.send('queue_create', {'queue_name': queue_name})
-        self.send('subscription_create', {
-            'queue_name': queue_name,
-            'ttl': 10000
-        })
+        self.subscribe()
 
     def cleanup(self):
         self._ws.close()
 
-    def send(self, action, body=None, extra_headers=None):
+    def subscribe(self, wait_for_response=True):
+        """Subscribe to the queue, or renew the subscription"""
+        return self.send('subscription_create', {
+            'queue_name': self._queue_name,
+            'ttl': SUBSCRIPTION_TTL
+        }, wait_for_response=wait_for_response)
+
+    def send(self, action, body=None, extra_headers=None,
+             wait_for_response=True):
 
         headers = {
             'Client-ID': self._websocket_client_id,
@@ -122,6 +165,8 @@ class WebsocketClient(object):
         if body:
             msg['body'] = body
         self._ws.send(json.dumps(msg))
+        if not wait_for_response:
+            return None
         data = self.recv()
         if data['headers']['status'] not in (200, 201, 204):
             raise RuntimeError(data)
@@ -171,12 +216,280 @@ class WebsocketClient(object):
             pass
 
 
+def _message_execution_ids(message):
+    """Return the execution and root execution ids of a Zaqar message"""
+    payload = message.get('body', {}).get('payload') or {}
+    if not isinstance(payload, dict):
+        return None, None
+    # TODO(apetrich) payload.execution is deprecated, see
+    # workflows.base.wait_for_messages
+    execution_id = payload.get('execution_id') or \
+        payload.get('execution', {}).get('id')
+    root_execution_id = payload.get('root_execution_id') or \
+        payload.get('execution', {}).get('root_execution_id')
+    return execution_id, root_execution_id
+
+
+def _put_latest(inbox, message):
+    """Put a message in a queue, dropping the oldest ones when it is full"""
+    while True:
+        try:
+            inbox.put_nowait(message)
+            return
+        except queue.Full:
+            try:
+                inbox.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class MultiplexedWebsocket(object):
+    """A messaging websocket shared by several subscriptions
+
+    The connection is authenticated and subscribed to the queue once. A
+    background thread, started when messages are first waited for, reads
+    the messages and routes them to the subscription waiting for their
+    execution, looked up by execution_id or root_execution_id. The last
+    BACKLOG_SIZE messages of executions nobody waits for yet are kept by
+    every open subscription, in case they belong to an execution it is
+    about to wait for.
+
+    The subscription to the queue is renewed by another thread before it
+    expires, for as long as the connection is open.
+    """
+
+    _CLOSED = object()
+
+    def __init__(self, instance, queue_name="tripleo", cacert=None):
+        self._client = self._connect(instance, queue_name, cacert)
+        self.queue_name = queue_name
+        self.closed = False
+        self._lock = threading.Lock()
+        self._reader = None
+        self._renewer = None
+        self._stopped = threading.Event()
+        self._routes = {}
+        self._subscriptions = []
+
+    def _connect(self, instance, queue_name, cacert):
+        return WebsocketClient(instance, queue_name, cacert=cacert)
+
+    def _read(self):
+        try:
+            self._client._ws.settimeout(None)
+            while True:
+                message = self._client.recv()
+                LOG.debug(message)
+                if 'request' in message:
+                    # The response to a subscription renewal
+                    status = message.get('headers', {}).get('status')
+                    if status not in (200, 201, 204):
+                        LOG.warning("Messaging request failed: %s", message)
+                elif 'body' in message:
+                    self._dispatch(message)
+        except Exception as e:
+            LOG.debug("Messaging websocket reader stopped: %s", e)
+        self._stopped.set()
+        with self._lock:
+            self.closed = True
+            for inbox in list(self._routes.values()) + [
+                    s.backlog for s in self._subscriptions]:
+                _put_latest(inbox, self._CLOSED)
+
+    def _dispatch(self, message):
+        with self._lock:
+            inboxes = []
+            for execution_id in _message_execution_ids(message):
+                inbox = self._routes.get(execution_id)
+                if inbox is not None and inbox not in inboxes:
+                    inboxes.append(inbox)
+            if not inboxes:
+                inboxes = [s.backlog for s in self._subscriptions]
+            for inbox in inboxes:
+                _put_latest(inbox, message)
+
+    def _renew(self):
+        while not self._stopped.wait(SUBSCRIPTION_TTL / 2.0):
+            try:
+                self._client.subscribe(wait_for_response=False)
+            except Exception as e:
+                LOG.debug("Could not renew the messaging subscription: %s",
+                          e)
+                return
+
+    def _start_reader(self):
+        if self._reader is None:
+            self._reader = threading.Thread(target=self._read,
+                                            name='messaging-websocket')
+            self._reader.daemon = True
+            self._reader.start()
+            self._renewer = threading.Thread(
+                target=self._renew, name='messaging-subscription')
+            self._renewer.daemon = True
+            self._renewer.start()
+
+    def register(self, subscription):
+        with self._lock:
+            self._subscriptions.append(subscription)
+
+    def unregister(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def route(self, execution_id, backlog):
+        """Route the messages of an execution to a new inbox
+
+        The messages of the execution already in backlog are moved to it.
+        """
+        inbox = queue.Queue()
+        with self._lock:
+            self._routes[execution_id] = inbox
+            others = []
+            while True:
+                try:
+                    message = backlog.get_nowait()
+                except queue.Empty:
+                    break
+                if (message is not self._CLOSED and
+                        execution_id in _message_execution_ids(message)):
+                    inbox.put(message)
+                else:
+                    others.append(message)
+            for message in others:
+                _put_latest(backlog, message)
+            if self.closed:
+                inbox.put(self._CLOSED)
+            else:
+                self._start_reader()
+        return inbox
+
+    def unroute(self, execution_id, inbox):
+        with self._lock:
+            if self._routes.get(execution_id) is inbox:
+                del self._routes[execution_id]
+
+    def get(self, inbox, timeout=None):
+        """Return the next message of an inbox"""
+        with self._lock:
+            if not self.closed:
+                self._start_reader()
+        try:
+            message = inbox.get(timeout=timeout)
+        except queue.Empty:
+            raise exceptions.WebSocketTimeout()
+        if message is self._CLOSED:
+            # Let the other waiters of this inbox know as well
+            _put_latest(inbox, message)
+            raise exceptions.WebSocketConnectionClosed()
+        return message
+
+    def cleanup(self):
+        self._stopped.set()
+        self._client.cleanup()
+
+
+class WebsocketSubscription(object):
+    """A subscription to the messages of a shared messaging websocket
+
+    connect is an optional callable returning an open MultiplexedWebsocket
+    for the queue, used to subscribe again when the connection was closed.
+    """
+
+    def __init__(self, connection, connect=None):
+        self._connection = connection
+        self._connect = connect
+        self._queue_name = connection.queue_name
+        self.backlog = queue.Queue(BACKLOG_SIZE)
+        connection.register(self)
+
+    def cleanup(self):
+        self._connection.unregister(self)
+
+    def reconnect(self):
+        """Subscribe again after the connection was closed
+
+        The messages sent while there was no connection are lost.
+
+        :raises WebSocketConnectionClosed: if no new connection could be
+                                           opened.
+        """
+        if self._connect is None:
+            raise exceptions.WebSocketConnectionClosed()
+        try:
+            connection = self._connect()
+        except Exception as e:
+            LOG.debug("Could not reconnect the messaging websocket: %s", e)
+            raise exceptions.WebSocketConnectionClosed()
+        self.cleanup()
+        self._connection = connection
+        self.backlog = queue.Queue(BACKLOG_SIZE)
+        connection.register(self)
+
+    def recv(self, timeout=None):
+        """Return the next message received since the subscription started"""
+        return self._connection.get(self.backlog, timeout=timeout)
+
+    def wait_for_messages(self, timeout=None, execution_id=None,
+                          wakeup=None):
+        """Wait for messages on the Zaqar queue
+
+        When an execution_id is given, only the messages of this execution
+        and of its sub-workflows are returned. The timeout applies to the
+        wait for each message, as for WebsocketClient.wait_for_messages.
+
+        wakeup is an optional callable returning a number of seconds, or
+        None. When no message arrives within that many seconds, None is
+        yielded instead of a payload, without resetting the timeout.
+        """
+
+        if timeout is None:
+            LOG.warning("Waiting for messages on queue '{}' with no timeout."
+                        .format(self._queue_name))
+
+        if execution_id is None:
+            inbox = self.backlog
+        else:
+            inbox = self._connection.route(execution_id, self.backlog)
+        try:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                wait = None if deadline is None else \
+                    max(0, deadline - time.time())
+                wake = wakeup() if wakeup is not None else None
+                if wake is not None and (wait is None or wake < wait):
+                    try:
+                        message = self._connection.get(inbox, timeout=wake)
+                    except exceptions.WebSocketTimeout:
+                        yield None
+                        continue
+                else:
+                    message = self._connection.get(inbox, timeout=wait)
+                if timeout is not None:
+                    deadline = time.time() + timeout
+                yield message['body']['payload']
+        finally:
+            if execution_id is not None:
+                self._connection.unroute(execution_id, inbox)
+
+    def __enter__(self):
+        """Return self to allow usage as a context manager"""
+        return self
+
+    def __exit__(self, *exc):
+        """Call cleanup when exiting the context manager"""
+        self.cleanup()
+
+
 class ClientWrapper(object):
 
     def __init__(self, instance):
         self._instance = instance
         self._object_store = None
         self._local_orchestration = None
+        self._messaging_websockets = {}
+        self._messaging_lock = threading.Lock()
+        self._cleanup_registered = False
 
     def local_orchestration(self, api_port):
         """Returns an local_orchestration service client"""
@@ -206,9 +519,39 @@ class ClientWrapper(object):
         return self._local_orchestration
 
     def messaging_websocket(self, queue_name='tripleo'):
-        """Returns a websocket for the messaging service"""
-        return WebsocketClient(self._instance, queue_name,
-                               cacert=self._instance.cacert)
+        """Returns a websocket for the messaging service
+
+        The websockets returned for a queue are subscriptions sharing a
+        single connection, which is opened on first use.
+        """
+        connect = functools.partial(self._messaging_connection, queue_name)
+        return WebsocketSubscription(connect(), connect)
+
+    def _messaging_connection(self, queue_name):
+        with self._messaging_lock:
+            connection = self._messaging_websockets.get(queue_name)
+            if connection is None or connection.closed:
+                connection = self._open_messaging_connection(queue_name)
+                self._messaging_websockets[queue_name] = connection
+                if not self._cleanup_registered:
+                    atexit.register(self.cleanup)
+                    self._cleanup_registered = True
+        return connection
+
+    def cleanup(self):
+        """Close the shared messaging websockets"""
+        with self._messaging_lock:
+            connections = list(self._messaging_websockets.values())
+            self._messaging_websockets.clear()
+        for connection in connections:
+            try:
+                connection.cleanup()
+            except websocket.WebSocketConnectionClosedException:
+                pass
+
+    def _open_messaging_connection(self, queue_name):
+        return MultiplexedWebsocket(self._instance, queue_name,
+                                    cacert=self._instance.cacert)
 
     @property
     def object_store(self):
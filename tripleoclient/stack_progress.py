@@ -0,0 +1,184 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""Progress and remaining time of the create or update of a stack"""
+
+import datetime
+import json
+import logging
+import os
+import time
+
+from tripleoclient import constants
+
+LOG = logging.getLogger(__name__)
+
+
+def count_expected_resources(template, parameters):
+    """Count the resources and the nodes of a rendered root template
+
+    The nodes are the members of the OS::Heat::ResourceGroup resources of
+    the roles, whose count is looked up in the stack parameters.
+
+    :returns: tuple of the number of top level resources and of nodes
+    """
+    resources = template.get('resources') or {}
+    template_parameters = template.get('parameters') or {}
+    nodes = 0
+    for resource in resources.values():
+        if resource.get('type') != 'OS::Heat::ResourceGroup':
+            continue
+        count = (resource.get('properties') or {}).get('count', 0)
+        if isinstance(count, dict) and 'get_param' in count:
+            name = count['get_param']
+            count = parameters.get(
+                name, (template_parameters.get(name) or {}).get('default', 0))
+        try:
+            nodes += int(count)
+        except (TypeError, ValueError):
+            LOG.debug("Unable to count the nodes of %s", resource)
+    return len(resources), nodes
+
+
+class StackHistory(object):
+    """Timings of the previous runs of the actions of a stack
+
+    The last STACK_HISTORY_RUNS successful runs of each action are kept in
+    a JSON file per stack, under STACK_HISTORY_DIRECTORY by default.
+    """
+
+    def __init__(self, stack_name, history_dir=None):
+        if history_dir is None:
+            history_dir = constants.STACK_HISTORY_DIRECTORY
+        self.path = os.path.join(history_dir, '%s.json' % stack_name)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def runs(self, action):
+        return self.load().get(action, [])
+
+    def add(self, action, run):
+        history = self.load()
+        runs = history.setdefault(action, [])
+        runs.append(run)
+        del runs[:-constants.STACK_HISTORY_RUNS]
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(history, f)
+        os.rename(tmp_path, self.path)
+
+
+class StackProgress(object):
+    """Progress of an action of a stack, from the events seen
+
+    The resources expected are the top level resources of the template and
+    a number of resources per node. The resources per node and the time
+    per resource are the averages of the previous runs of the same action,
+    when there are some. Otherwise STACK_PROGRESS_RESOURCES_PER_NODE is
+    assumed, and the time per resource is the one of the current run.
+
+    Every resource reaching a *_COMPLETE status, other than DELETE_COMPLETE,
+    counts as done.
+    """
+
+    def __init__(self, stack_name, action, template, parameters,
+                 history=None):
+        self.stack_name = stack_name
+        self.action = action
+        self.history = history or StackHistory(stack_name)
+        self.top_resources, self.nodes = count_expected_resources(
+            template, parameters)
+        self.completed = set()
+        self.started_at = time.time()
+        self._last_line = None
+
+        runs = self.history.runs(action)
+        per_node = [float(run['resources'] - run['top_resources']) /
+                    run['nodes'] for run in runs if run['nodes']]
+        if per_node:
+            resources_per_node = sum(per_node) / len(per_node)
+        else:
+            resources_per_node = constants.STACK_PROGRESS_RESOURCES_PER_NODE
+        self.expected = max(1, int(round(
+            self.top_resources + self.nodes * resources_per_node)))
+
+        per_resource = [float(run['duration']) / run['resources']
+                        for run in runs if run['resources']]
+        if per_resource:
+            self.seconds_per_resource = sum(per_resource) / len(per_resource)
+        else:
+            self.seconds_per_resource = None
+
+    def update(self, events):
+        """Count the resources completed by events
+
+        :returns: whether the status line changed
+        """
+        for event in events:
+            status = getattr(event, 'resource_status', '') or ''
+            if (status.endswith('_COMPLETE') and
+                    not status.startswith('DELETE')):
+                self.completed.add((getattr(event, 'stack_name', None),
+                                    event.resource_name))
+        line = self.status_line()
+        changed = line != self._last_line
+        self._last_line = line
+        return changed
+
+    def percent(self):
+        # The expected resources are an estimate, only the end of the
+        # action makes it complete
+        return min(99, 100 * len(self.completed) // self.expected)
+
+    def remaining_time(self):
+        """Return the estimated seconds left, or None when unknown"""
+        remaining = max(0, self.expected - len(self.completed))
+        if self.seconds_per_resource is not None:
+            return remaining * self.seconds_per_resource
+        if self.completed:
+            elapsed = time.time() - self.started_at
+            return remaining * elapsed / len(self.completed)
+        return None
+
+    def status_line(self):
+        remaining = self.remaining_time()
+        if remaining is None:
+            eta = "time left unknown"
+        else:
+            eta = "about %s left" % datetime.timedelta(
+                seconds=int(remaining))
+        return "Stack %s %s: %d%% (%d of ~%d resources), %s" % (
+            self.stack_name, self.action, self.percent(),
+            len(self.completed), self.expected, eta)
+
+    def finish(self, stack_status):
+        """Record the timings of the run once it succeeded"""
+        if stack_status != '%s_COMPLETE' % self.action or not self.completed:
+            return
+        try:
+            self.history.add(self.action, {
+                'finished_at': time.time(),
+                'duration': round(time.time() - self.started_at, 3),
+                'resources': len(self.completed),
+                'top_resources': self.top_resources,
+                'nodes': self.nodes})
+        except (IOError, OSError) as e:
+            LOG.warning('Could not save the timings of stack %s to %s: %s',
+                        self.stack_name, self.history.path, e)
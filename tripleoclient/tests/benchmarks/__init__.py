@@ -0,0 +1,161 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""Benchmarks of the client side of the deployment flows
+
+The flows of tripleoclient.tests.benchmarks.scenarios run against the fake
+services of tripleoclient.tests.fake_services, so they only measure the
+time and memory spent in the client, offline. Run them with::
+
+    python -m tripleoclient.tests.benchmarks [--scales 10,100,1000]
+        [--json] [scenario ...]
+
+Each scenario runs in its own process at each scale, and is reported with
+its wall time, the number of API calls and of messages it caused and the
+peak RSS of its process.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from prettytable import PrettyTable
+from six.moves import queue
+
+from tripleoclient.tests.benchmarks import scenarios
+from tripleoclient.tests import fake_services
+
+DEFAULT_SCALES = (10, 100, 1000)
+
+# Seconds between the checks that the process of a scenario still runs
+_RESULT_POLL_INTERVAL = 1
+
+
+def run_scenario(name, nodes):
+    """Run a scenario in this process and return its measurements"""
+    services = fake_services.FakeServices()
+    workdir = tempfile.mkdtemp(prefix='tripleoclient-benchmark-')
+    try:
+        start = time.time()
+        scenarios.SCENARIOS[name](services, nodes, workdir)
+        wall_time = time.time() - start
+    finally:
+        services.cleanup()
+        shutil.rmtree(workdir)
+    return {
+        'scenario': name,
+        'nodes': nodes,
+        'wall_time': round(wall_time, 3),
+        'api_calls': services.api_calls(),
+        'messages': services.calls['zaqar.messages'],
+        'calls': dict(services.calls),
+    }
+
+
+def _run_child(name, nodes, results):
+    logging.getLogger('tripleoclient').setLevel(logging.ERROR)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = devnull
+            result = run_scenario(name, nodes)
+        # ru_maxrss is in KiB on Linux
+        result['peak_rss_mib'] = round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    except Exception:
+        result = {'scenario': name, 'nodes': nodes,
+                  'error': traceback.format_exc()}
+    results.put(result)
+
+
+def run_isolated(name, nodes):
+    """Run a scenario in a new process, so that its peak RSS is its own
+
+    A process which exits without giving its result, e.g. killed by a
+    signal or the OOM killer, gives a failed result.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_child,
+                                      args=(name, nodes, results))
+    process.start()
+    try:
+        while True:
+            # A result put before the process exited is in the queue by
+            # the time it is seen as exited
+            exited = not process.is_alive()
+            try:
+                return results.get(timeout=_RESULT_POLL_INTERVAL)
+            except queue.Empty:
+                if exited:
+                    return {'scenario': name, 'nodes': nodes,
+                            'error': 'The scenario process exited with code '
+                                     '%s without a result\n'
+                                     % process.exitcode}
+    finally:
+        process.join()
+
+
+def _table(results):
+    table = PrettyTable(['Scenario', 'Nodes', 'Wall time (s)', 'API calls',
+                         'Messages', 'Peak RSS (MiB)'])
+    for result in results:
+        if 'error' in result:
+            table.add_row([result['scenario'], result['nodes'], 'FAILED',
+                           '', '', ''])
+        else:
+            table.add_row([result['scenario'], result['nodes'],
+                           result['wall_time'], result['api_calls'],
+                           result['messages'], result['peak_rss_mib']])
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m tripleoclient.tests.benchmarks',
+        description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='Scenarios to run, out of %s (default: all)' %
+                             ', '.join(scenarios.SCENARIOS))
+    parser.add_argument('--scales', default=','.join(
+                        str(scale) for scale in DEFAULT_SCALES),
+                        help='Comma separated numbers of nodes to run the '
+                             'scenarios with (default: %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='Print a JSON line per run instead of a table')
+    args = parser.parse_args(argv)
+
+    names = args.scenarios or list(scenarios.SCENARIOS)
+    unknown = [name for name in names if name not in scenarios.SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(unknown))
+    scales = [int(scale) for scale in args.scales.split(',')]
+
+    results = []
+    for name in names:
+        for nodes in scales:
+            result = run_isolated(name, nodes)
+            results.append(result)
+            if args.json:
+                print(json.dumps(result, sort_keys=True))
+            elif 'error' in result:
+                sys.stderr.write(result['error'])
+    if not args.json:
+        print(_table(results))
+    return 1 if any('error' in result for result in results) else 0
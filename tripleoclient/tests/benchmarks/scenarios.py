@@ -0,0 +1,291 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""Client side flows run against the fake services at a given scale
+
+Each scenario takes the FakeServices, a number of nodes and a scratch
+directory. It scripts the workflows it needs so that they send messages in
+proportion to the number of nodes, as the real ones do, then runs the
+client code of the flow.
+"""
+
+import argparse
+import collections
+import logging
+import os
+import sys
+
+import mock
+import yaml
+
+from tripleoclient import constants
+from tripleoclient.v1 import overcloud_deploy
+from tripleoclient.workflows import baremetal
+from tripleoclient.workflows import deployment
+from tripleoclient.workflows import plan_management
+from tripleoclient.workflows import scale
+
+LOG = logging.getLogger(__name__)
+
+PLAN = 'overcloud'
+
+# The tasks for which config-download reports a result for every node
+_ANSIBLE_TASKS = ('Gathering Facts', 'Write the config_step hieradata',
+                  'Run puppet host configuration for step 1',
+                  'Start containers for step 1', 'Wait for containers')
+
+_Stack = collections.namedtuple('_Stack', ['stack_name'])
+
+
+def _node_uuids(nodes):
+    return ['%08x-0000-4000-8000-000000000000' % i for i in range(nodes)]
+
+
+def _hosts(nodes):
+    return ['overcloud-novacompute-%d' % i for i in range(nodes)]
+
+
+def _ansible_messages(hosts):
+    for task in _ANSIBLE_TASKS:
+        yield {'status': 'RUNNING', 'message': 'TASK [%s]' % task}
+        for host in hosts:
+            yield {'status': 'RUNNING', 'message': 'ok: [%s]' % host}
+    yield {'status': 'SUCCESS', 'message': 'Ansible passed.'}
+
+
+def deploy_workflows(services, nodes, workdir):
+    """The deploy workflow then config-download
+
+    These are the workflows overcloud deploy runs once the plan is updated,
+    including config-download, which the deploy scenario leaves out.
+    """
+    hosts = _hosts(nodes)
+    services.mistral.register_workflow(
+        'tripleo.deployment.v1.deploy_plan',
+        lambda workflow_input: [
+            {'status': 'RUNNING', 'message': 'Validating the plan'},
+            {'status': 'SUCCESS', 'message': 'Heat stack create started'}])
+    services.mistral.register_workflow(
+        'tripleo.deployment.v1.config_download_deploy',
+        lambda workflow_input: _ansible_messages(hosts))
+
+    clients = services.client_manager
+    deployment.deploy(LOG, clients, container=PLAN, run_validations=False,
+                      skip_deploy_identifier=False, deployment_options={})
+    deployment.config_download(LOG, clients, _Stack(PLAN), workdir,
+                               'tripleo-admin', '/dev/null', 'ctlplane',
+                               None, None, 240)
+
+
+def _templates(nodes, workdir):
+    """Write a templates directory with one template per node"""
+    tht_root = os.path.join(workdir, 'tht')
+    os.makedirs(os.path.join(tht_root, 'deployment'))
+    with open(os.path.join(tht_root, constants.PLAN_ENVIRONMENT), 'w') as f:
+        yaml.safe_dump({'name': PLAN, 'environments': []}, f)
+    with open(os.path.join(tht_root, constants.OVERCLOUD_ROLES_FILE),
+              'w') as f:
+        yaml.safe_dump([{'name': 'Compute', 'CountDefault': nodes}], f)
+    for i in range(nodes):
+        path = os.path.join(tht_root, 'deployment', 'node-%d.yaml' % i)
+        with open(path, 'w') as f:
+            yaml.safe_dump({'heat_template_version': 'rocky',
+                            'resources': {'Node%d' % i: {
+                                'type': 'OS::Heat::None'}}}, f)
+    return tht_root
+
+
+def _plan(services, nodes, workdir):
+    tht_root = _templates(nodes, workdir)
+    swift = services.swift
+    swift.put_container(PLAN)
+    swift.put_object(PLAN, constants.PLAN_ENVIRONMENT, yaml.safe_dump(
+        {'name': PLAN, 'passwords': {'AdminPassword': 'secret'}}))
+    for i in range(nodes):
+        swift.put_object(PLAN, 'deployment/node-%d.yaml' % i, 'old')
+    services.calls.clear()
+    return tht_root
+
+
+def _deploy_templates(nodes, workdir):
+    """Write templates with a root template and an environment per node
+
+    The resources of the root template have types of their own, mapped to
+    the template of their node by its environment, as the resources of
+    the roles of tripleo-heat-templates are.
+
+    :returns: tuple of the templates directory, the root template and the
+              paths of the environment files
+    """
+    tht_root = _templates(nodes, workdir)
+    resources = dict(('Node%d' % i, {'type': 'OS::TripleO::Node%d' % i})
+                     for i in range(nodes))
+    template = {'heat_template_version': 'rocky', 'resources': resources}
+    with open(os.path.join(tht_root, constants.OVERCLOUD_YAML_NAME),
+              'w') as f:
+        yaml.safe_dump(template, f)
+    os.makedirs(os.path.join(tht_root, 'environments'))
+    env_files = []
+    for i, host in enumerate(_hosts(nodes)):
+        path = os.path.join(tht_root, 'environments', 'node-%d.yaml' % i)
+        registry = {'OS::TripleO::Node%d' % i:
+                    '../deployment/node-%d.yaml' % i}
+        with open(path, 'w') as f:
+            yaml.safe_dump({'resource_registry': registry,
+                            'parameter_defaults': {
+                                'Node%dHostname' % i: host}}, f)
+        env_files.append(path)
+    return tht_root, template, env_files
+
+
+class _App(object):
+    """The part of the openstack shell used by the commands"""
+
+    def __init__(self, client_manager):
+        self.client_manager = client_manager
+        self.stdout = sys.stdout
+
+
+def deploy(services, nodes, workdir):
+    """overcloud deploy creating the stack of the nodes
+
+    DeployOvercloud.take_action with an environment file per node: the plan
+    is created from the templates, the environments are processed and
+    uploaded, the deploy workflow creates the stack and the client waits
+    for it, then it gets the overcloudrc. config-download is left out with
+    --stack-only. The sleeps between the polls of the stack are skipped, as
+    the fake stack moves on at every poll, and the post-deployment changes
+    to the known_hosts of the user and to no_proxy are not made.
+    """
+    tht_root, template, env_files = _deploy_templates(nodes, workdir)
+
+    def create_container(container, **kwargs):
+        services.swift.containers.setdefault(container, {})
+    services.mistral.register_action('tripleo.plan.create_container',
+                                     create_container)
+    services.mistral.register_workflow(
+        'tripleo.plan_management.v1.list_plans',
+        lambda workflow_input: [{'status': 'SUCCESS', 'plans': []}])
+
+    def deploy_plan(workflow_input):
+        services.heat.create_stack(
+            workflow_input['container'], template,
+            outputs={'KeystoneURL': 'http://192.0.2.1:5000'})
+        return [{'status': 'RUNNING', 'message': 'Validating the plan'},
+                {'status': 'SUCCESS', 'message': 'Heat stack create started'}]
+    services.mistral.register_workflow('tripleo.deployment.v1.deploy_plan',
+                                       deploy_plan)
+    services.mistral.register_workflow(
+        'tripleo.deployment.v1.create_overcloudrc',
+        lambda workflow_input: [{'status': 'SUCCESS', 'message': {
+            'overcloudrc': 'export OS_CLOUD=%s\n' % PLAN}}])
+    services.mistral.register_workflow(
+        'tripleo.deployment.v1.createcloudsyaml',
+        lambda workflow_input: [{'status': 'SUCCESS', 'message': {
+            PLAN: {'auth': {'auth_url': 'http://192.0.2.1:5000'}}}}])
+    services.mistral.register_workflow(
+        'tripleo.deployment.v1.get_horizon_url',
+        lambda workflow_input: [{'status': 'SUCCESS',
+                                 'horizon_url': 'http://192.0.2.1/dashboard'}])
+
+    cache_dir = os.path.join(workdir, 'cache')
+    patchers = [
+        mock.patch('time.sleep'),
+        mock.patch.multiple(
+            constants, CLOUD_HOME_DIR=workdir,
+            DEFAULT_ENV_DIRECTORY=os.path.join(workdir, 'environments'),
+            PLAN_CACHE_DIRECTORY=os.path.join(cache_dir, 'plans'),
+            STACK_STATE_DIRECTORY=os.path.join(cache_dir, 'stacks'),
+            STACK_HISTORY_DIRECTORY=os.path.join(cache_dir, 'stack-history')),
+        mock.patch.object(overcloud_deploy.DeployOvercloud,
+                          '_get_undercloud_host_entry',
+                          return_value='192.168.24.1 undercloud.ctlplane'),
+        mock.patch.object(overcloud_deploy.DeployOvercloud,
+                          '_deploy_postconfig'),
+    ]
+    cwd = os.getcwd()
+    for patcher in patchers:
+        patcher.start()
+    try:
+        # The overcloudrc is written to the current directory
+        os.chdir(workdir)
+        cmd = overcloud_deploy.DeployOvercloud(
+            _App(services.client_manager), argparse.Namespace(verbose_level=1))
+        argv = ['--templates', tht_root, '--stack', PLAN, '--stack-only',
+                '--deployed-server', '--disable-validations']
+        for path in env_files:
+            argv.extend(['-e', path])
+        cmd.take_action(cmd.get_parser('overcloud deploy').parse_args(argv))
+    finally:
+        os.chdir(cwd)
+        for patcher in reversed(patchers):
+            patcher.stop()
+
+
+def plan_update(services, nodes, workdir):
+    """update_plan_from_templates, replacing every plan file"""
+    tht_root = _plan(services, nodes, workdir)
+    plan_management.update_plan_from_templates(
+        services.client_manager, PLAN, tht_root)
+
+
+def plan_update_delta(services, nodes, workdir):
+    """update_plan_from_templates, uploading the changed files only"""
+    tht_root = _plan(services, nodes, workdir)
+    plan_management.update_plan_from_templates(
+        services.client_manager, PLAN, tht_root, delta_sync=True)
+
+
+def introspection(services, nodes, workdir):
+    """Introspection of the nodes, reported node by node"""
+    node_uuids = _node_uuids(nodes)
+
+    def introspect(workflow_input):
+        for node_uuid in workflow_input['node_uuids']:
+            yield {'status': 'RUNNING',
+                   'message': 'Introspection of node %s completed. '
+                              'Status:SUCCESS. Errors:None' % node_uuid}
+        yield {'status': 'SUCCESS',
+               'message': 'Successfully introspected %d node(s).' % nodes}
+    services.mistral.register_workflow('tripleo.baremetal.v1.introspect',
+                                       introspect)
+
+    baremetal.introspect(services.client_manager, node_uuids=node_uuids,
+                         run_validations=False)
+
+
+def scale_down(services, nodes, workdir):
+    """Removal of the nodes: the scale playbook then the stack update"""
+    hosts = _hosts(nodes)
+    services.mistral.register_workflow(
+        'tripleo.deployment.v1.config_download_deploy',
+        lambda workflow_input: _ansible_messages(hosts))
+
+    def delete_node(workflow_input):
+        for node in workflow_input['nodes']:
+            yield {'status': 'RUNNING', 'message': 'Deleting %s' % node}
+        yield {'status': 'SUCCESS', 'message': 'Nodes deleted'}
+    services.mistral.register_workflow('tripleo.scale.v1.delete_node',
+                                       delete_node)
+
+    scale.scale_down(services.client_manager, PLAN, _node_uuids(nodes))
+
+
+SCENARIOS = collections.OrderedDict([
+    ('deploy', deploy),
+    ('deploy-workflows', deploy_workflows),
+    ('plan-update', plan_update),
+    ('plan-update-delta', plan_update_delta),
+    ('introspection', introspection),
+    ('scale-down', scale_down),
+])
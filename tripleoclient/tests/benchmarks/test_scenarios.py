@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+
+import mock
+import six
+
+from tripleoclient.tests import base
+from tripleoclient.tests import benchmarks
+
+
+def _exit_child(name, nodes, results):
+    os._exit(3)
+
+
+class TestScenarios(base.TestCase):
+    """Keep the benchmark scenarios working, at a small scale"""
+
+    def setUp(self):
+        super(TestScenarios, self).setUp()
+        patcher = mock.patch('sys.stdout', new_callable=six.StringIO)
+        self.stdout = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_deploy(self):
+        result = benchmarks.run_scenario('deploy', 3)
+        # list_plans, create_deployment_plan, get_deprecated_parameters,
+        # deploy_plan and the 3 workflows run once the stack is created
+        self.assertEqual(7, result['calls']['mistral.executions.create'])
+        self.assertEqual(1, result['calls']['heat.stacks.template'])
+        # the stack completes on the second poll, and is looked up after
+        # two polls without new events
+        self.assertEqual(4, result['calls']['heat.events.list'])
+        output = self.stdout.getvalue()
+        self.assertIn('CREATE_COMPLETE', output)
+        self.assertIn('Overcloud Endpoint: http://192.0.2.1:5000', output)
+        self.assertIn('Overcloud Deployed', output)
+
+    def test_deploy_workflows(self):
+        result = benchmarks.run_scenario('deploy-workflows', 3)
+        self.assertEqual(2, result['calls']['mistral.executions.create'])
+        # 5 tasks reported for each node, a final and 2 deploy messages
+        self.assertEqual(5 * 4 + 1 + 2, result['messages'])
+        self.assertIn('ok: [overcloud-novacompute-2]', self.stdout.getvalue())
+        self.assertIn('Overcloud configuration completed.',
+                      self.stdout.getvalue())
+
+    def test_plan_update(self):
+        result = benchmarks.run_scenario('plan-update', 3)
+        # the old plan files are deleted, the new ones extracted at once
+        self.assertEqual(4, result['calls']['swift.delete_object'])
+        self.assertEqual(2, result['calls']['swift.put_object'])
+        self.assertEqual(1, result['calls']['mistral.executions.create'])
+
+    def test_plan_update_delta(self):
+        result = benchmarks.run_scenario('plan-update-delta', 3)
+        # the 3 templates, roles_data.yaml and plan-environment.yaml
+        # changed, and plan-environment.yaml gets the passwords back
+        self.assertEqual(6, result['calls']['swift.put_object'])
+        self.assertNotIn('swift.delete_object', result['calls'])
+
+    def test_introspection(self):
+        result = benchmarks.run_scenario('introspection', 3)
+        self.assertEqual(4, result['messages'])
+        self.assertIn('Successfully introspected 3 node(s).',
+                      self.stdout.getvalue())
+
+    def test_scale_down(self):
+        result = benchmarks.run_scenario('scale-down', 3)
+        self.assertEqual(2, result['calls']['mistral.executions.create'])
+        self.assertIn('Scale-down configuration completed.',
+                      self.stdout.getvalue())
+
+    def test_main(self):
+        with mock.patch.object(benchmarks, 'run_isolated',
+                               side_effect=lambda name, nodes: dict(
+                                   benchmarks.run_scenario(name, nodes),
+                                   peak_rss_mib=1.0)):
+            self.assertEqual(0, benchmarks.main(
+                ['--scales', '1,2', 'introspection']))
+        output = self.stdout.getvalue()
+        self.assertIn('| introspection |   2   |', output)
+
+    def test_run_isolated_exited(self):
+        with mock.patch.object(benchmarks, '_run_child', _exit_child):
+            result = benchmarks.run_isolated('introspection', 1)
+        self.assertEqual('introspection', result['scenario'])
+        self.assertIn('exited with code 3', result['error'])
@@ -0,0 +1,83 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""In-process stand-ins for the services the client talks to
+
+FakeServices wires an in-memory Swift and Heat, a scripted Mistral and a
+Zaqar message bus behind a client manager, which the workflow helpers and the
+commands can use as they use the real one, without any network access::
+
+    services = FakeServices()
+    services.mistral.register_workflow(
+        'tripleo.baremetal.v1.introspect',
+        lambda workflow_input: [{'status': 'SUCCESS'}])
+    baremetal.introspect(services.client_manager, node_uuids=[...],
+                         run_validations=False)
+    services.calls  # Counter of the API calls made
+"""
+
+import collections
+
+from tripleoclient import plugin
+from tripleoclient.tests.fake_services import heat
+from tripleoclient.tests.fake_services import messaging
+from tripleoclient.tests.fake_services import mistral
+from tripleoclient.tests.fake_services import swift
+
+
+class FakeClientWrapper(plugin.ClientWrapper):
+    """The tripleoclient client, connected to the fake services"""
+
+    def __init__(self, services):
+        super(FakeClientWrapper, self).__init__(None)
+        self._services = services
+
+    @property
+    def object_store(self):
+        return self._services.swift
+
+    def _open_messaging_connection(self, queue_name):
+        return messaging.FakeMultiplexedWebsocket(self._services.bus,
+                                                  queue_name)
+
+
+class FakeClientManager(object):
+
+    def __init__(self, services):
+        self.workflow_engine = services.mistral
+        self.orchestration = services.heat
+        self.tripleoclient = FakeClientWrapper(services)
+
+
+class FakeServices(object):
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.swift = swift.FakeSwift(self.calls)
+        self.heat = heat.FakeHeat(self.calls)
+        self.bus = messaging.FakeMessageBus(self.calls)
+        self.mistral = mistral.FakeMistral(self.bus, self.calls)
+        self.client_manager = FakeClientManager(self)
+
+    def cleanup(self):
+        """Close the messaging connections opened by the client"""
+        wrapper = self.client_manager.tripleoclient
+        with wrapper._messaging_lock:
+            for connection in wrapper._messaging_websockets.values():
+                connection.cleanup()
+            wrapper._messaging_websockets.clear()
+
+    def api_calls(self):
+        """Return the total number of API calls made to the services"""
+        return sum(count for name, count in self.calls.items()
+                   if name != 'zaqar.messages')
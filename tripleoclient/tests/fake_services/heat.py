@@ -0,0 +1,246 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""An in-memory stand-in for the Heat client
+
+Stacks are created with create_stack(), which the scripts of the deploy
+workflow call as the real workflow makes Heat create the stack. A stack then
+creates the top level resources of its template while the client watches
+it: every listing of its events completes the resources in progress and
+starts the next ones, as if Heat ran exactly as fast as the client polls,
+and the stack is complete once all of them are. The events carry a
+root_stack link, as those of a Heat API which lists the events of the
+nested stacks itself.
+"""
+
+import datetime
+import threading
+import uuid
+
+from heatclient import exc as heat_exc
+
+_EVENTS_START = datetime.datetime(2019, 1, 1)
+
+
+class FakeEvent(object):
+
+    def __init__(self, stack, number, resource_name, physical_resource_id,
+                 status, reason):
+        self.id = str(uuid.uuid4())
+        self.resource_name = resource_name
+        self.logical_resource_id = resource_name
+        self.physical_resource_id = physical_resource_id
+        self.resource_status = status
+        self.resource_status_reason = reason
+        self.event_time = (_EVENTS_START +
+                           datetime.timedelta(seconds=number)).isoformat()
+        href = 'http://heat/v1/stacks/%s/%s' % (stack.stack_name, stack.id)
+        self.links = [{'rel': 'stack', 'href': href},
+                      {'rel': 'root_stack', 'href': href}]
+
+
+class FakeResource(object):
+
+    def __init__(self, stack, resource_name, physical_resource_id, status):
+        self.resource_name = resource_name
+        self.physical_resource_id = physical_resource_id
+        self.resource_status = status
+        self.links = [{'rel': 'stack', 'href': 'http://heat/v1/stacks/%s/%s'
+                       % (stack.stack_name, stack.id)}]
+
+
+class _Stack(object):
+    """A stack as Heat keeps it"""
+
+    def __init__(self, name, template, parameters, outputs):
+        self.id = str(uuid.uuid4())
+        self.stack_name = name
+        self.template = template
+        self.parameters = parameters
+        self.outputs = outputs
+        self.stack_action = 'CREATE'
+        self.stack_status = 'CREATE_IN_PROGRESS'
+        self.events = []
+        self.resources = {}
+        self._pending = sorted(template.get('resources') or {})
+        self._in_progress = []
+        self._event(name, self.id, 'CREATE_IN_PROGRESS',
+                    'Stack CREATE started')
+
+    def _event(self, resource_name, physical_resource_id, status, reason):
+        self.events.append(FakeEvent(self, len(self.events), resource_name,
+                                     physical_resource_id, status, reason))
+
+    def advance(self, count):
+        """Complete the resources in progress and start the next count"""
+        if self.stack_status != 'CREATE_IN_PROGRESS':
+            return
+        for name in self._in_progress:
+            self.resources[name] = FakeResource(
+                self, name, str(uuid.uuid4()), 'CREATE_COMPLETE')
+            self._event(name, self.resources[name].physical_resource_id,
+                        'CREATE_COMPLETE', 'state changed')
+        self._in_progress = self._pending[:count]
+        del self._pending[:count]
+        for name in self._in_progress:
+            self.resources[name] = FakeResource(
+                self, name, '', 'CREATE_IN_PROGRESS')
+            self._event(name, '', 'CREATE_IN_PROGRESS', 'state changed')
+        if not self._in_progress:
+            self.stack_status = 'CREATE_COMPLETE'
+            self._event(self.stack_name, self.id, 'CREATE_COMPLETE',
+                        'Stack CREATE completed successfully')
+
+
+class FakeStack(object):
+    """A stack as the client gets it, a copy of its state at the time"""
+
+    def __init__(self, heat, stack, resolve_outputs=True):
+        self._heat = heat
+        self._stack = stack
+        self._resolve_outputs = resolve_outputs
+        self._copy()
+
+    def _copy(self):
+        self.id = self._stack.id
+        self.stack_name = self._stack.stack_name
+        self.stack_action = self._stack.stack_action
+        self.stack_status = self._stack.stack_status
+        self.parameters = dict(self._stack.parameters)
+
+    def get(self):
+        self._heat._count('stacks.get')
+        self._copy()
+
+    def to_dict(self):
+        stack = {'id': self.id, 'stack_name': self.stack_name,
+                 'stack_action': self.stack_action,
+                 'stack_status': self.stack_status,
+                 'parameters': self.parameters}
+        if self._resolve_outputs:
+            stack['outputs'] = [{'output_key': key, 'output_value': value}
+                                for key, value in
+                                sorted(self._stack.outputs.items())]
+        return stack
+
+    def output_list(self):
+        self._heat._count('stacks.output_list')
+        return {'outputs': [{'output_key': key} for key in
+                            sorted(self._stack.outputs)]}
+
+    def output_show(self, key):
+        self._heat._count('stacks.output_show')
+        if key not in self._stack.outputs:
+            raise heat_exc.HTTPNotFound()
+        return {'output': {'output_key': key,
+                           'output_value': self._stack.outputs[key]}}
+
+    def environment(self):
+        self._heat._count('stacks.environment')
+        return {'parameter_defaults': dict(self._stack.parameters),
+                'resource_registry': {}}
+
+
+class _StackManager(object):
+
+    def __init__(self, heat):
+        self._heat = heat
+
+    def get(self, stack_id, resolve_outputs=True):
+        self._heat._count('stacks.get')
+        return FakeStack(self._heat, self._heat._find(stack_id),
+                         resolve_outputs)
+
+    def template(self, stack_id):
+        self._heat._count('stacks.template')
+        return self._heat._find(stack_id).template
+
+
+class _EventManager(object):
+
+    def __init__(self, heat):
+        self._heat = heat
+
+    def list(self, stack_id, resource_name=None, **kwargs):
+        return self._heat._list_events(stack_id, **kwargs)
+
+
+class _ResourceManager(object):
+
+    def __init__(self, heat):
+        self._heat = heat
+
+    def list(self, stack_id, **kwargs):
+        self._heat._count('resources.list')
+        with self._heat._lock:
+            stack = self._heat._find(stack_id)
+            return [stack.resources[name] for name in sorted(stack.resources)]
+
+
+class FakeHeat(object):
+    """Stacks creating their resources as they are watched
+
+    create_stack(name, template, parameters, outputs) starts the creation
+    of a stack, replacing any stack of the same name. Every events listing
+    of a stack in progress moves resources_per_poll of its resources
+    further.
+
+    Every call is counted in calls, under 'heat.<manager>.<method>'.
+    """
+
+    def __init__(self, calls, resources_per_poll=20):
+        self.calls = calls
+        self.resources_per_poll = resources_per_poll
+        self.stacks = _StackManager(self)
+        self.events = _EventManager(self)
+        self.resources = _ResourceManager(self)
+        self.stacks_by_name = {}
+        self._lock = threading.RLock()
+
+    def create_stack(self, name, template, parameters=None, outputs=None):
+        stack = _Stack(name, template, parameters or {}, outputs or {})
+        with self._lock:
+            self.stacks_by_name[name] = stack
+        return stack.id
+
+    def _count(self, method):
+        with self._lock:
+            self.calls['heat.' + method] += 1
+
+    def _find(self, stack_id):
+        """Look a stack up by its name, its ID or both as name/ID"""
+        with self._lock:
+            name = stack_id.split('/')[0]
+            if name in self.stacks_by_name:
+                return self.stacks_by_name[name]
+            for stack in self.stacks_by_name.values():
+                if stack.id in (name, stack_id.split('/')[-1]):
+                    return stack
+        raise heat_exc.HTTPNotFound()
+
+    def _list_events(self, stack_id, nested_depth=None, sort_dir=None,
+                     marker=None, limit=None, **kwargs):
+        self._count('events.list')
+        with self._lock:
+            stack = self._find(stack_id)
+            stack.advance(self.resources_per_poll)
+            events = list(stack.events)
+        ids = [event.id for event in events]
+        if sort_dir == 'desc':
+            events.reverse()
+            ids.reverse()
+        if marker in ids:
+            events = events[ids.index(marker) + 1:]
+        if limit is not None:
+            events = events[:limit]
+        return events
@@ -0,0 +1,117 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""An in-memory stand-in for the Zaqar websocket message bus
+
+The fake connection plugs into the real plugin.MultiplexedWebsocket and
+WebsocketSubscription classes, so the routing of the messages by the client
+is exercised as it is against Zaqar.
+"""
+
+import threading
+
+from six.moves import queue
+import websocket
+
+from tripleoclient import plugin
+
+
+class FakeMessageBus(object):
+    """Deliver the payloads published on a queue to its connections
+
+    Every published message is counted in calls, under 'zaqar.messages'.
+    """
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.consumers = []
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def connect(self, queue_name):
+        connection = FakeWebsocketClient(self, queue_name)
+        with self._lock:
+            self.calls['zaqar.connect'] += 1
+            self._connections.setdefault(queue_name, []).append(connection)
+        return connection
+
+    def disconnect(self, connection):
+        with self._lock:
+            connections = self._connections.get(connection.queue_name, [])
+            if connection in connections:
+                connections.remove(connection)
+
+    def publish(self, queue_name, payload):
+        with self._lock:
+            self.calls['zaqar.messages'] += 1
+            connections = list(self._connections.get(queue_name, []))
+        for connection in connections:
+            connection.deliver({'body': {'payload': payload}})
+
+    def consumed(self, payload):
+        """Tell the consumers that the client took a payload"""
+        for consumer in self.consumers:
+            consumer(payload)
+
+
+class _FakeSocket(object):
+
+    def settimeout(self, timeout):
+        pass
+
+
+class FakeWebsocketClient(object):
+    """The part of plugin.WebsocketClient used by MultiplexedWebsocket"""
+
+    _CLOSE = object()
+
+    def __init__(self, bus, queue_name):
+        self._bus = bus
+        self.queue_name = queue_name
+        self._ws = _FakeSocket()
+        self._messages = queue.Queue()
+
+    def deliver(self, message):
+        self._messages.put(message)
+
+    def recv(self):
+        message = self._messages.get()
+        if message is self._CLOSE:
+            raise websocket.WebSocketConnectionClosedException()
+        return message
+
+    def subscribe(self, wait_for_response=True):
+        pass
+
+    def cleanup(self):
+        self._bus.disconnect(self)
+        self._messages.put(self._CLOSE)
+
+
+class FakeMultiplexedWebsocket(plugin.MultiplexedWebsocket):
+    """A MultiplexedWebsocket reading from a FakeMessageBus
+
+    The bus is told about every message the client takes from it.
+    """
+
+    def __init__(self, bus, queue_name="tripleo"):
+        self._bus = bus
+        super(FakeMultiplexedWebsocket, self).__init__(bus, queue_name)
+
+    def _connect(self, bus, queue_name, cacert):
+        return bus.connect(queue_name)
+
+    def get(self, inbox, timeout=None):
+        message = super(FakeMultiplexedWebsocket, self).get(inbox, timeout)
+        self._bus.consumed(message['body']['payload'])
+        return message
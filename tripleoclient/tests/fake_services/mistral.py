@@ -0,0 +1,159 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""An in-memory stand-in for the Mistral client
+
+Workflows are scripted: the script registered for a workflow name is called
+with the workflow input and returns the payloads the workflow sends, which
+are published on the message bus as soon as the execution is created. The
+status of the last payload gives the final state of the execution, which it
+enters once the client took that payload from the bus, as if the workflow
+ran exactly as fast as the client reads its messages.
+"""
+
+import json
+import threading
+import uuid
+
+
+class FakeExecution(object):
+
+    def __init__(self, workflow_name, workflow_input):
+        self.id = str(uuid.uuid4())
+        self.workflow_name = workflow_name
+        self.input = json.dumps(workflow_input)
+        self.state = 'RUNNING'
+        self.state_info = None
+        self.output = '{}'
+
+    def to_dict(self):
+        return {'id': self.id, 'workflow_name': self.workflow_name,
+                'input': self.input, 'state': self.state,
+                'state_info': self.state_info, 'output': self.output}
+
+
+class FakeActionExecution(object):
+
+    def __init__(self, name, state, result):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.state = state
+        self.output = json.dumps({'result': result})
+
+
+class _ExecutionManager(object):
+
+    def __init__(self, mistral):
+        self._mistral = mistral
+
+    def create(self, workflow_identifier, workflow_input=None, **kwargs):
+        return self._mistral._run_workflow(workflow_identifier,
+                                           workflow_input or {})
+
+    def get(self, id):
+        self._mistral._count('executions.get')
+        return self._mistral.executions_by_id[id]
+
+    def list(self, **kwargs):
+        self._mistral._count('executions.list')
+        return list(self._mistral.executions_by_id.values())
+
+
+class _ActionExecutionManager(object):
+
+    def __init__(self, mistral):
+        self._mistral = mistral
+
+    def create(self, name, input=None, save_result=None, run_sync=None,
+               **kwargs):
+        return self._mistral._run_action(name, input or {})
+
+
+class FakeMistral(object):
+    """Scripted workflows and actions
+
+    register_workflow(name, script) makes script(workflow_input) provide
+    the payloads of the executions of the workflow, without their
+    execution_id which is added. register_action(name, action) makes
+    action(**input) provide the result of the action, an exception raised
+    by it gives an action in ERROR state. Workflows and actions which are
+    not registered succeed at once.
+
+    Every call is counted in calls, under 'mistral.<manager>.<method>'.
+    """
+
+    def __init__(self, bus, calls, queue_name='tripleo'):
+        self.calls = calls
+        self.executions = _ExecutionManager(self)
+        self.action_executions = _ActionExecutionManager(self)
+        self.executions_by_id = {}
+        self._bus = bus
+        self._queue_name = queue_name
+        self._workflows = {}
+        self._actions = {}
+        self._final_states = {}
+        self._lock = threading.Lock()
+        bus.consumers.append(self._consumed)
+
+    def register_workflow(self, name, script):
+        self._workflows[name] = script
+
+    def register_action(self, name, action):
+        self._actions[name] = action
+
+    def _count(self, method):
+        with self._lock:
+            self.calls['mistral.' + method] += 1
+
+    def _run_workflow(self, name, workflow_input):
+        self._count('executions.create')
+        execution = FakeExecution(name, workflow_input)
+        with self._lock:
+            self.executions_by_id[execution.id] = execution
+
+        script = self._workflows.get(name)
+        payloads = script(workflow_input) if script else [
+            {'status': 'SUCCESS', 'message': '%s completed' % name}]
+        payload = {}
+        for payload in payloads:
+            payload = dict(payload, execution_id=execution.id,
+                           root_execution_id=execution.id)
+            self._bus.publish(self._queue_name, payload)
+        execution.output = json.dumps(payload)
+        if payload.get('status', 'SUCCESS') == 'SUCCESS':
+            final_state = 'SUCCESS', None
+        else:
+            final_state = 'ERROR', payload.get('message')
+        with self._lock:
+            self._final_states[execution.id] = payload, final_state
+        return execution
+
+    def _consumed(self, payload):
+        execution_id = payload.get('execution_id')
+        with self._lock:
+            final_payload, final_state = self._final_states.get(
+                execution_id, (None, None))
+            if final_payload is not None and payload == final_payload:
+                del self._final_states[execution_id]
+                execution = self.executions_by_id[execution_id]
+                execution.state, execution.state_info = final_state
+
+    def _run_action(self, name, action_input):
+        self._count('action_executions.create')
+        action = self._actions.get(name)
+        if action is None:
+            return FakeActionExecution(name, 'SUCCESS', None)
+        try:
+            return FakeActionExecution(name, 'SUCCESS', action(**action_input))
+        except Exception as e:
+            return FakeActionExecution(name, 'ERROR', str(e))
@@ -0,0 +1,152 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""An in-memory stand-in for a swiftclient Connection"""
+
+import hashlib
+import io
+import tarfile
+import threading
+
+import six
+from swiftclient import exceptions as swift_exc
+
+
+def _read(contents):
+    """Return the bytes of object contents given as swiftclient accepts"""
+    if contents is None:
+        return b''
+    if hasattr(contents, 'read'):
+        contents = contents.read()
+    elif not isinstance(contents, (six.binary_type, six.text_type)):
+        # An iterable of chunks, as for a chunked transfer
+        contents = b''.join(
+            chunk.encode('utf-8') if isinstance(chunk, six.text_type)
+            else chunk for chunk in contents)
+    if isinstance(contents, six.text_type):
+        contents = contents.encode('utf-8')
+    return contents
+
+
+class FakeSwift(object):
+    """Containers of objects kept in memory
+
+    Only the methods of swiftclient.client.Connection used by the client
+    are provided, including the extraction of a tarball uploaded with the
+    extract-archive query string. Every call is counted in calls, under
+    'swift.<method>'.
+    """
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.containers = {}
+        self._lock = threading.Lock()
+
+    def _count(self, method):
+        with self._lock:
+            self.calls['swift.' + method] += 1
+
+    def _container(self, container):
+        try:
+            return self.containers[container]
+        except KeyError:
+            raise swift_exc.ClientException(
+                'Container GET failed', http_status=404,
+                http_path=container)
+
+    def _put(self, container, name, data):
+        with self._lock:
+            self._container(container)[name] = (
+                data, hashlib.md5(data).hexdigest())
+
+    def get_account(self, **kwargs):
+        self._count('get_account')
+        with self._lock:
+            return {}, [{'name': name, 'count': len(objects)}
+                        for name, objects in sorted(self.containers.items())]
+
+    def put_container(self, container, headers=None, **kwargs):
+        self._count('put_container')
+        with self._lock:
+            self.containers.setdefault(container, {})
+
+    def head_container(self, container, **kwargs):
+        self._count('head_container')
+        with self._lock:
+            objects = self._container(container)
+            return {'x-container-object-count': str(len(objects))}
+
+    def get_container(self, container, prefix=None, full_listing=False,
+                      **kwargs):
+        self._count('get_container')
+        with self._lock:
+            objects = sorted(self._container(container).items())
+        listing = [{'name': name, 'hash': etag, 'bytes': len(data)}
+                   for name, (data, etag) in objects
+                   if prefix is None or name.startswith(prefix)]
+        return {'x-container-object-count': str(len(listing))}, listing
+
+    def delete_container(self, container, **kwargs):
+        self._count('delete_container')
+        with self._lock:
+            if self._container(container):
+                raise swift_exc.ClientException(
+                    'Container DELETE failed', http_status=409,
+                    http_path=container)
+            del self.containers[container]
+
+    def put_object(self, container, obj, contents=None, query_string=None,
+                   headers=None, **kwargs):
+        self._count('put_object')
+        data = _read(contents)
+        if query_string and query_string.startswith('extract-archive='):
+            with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as tar:
+                for member in tar:
+                    if member.isfile():
+                        name = member.name
+                        if name.startswith('./'):
+                            name = name[2:]
+                        self._put(container, name,
+                                  tar.extractfile(member).read())
+            return ''
+        self._put(container, obj, data)
+        return hashlib.md5(data).hexdigest()
+
+    def head_object(self, container, obj, **kwargs):
+        self._count('head_object')
+        data, etag = self._object(container, obj)
+        return {'etag': etag, 'content-length': str(len(data))}
+
+    def get_object(self, container, obj, **kwargs):
+        self._count('get_object')
+        data, etag = self._object(container, obj)
+        return {'etag': etag, 'content-length': str(len(data))}, data
+
+    def delete_object(self, container, obj, **kwargs):
+        self._count('delete_object')
+        with self._lock:
+            objects = self._container(container)
+            if obj not in objects:
+                raise swift_exc.ClientException(
+                    'Object DELETE failed', http_status=404,
+                    http_path='%s/%s' % (container, obj))
+            del objects[obj]
+
+    def _object(self, container, obj):
+        with self._lock:
+            try:
+                return self._container(container)[obj]
+            except KeyError:
+                raise swift_exc.ClientException(
+                    'Object GET failed', http_status=404,
+                    http_path='%s/%s' % (container, obj))
@@ -94,7 +94,8 @@ class TestExport(TestCase):
         mock_get_stack.return_value = self.mock_stack
         with mock.patch('six.moves.builtins.open', self.mock_open):
             export.export_stack(heat, "control")
-        mock_get_stack.assert_called_once_with(heat, 'control')
+        mock_get_stack.assert_called_once_with(heat, 'control',
+                                               resolve_outputs=False)
 
     def test_export_passwords(self):
         swift = mock.Mock()
@@ -16,6 +16,10 @@ import json
 import mock
 import socket
 
+from six.moves import queue
+import websocket
+
+from tripleoclient import exceptions
 from tripleoclient import plugin
 from tripleoclient.tests import base
 from tripleoclient.tests import fakes
@@ -39,14 +43,17 @@ class TestPlugin(base.TestCase):
         client = plugin.make_client(clientmgr)
 
         websocket = client.messaging_websocket()
-        # The second access should not return the same client:
+        # The second access should return a new subscription sharing the
+        # same connection:
         self.assertIsNot(client.messaging_websocket(), websocket)
 
         plugin.make_client(clientmgr)
 
-        # And the functions should only be called when the client is created:
-        self.assertEqual(clientmgr.auth.get_token.call_count, 2)
-        self.assertEqual(clientmgr.get_endpoint_for_service_type.call_count, 2)
+        # And the functions should only be called when the connection is
+        # created:
+        self.assertEqual(clientmgr.auth.get_token.call_count, 1)
+        self.assertEqual(clientmgr.get_endpoint_for_service_type.call_count, 1)
+        self.assertEqual(ws_create_connection.call_count, 1)
         ws_create_connection.assert_called_with("ws://0.0.0.0")
 
     @mock.patch.object(plugin.WebsocketClient, "recv")
@@ -126,15 +133,181 @@ class TestPlugin(base.TestCase):
         client = plugin.make_client(clientmgr)
 
         websocket = client.messaging_websocket()
-        # The second access should not return the same client:
+        # The second access should return a new subscription sharing the
+        # same connection:
         self.assertIsNot(client.messaging_websocket(), websocket)
 
         plugin.make_client(clientmgr)
 
-        # And the functions should only be called when the client is created:
-        self.assertEqual(clientmgr.auth.get_token.call_count, 2)
-        self.assertEqual(clientmgr.get_endpoint_for_service_type.call_count, 2)
+        # And the functions should only be called when the connection is
+        # created:
+        self.assertEqual(clientmgr.auth.get_token.call_count, 1)
+        self.assertEqual(clientmgr.get_endpoint_for_service_type.call_count, 1)
+        self.assertEqual(ws_create_connection.call_count, 1)
         ws_create_connection.assert_called_with(
             "wss://0.0.0.0",
             sslopt={'ca_certs':
                     '/etc/pki/ca-trust/source/anchors/cm-local-ca.pem'})
+
+
+class TestMultiplexedWebsocket(base.TestCase):
+
+    def setUp(self):
+        super(TestMultiplexedWebsocket, self).setUp()
+        self.messages = queue.Queue()
+        for i in range(3):
+            self.messages.put({"headers": {"status": 200}})
+
+        def recv():
+            message = self.messages.get(timeout=5)
+            if isinstance(message, Exception):
+                raise message
+            return message
+
+        patcher = mock.patch.object(plugin.WebsocketClient, "recv",
+                                    side_effect=recv)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("websocket.create_connection")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        clientmgr = mock.MagicMock()
+        clientmgr.get_endpoint_for_service_type.return_value = fakes.WS_URL
+        clientmgr.auth.get_token.return_value = "TOKEN"
+        clientmgr.auth_ref.project_id = "ID"
+        clientmgr.cacert = None
+        self.client = plugin.make_client(clientmgr)
+        self.addCleanup(self.client.cleanup)
+
+    def _sent_actions(self):
+        return [json.loads(c[0][0])['action'] for c in
+                websocket.create_connection.return_value.send.call_args_list]
+
+    def _message(self, execution_id, root_execution_id=None, **payload):
+        payload['execution_id'] = execution_id
+        if root_execution_id:
+            payload['root_execution_id'] = root_execution_id
+        self.messages.put({"body": {"payload": payload}})
+
+    def test_route_by_execution(self):
+        with self.client.messaging_websocket() as ws1, \
+                self.client.messaging_websocket() as ws2:
+            self._message("A", message=1)
+            self._message("B", message=2)
+            self._message("A-sub", "A", message=3)
+            self._message("A", message=4)
+            a_messages = ws1.wait_for_messages(timeout=5, execution_id="A")
+            self.assertEqual([1, 3, 4], [next(a_messages)["message"]
+                                         for i in range(3)])
+            b_messages = ws2.wait_for_messages(timeout=5, execution_id="B")
+            self.assertEqual(2, next(b_messages)["message"])
+
+    @mock.patch.object(plugin, 'BACKLOG_SIZE', 2)
+    def test_backlog_bounded(self):
+        with self.client.messaging_websocket() as ws:
+            for i in range(3):
+                self._message("other", message=i)
+            self._message("A", message=3)
+            messages = ws.wait_for_messages(timeout=5, execution_id="A")
+            self.assertEqual(3, next(messages)["message"])
+            # The oldest message nobody waited for was dropped
+            self.assertEqual([1, 2], [ws.recv(timeout=5)["body"]["payload"]
+                                      ["message"] for i in range(2)])
+            self.assertRaises(exceptions.WebSocketTimeout, ws.recv,
+                              timeout=0.1)
+
+    def test_timeout(self):
+        with self.client.messaging_websocket() as ws:
+            messages = ws.wait_for_messages(timeout=0.1, execution_id="A")
+            self.assertRaises(exceptions.WebSocketTimeout, next, messages)
+
+    def test_wakeup(self):
+        with self.client.messaging_websocket() as ws:
+            wakeups = [0.01, None]
+            messages = ws.wait_for_messages(
+                timeout=5, execution_id="A",
+                wakeup=lambda: wakeups.pop(0) if wakeups else None)
+            self.assertIsNone(next(messages))
+            self._message("A", message=1)
+            self.assertEqual(1, next(messages)["message"])
+
+    def test_wakeup_keeps_timeout(self):
+        with self.client.messaging_websocket() as ws:
+            messages = ws.wait_for_messages(timeout=0.2, execution_id="A",
+                                            wakeup=lambda: 0.05)
+            self.assertIsNone(next(messages))
+            self.assertIsNone(next(messages))
+            self.assertRaises(exceptions.WebSocketTimeout, list, messages)
+
+    def test_connection_closed(self):
+        with self.client.messaging_websocket() as ws:
+            self.messages.put(
+                websocket.WebSocketConnectionClosedException())
+            messages = ws.wait_for_messages(timeout=5, execution_id="A")
+            self.assertRaises(exceptions.WebSocketConnectionClosed, next,
+                              messages)
+        # A new connection is opened for the next subscription
+        for i in range(3):
+            self.messages.put({"headers": {"status": 200}})
+        self.client.messaging_websocket()
+        self.assertEqual(2, websocket.create_connection.call_count)
+
+    def test_reconnect(self):
+        with self.client.messaging_websocket() as ws:
+            self.messages.put(
+                websocket.WebSocketConnectionClosedException())
+            messages = ws.wait_for_messages(timeout=5, execution_id="A")
+            self.assertRaises(exceptions.WebSocketConnectionClosed, next,
+                              messages)
+
+            for i in range(3):
+                self.messages.put({"headers": {"status": 200}})
+            ws.reconnect()
+            self.assertEqual(2, websocket.create_connection.call_count)
+            self._message("A", message=1)
+            messages = ws.wait_for_messages(timeout=5, execution_id="A")
+            self.assertEqual(1, next(messages)["message"])
+
+    def test_reconnect_failed(self):
+        with self.client.messaging_websocket() as ws:
+            self.messages.put(
+                websocket.WebSocketConnectionClosedException())
+            messages = ws.wait_for_messages(timeout=5, execution_id="A")
+            self.assertRaises(exceptions.WebSocketConnectionClosed, next,
+                              messages)
+
+            websocket.create_connection.side_effect = socket.error
+            self.assertRaises(exceptions.WebSocketConnectionClosed,
+                              ws.reconnect)
+
+    def test_responses_ignored(self):
+        with self.client.messaging_websocket() as ws:
+            self.messages.put({"request": {"action": "subscription_create"},
+                               "headers": {"status": 201},
+                               "body": {"subscription_id": "S"}})
+            self._message("A", message=1)
+            messages = ws.wait_for_messages(timeout=5, execution_id="A")
+            self.assertEqual(1, next(messages)["message"])
+
+    @mock.patch.object(plugin, 'SUBSCRIPTION_TTL', 0.1)
+    def test_subscription_renewed(self):
+        with self.client.messaging_websocket() as ws:
+            messages = ws.wait_for_messages(timeout=0.5, execution_id="A")
+            self.assertRaises(exceptions.WebSocketTimeout, next, messages)
+        self.assertEqual(['authenticate', 'queue_create'],
+                         self._sent_actions()[:2])
+        self.assertGreater(
+            self._sent_actions().count('subscription_create'), 2)
+        self.assertEqual(['subscription_create'],
+                         list(set(self._sent_actions()[2:])))
+
+    @mock.patch('atexit.register')
+    def test_cleanup(self, mock_atexit):
+        self.client.messaging_websocket()
+        self.client.messaging_websocket()
+        mock_atexit.assert_called_once_with(self.client.cleanup)
+
+        self.client.cleanup()
+        ws = websocket.create_connection.return_value
+        ws.close.assert_called_once_with()
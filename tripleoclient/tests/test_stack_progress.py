@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+
+import fixtures
+import mock
+
+from tripleoclient import stack_progress
+from tripleoclient.tests import base
+
+TEMPLATE = {
+    'parameters': {
+        'ControllerCount': {'type': 'number', 'default': 1},
+        'ComputeCount': {'type': 'number', 'default': 1},
+    },
+    'resources': {
+        'Networks': {'type': 'OS::TripleO::Network'},
+        'Controller': {'type': 'OS::Heat::ResourceGroup',
+                       'properties': {'count': {'get_param':
+                                                'ControllerCount'}}},
+        'Compute': {'type': 'OS::Heat::ResourceGroup',
+                    'properties': {'count': {'get_param': 'ComputeCount'}}},
+        'Fixed': {'type': 'OS::Heat::ResourceGroup',
+                  'properties': {'count': 2}},
+    },
+}
+
+
+def _event(resource_name, status, stack_name='overcloud'):
+    return mock.Mock(resource_name=resource_name, resource_status=status,
+                     stack_name=stack_name)
+
+
+class TestStackProgress(base.TestCase):
+
+    def setUp(self):
+        super(TestStackProgress, self).setUp()
+        self.history = stack_progress.StackHistory(
+            'overcloud', self.useFixture(fixtures.TempDir()).path)
+        clock = [1000.0]
+        self.clock = clock
+        patcher = mock.patch('time.time', side_effect=lambda: clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _progress(self, action='CREATE', parameters=None):
+        return stack_progress.StackProgress(
+            'overcloud', action, TEMPLATE,
+            parameters or {'ControllerCount': '3', 'ComputeCount': '5'},
+            history=self.history)
+
+    def test_count_expected_resources(self):
+        self.assertEqual((4, 10), stack_progress.count_expected_resources(
+            TEMPLATE, {'ControllerCount': '3', 'ComputeCount': '5'}))
+        # the default of the parameter is used when it is not set
+        self.assertEqual((4, 6), stack_progress.count_expected_resources(
+            TEMPLATE, {'ControllerCount': '3'}))
+
+    def test_progress_without_history(self):
+        progress = self._progress()
+        self.assertEqual(4 + 10 * 40, progress.expected)
+        self.assertIsNone(progress.remaining_time())
+        self.assertIn('time left unknown', progress.status_line())
+
+        self.clock[0] += 101
+        self.assertTrue(progress.update([
+            _event('Networks', 'CREATE_IN_PROGRESS'),
+            _event('Networks', 'CREATE_COMPLETE'),
+            _event('0', 'CREATE_COMPLETE', 'overcloud-Compute'),
+            _event('0', 'CREATE_COMPLETE', 'overcloud-Controller'),
+            _event('Old', 'DELETE_COMPLETE')]))
+
+        self.assertEqual(3, len(progress.completed))
+        self.assertEqual(0, progress.percent())
+        # 101 seconds for 3 resources, 401 resources left
+        self.assertEqual(401 * 101 / 3.0, progress.remaining_time())
+        self.assertEqual(
+            'Stack overcloud CREATE: 0% (3 of ~404 resources), '
+            'about 3:45:00 left', progress.status_line())
+        self.assertFalse(progress.update([_event('Networks',
+                                                 'CREATE_COMPLETE')]))
+
+    def test_history(self):
+        progress = self._progress(parameters={'ControllerCount': '1',
+                                              'ComputeCount': '1'})
+        events = [_event('r%d' % i, 'CREATE_COMPLETE') for i in range(44)]
+        progress.update(events)
+        self.clock[0] += 440
+        progress.finish('CREATE_COMPLETE')
+        self.assertEqual([{'finished_at': 1440.0, 'duration': 440.0,
+                           'resources': 44, 'top_resources': 4,
+                           'nodes': 4}], self.history.runs('CREATE'))
+
+        # 10 resources per node, 10 seconds per resource
+        progress = self._progress()
+        self.assertEqual(4 + 10 * 10, progress.expected)
+        progress.update(events)
+        self.assertEqual(42, progress.percent())
+        self.assertEqual(600, progress.remaining_time())
+        self.assertIn('about 0:10:00 left', progress.status_line())
+
+        # the updates have their own history
+        self.assertEqual(4 + 10 * 40, self._progress('UPDATE').expected)
+
+    def test_finish_failed(self):
+        progress = self._progress()
+        progress.update([_event('Networks', 'CREATE_COMPLETE')])
+        progress.finish('CREATE_FAILED')
+        self.assertFalse(os.path.exists(self.history.path))
+
+    @mock.patch('tripleoclient.constants.STACK_HISTORY_RUNS', 2)
+    def test_history_runs(self):
+        for duration in (1, 2, 3):
+            self.history.add('CREATE', {'duration': duration})
+        self.assertEqual([{'duration': 2}, {'duration': 3}],
+                         self.history.runs('CREATE'))
+
+    def test_history_invalid(self):
+        with open(self.history.path, 'w') as f:
+            f.write('{')
+        self.assertEqual([], self.history.runs('CREATE'))
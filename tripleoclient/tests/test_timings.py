@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import json
+import os
+
+import fixtures
+import mock
+import six
+
+from tripleoclient import plugin
+from tripleoclient.tests import base
+from tripleoclient import timings
+from tripleoclient.workflows import base as workflow_base
+
+
+class TestWorkflowTimings(base.TestCase):
+
+    def setUp(self):
+        super(TestWorkflowTimings, self).setUp()
+        self.timings = timings.WorkflowTimings()
+        patcher = mock.patch.object(timings, 'TIMINGS', self.timings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('atexit.register')
+        self.mock_atexit = patcher.start()
+        self.addCleanup(patcher.stop)
+        clock = [1000.0]
+        self.clock = clock
+        patcher = mock.patch('time.time', side_effect=lambda: clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _tick(self, seconds):
+        self.clock[0] += seconds
+
+    def _run_workflow(self, gaps):
+        mistral = mock.Mock()
+
+        def create(identifier, workflow_input):
+            self._tick(0.5)
+            return mock.Mock(id='IDID')
+        mistral.executions.create.side_effect = create
+        mistral.executions.get.return_value = mock.Mock(id='IDID',
+                                                        state='RUNNING')
+        websocket = mock.Mock()
+
+        def wait_for_messages(timeout):
+            for i, gap in enumerate(gaps):
+                self._tick(gap)
+                yield {'execution_id': 'IDID',
+                       'status': 'RUNNING' if i < len(gaps) - 1
+                       else 'SUCCESS'}
+        websocket.wait_for_messages.side_effect = wait_for_messages
+
+        execution = workflow_base.start_workflow(
+            mistral, 'tripleo.test.v1.wf', {})
+        return list(workflow_base.wait_for_messages(
+            mistral, websocket, execution))
+
+    def test_disabled(self):
+        self._run_workflow([1, 2])
+        self.assertEqual([], self.timings.records)
+        self.assertFalse(self.mock_atexit.called)
+
+    def test_workflow(self):
+        self.timings.enable(summary=True)
+        self.mock_atexit.assert_called_once_with(self.timings.report)
+
+        self._run_workflow([2, 1, 45, 1])
+
+        self.assertEqual([{
+            'type': 'workflow',
+            'name': 'tripleo.test.v1.wf',
+            'execution_id': 'IDID',
+            'started_at': 1000.0,
+            'start_duration': 0.5,
+            'first_message': 2.5,
+            'messages': 4,
+            'longest_idle': 45,
+            'idle_gaps': [[3.5, 45]],
+            'status': 'SUCCESS',
+            'duration': 49.5,
+        }], self.timings.records)
+
+    def test_action(self):
+        self.timings.enable()
+        mistral = mock.Mock()
+
+        def create(action, input_, **kwargs):
+            self._tick(3)
+            return mock.Mock(output='{"result": "ok"}', state='SUCCESS')
+        mistral.action_executions.create.side_effect = create
+
+        workflow_base.call_action(mistral, 'tripleo.test.action')
+
+        self.assertEqual([{'type': 'action', 'name': 'tripleo.test.action',
+                           'started_at': 1000.0, 'state': 'SUCCESS',
+                           'duration': 3}], self.timings.records)
+
+    def test_report(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'timings.jsonl')
+        self.timings.enable(summary=True, path=path)
+        self._run_workflow([1, 1])
+        self._run_workflow([1])
+
+        with mock.patch('sys.stderr', new_callable=six.StringIO) as stderr:
+            self.timings.report()
+
+        summary = stderr.getvalue()
+        self.assertIn('Workflow timings (seconds):', summary)
+        self.assertEqual(2, summary.count('tripleo.test.v1.wf'))
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([2, 1], [r['messages'] for r in records])
+
+
+class TestTimingsOptions(base.TestCase):
+
+    def test_options(self):
+        parser = plugin.build_option_parser(argparse.ArgumentParser())
+        with mock.patch.object(timings.TIMINGS, 'enable') as mock_enable:
+            args = parser.parse_args(['--timings',
+                                      '--timings-file', '/tmp/t.jsonl'])
+
+        self.assertTrue(args.timings)
+        self.assertEqual('/tmp/t.jsonl', args.timings_file)
+        mock_enable.assert_has_calls([mock.call(summary=True),
+                                      mock.call(path='/tmp/t.jsonl')])
+
+    def test_no_options(self):
+        parser = plugin.build_option_parser(argparse.ArgumentParser())
+        with mock.patch.object(timings.TIMINGS, 'enable') as mock_enable:
+            args = parser.parse_args([])
+
+        self.assertIsNone(args.timings)
+        self.assertFalse(mock_enable.called)
@@ -15,7 +15,10 @@
 
 
 import argparse
+import collections
+import copy
 import datetime
+import json
 import logging
 import mock
 import os
@@ -24,10 +27,14 @@ import shutil
 import socket
 import subprocess
 import tempfile
+import threading
+import time
 
 import sys
 
+from heatclient.common import template_utils
 from heatclient import exc as hc_exc
+from swiftclient import client as swift_client
 
 from uuid import uuid4
 
@@ -476,7 +483,7 @@ class TestWaitForStackUtil(TestCase):
         e.event_time = event_time
         return e
 
-    @mock.patch("heatclient.common.event_utils.get_events")
+    @mock.patch("tripleoclient.utils.get_stack_events")
     def test_wait_for_stack_ready(self, mock_el):
         stack = mock.Mock()
         stack.stack_name = 'stack'
@@ -487,7 +494,7 @@ class TestWaitForStackUtil(TestCase):
         self.assertTrue(complete)
 
     @mock.patch("time.sleep")
-    @mock.patch("heatclient.common.event_utils.poll_for_events")
+    @mock.patch("tripleoclient.utils.poll_for_stack_events")
     @mock.patch("tripleoclient.utils.get_stack")
     def test_wait_for_stack_ready_retry(self, mock_get_stack, mock_poll,
                                         mock_time):
@@ -503,7 +510,7 @@ class TestWaitForStackUtil(TestCase):
         self.assertTrue(complete)
 
     @mock.patch("time.sleep")
-    @mock.patch("heatclient.common.event_utils.poll_for_events")
+    @mock.patch("tripleoclient.utils.poll_for_stack_events")
     @mock.patch("tripleoclient.utils.get_stack")
     def test_wait_for_stack_ready_retry_fail(self, mock_get_stack, mock_poll,
                                              mock_time):
@@ -519,7 +526,7 @@ class TestWaitForStackUtil(TestCase):
                           self.mock_orchestration, 'stack')
 
     @mock.patch("time.sleep")
-    @mock.patch("heatclient.common.event_utils.poll_for_events")
+    @mock.patch("tripleoclient.utils.poll_for_stack_events")
     @mock.patch("tripleoclient.utils.get_stack")
     def test_wait_for_stack_ready_server_fail(self, mock_get_stack, mock_poll,
                                               mock_time):
@@ -541,7 +548,7 @@ class TestWaitForStackUtil(TestCase):
 
         self.assertFalse(complete)
 
-    @mock.patch("heatclient.common.event_utils.get_events")
+    @mock.patch("tripleoclient.utils.get_stack_events")
     def test_wait_for_stack_ready_failed(self, mock_el):
         stack = mock.Mock()
         stack.stack_name = 'stack'
@@ -552,7 +559,7 @@ class TestWaitForStackUtil(TestCase):
 
         self.assertFalse(complete)
 
-    @mock.patch("heatclient.common.event_utils.poll_for_events")
+    @mock.patch("tripleoclient.utils.poll_for_stack_events")
     def test_wait_for_stack_in_progress(self, mock_poll_for_events):
 
         mock_poll_for_events.return_value = ("CREATE_IN_PROGRESS", "MESSAGE")
@@ -565,6 +572,248 @@ class TestWaitForStackUtil(TestCase):
         result = utils.wait_for_stack_ready(self.mock_orchestration, 'stack')
         self.assertEqual(False, result)
 
+    @mock.patch("tripleoclient.utils.poll_for_stack_events")
+    def test_wait_for_stack_ready_poll_period(self, mock_poll):
+        mock_poll.return_value = ("UPDATE_COMPLETE", "MESSAGE")
+        stack = mock.Mock()
+        stack.stack_name = 'stack'
+        stack.id = 'id'
+        self.mock_orchestration.stacks.get.return_value = stack
+
+        self.assertTrue(utils.wait_for_stack_ready(
+            self.mock_orchestration, 'stack', marker='m', action='UPDATE',
+            poll_period=2))
+        mock_poll.assert_called_once_with(
+            self.mock_orchestration, 'stack/id', action='UPDATE',
+            poll_period=2, marker='m', out=mock.ANY, nested_depth=2,
+            api_calls=mock.ANY, marker_callback=mock.ANY,
+            progress=None)
+
+    def _stack_event(self, id, resource_name='server',
+                     resource_status='CREATE_IN_PROGRESS'):
+        e = mock.Mock(id=id, resource_name=resource_name,
+                      resource_status=resource_status,
+                      physical_resource_id='stack-id', links=[])
+        return e
+
+    @mock.patch("heatclient.common.utils.event_log_formatter",
+                return_value='')
+    @mock.patch("tripleoclient.utils.get_stack_events")
+    def test_poll_for_stack_events_backoff(self, mock_events, mock_format):
+        mock_events.side_effect = [
+            [self._stack_event('1')], [], [], [], [],
+            [self._stack_event('2')], [],
+            [self._stack_event('3', 'stack', 'CREATE_COMPLETE')]]
+        stack = mock.Mock(stack_status='CREATE_IN_PROGRESS')
+        self.mock_orchestration.stacks.get.return_value = stack
+        api_calls = collections.Counter()
+
+        with mock.patch('time.sleep') as mock_sleep:
+            status, msg = utils.poll_for_stack_events(
+                self.mock_orchestration, 'stack', action='CREATE',
+                poll_period=3, max_poll_period=10, out=mock.Mock(),
+                api_calls=api_calls)
+
+        self.assertEqual('CREATE_COMPLETE', status)
+        # the wait grows while nothing comes and is reset by new events
+        self.assertEqual([3, 6, 10, 10, 10, 3, 6],
+                         [c[0][0] for c in mock_sleep.call_args_list])
+        # the listings start after the last event seen
+        self.assertEqual('2', mock_events.call_args[1]['marker'])
+        self.assertEqual({'stack': 2}, api_calls)
+
+    @mock.patch("tripleoclient.utils.save_stack_state")
+    @mock.patch("tripleoclient.utils.poll_for_stack_events")
+    def test_wait_for_stack_ready_save_state(self, mock_poll, mock_save):
+        stack = mock.Mock(id='id')
+        stack.stack_name = 'stack'
+        self.mock_orchestration.stacks.get.return_value = stack
+
+        def poll_once(*args, **kwargs):
+            mock_poll.side_effect = lambda *a, **kw: (
+                "UPDATE_COMPLETE", "MESSAGE")
+            kwargs['marker_callback']('e1')
+            raise hc_exc.HTTPException(code=503)
+        mock_poll.side_effect = poll_once
+
+        self.assertTrue(utils.wait_for_stack_ready(
+            self.mock_orchestration, 'stack', marker='m', action='UPDATE',
+            save_state=True))
+
+        # the retry goes on from the last event seen
+        self.assertEqual(['m', 'e1'], [c[1]['marker']
+                                       for c in mock_poll.call_args_list])
+        mock_save.assert_has_calls([
+            mock.call('stack', 'UPDATE', 'm'),
+            mock.call('stack', 'UPDATE', 'e1'),
+            mock.call('stack', 'UPDATE', 'e1', 'UPDATE_COMPLETE')])
+
+    @mock.patch("heatclient.common.utils.event_log_formatter",
+                return_value='')
+    @mock.patch("tripleoclient.utils.get_stack_events")
+    def test_poll_for_stack_events_progress(self, mock_events, mock_format):
+        events = [self._stack_event('1'),
+                  self._stack_event('2', 'stack', 'CREATE_COMPLETE')]
+        mock_events.return_value = events
+        progress = mock.Mock()
+        progress.update.return_value = True
+        progress.status_line.return_value = 'Stack stack CREATE: 50%'
+
+        with mock.patch('sys.stdout') as stdout:
+            utils.poll_for_stack_events(
+                self.mock_orchestration, 'stack', action='CREATE',
+                out=mock.Mock(), progress=progress)
+
+        progress.update.assert_called_once_with(events)
+        stdout.write.assert_any_call('Stack stack CREATE: 50%')
+
+    @mock.patch("tripleoclient.utils.poll_for_stack_events",
+                return_value=("CREATE_COMPLETE", "MESSAGE"))
+    def test_wait_for_stack_ready_progress(self, mock_poll):
+        progress = mock.Mock()
+        progress_factory = mock.Mock(return_value=progress)
+
+        self.assertTrue(utils.wait_for_stack_ready(
+            self.mock_orchestration, 'stack',
+            progress_factory=progress_factory))
+
+        progress_factory.assert_called_once_with(
+            self.mock_orchestration.stacks.get.return_value)
+        self.assertIs(progress, mock_poll.call_args[1]['progress'])
+        progress.finish.assert_called_once_with('CREATE_COMPLETE')
+
+    @mock.patch("tripleoclient.utils.get_stack_events",
+                return_value=[])
+    def test_poll_for_stack_events_stack_status(self, mock_events):
+        stack = mock.Mock(stack_status='UPDATE_FAILED')
+        self.mock_orchestration.stacks.get.return_value = stack
+        api_calls = collections.Counter()
+
+        status, msg = utils.poll_for_stack_events(
+            self.mock_orchestration, 'stack', action='UPDATE',
+            out=mock.Mock(), api_calls=api_calls)
+
+        self.assertEqual('UPDATE_FAILED', status)
+        self.assertEqual(2, mock_events.call_count)
+        self.assertEqual({'stack': 1}, api_calls)
+
+
+class TestGetStackEvents(TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+
+    def _event(self, id, event_time, stack='overcloud', links=()):
+        event = mock.Mock(id=id, event_time=event_time,
+                          links=[{'rel': 'stack',
+                                  'href': 'http://heat/stacks/%s/x' % stack}]
+                          + list(links))
+        return event
+
+    def test_no_nested_depth(self):
+        events = [self._event('1', '2020-01-01T00:00:01')]
+        self.client.events.list.return_value = events
+
+        self.assertEqual(events, utils.get_stack_events(
+            self.client, 'overcloud', marker='0'))
+        self.client.events.list.assert_called_once_with(
+            stack_id='overcloud', sort_dir='asc', marker='0')
+        self.assertEqual('overcloud', events[0].stack_name)
+
+    def test_nested_depth_api(self):
+        events = [self._event('1', '2020-01-01T00:00:01',
+                              links=[{'rel': 'root_stack'}])]
+        self.client.events.list.return_value = events
+        api_calls = collections.Counter()
+
+        self.assertEqual(events, utils.get_stack_events(
+            self.client, 'overcloud', nested_depth=2, api_calls=api_calls))
+        self.client.events.list.assert_called_once_with(
+            stack_id='overcloud', sort_dir='asc', nested_depth=2)
+        self.assertFalse(self.client.resources.list.called)
+        self.assertEqual({'events': 1}, api_calls)
+
+    @mock.patch('heatclient.common.utils.resource_nested_identifier',
+                side_effect=lambda resource: resource.nested)
+    def test_nested_stacks(self, mock_nested):
+        root = [self._event('r1', '2020-01-01T00:00:01'),
+                self._event('r2', '2020-01-01T00:00:05')]
+        compute = [self._event('c1', '2020-01-01T00:00:02', 'compute'),
+                   self._event('r2', '2020-01-01T00:00:05')]
+        node = [self._event('n1', '2020-01-01T00:00:03', 'node'),
+                self._event('n2', '2020-01-01T00:00:06', 'node')]
+        events = {'overcloud': root, 'compute/1': compute, 'node/2': node}
+        resources = {'overcloud': [mock.Mock(nested='compute/1'),
+                                   mock.Mock(nested=None)],
+                     'compute/1': [mock.Mock(nested='node/2')],
+                     'node/2': [mock.Mock(nested='deeper/3')]}
+
+        def list_events(stack_id, **kwargs):
+            if kwargs.get('nested_depth'):
+                # without root_stack links, the API ignored nested_depth
+                return root
+            return events[stack_id]
+        self.client.events.list.side_effect = list_events
+        self.client.resources.list.side_effect = \
+            lambda stack_id: resources[stack_id]
+        api_calls = collections.Counter()
+
+        result = utils.get_stack_events(self.client, 'overcloud',
+                                        nested_depth=2, marker='r1',
+                                        concurrency=2, api_calls=api_calls)
+
+        self.assertEqual(['c1', 'n1', 'r2', 'n2'],
+                         [event.id for event in result])
+        self.assertEqual(['compute', 'node', 'overcloud', 'node'],
+                         [event.stack_name for event in result])
+        self.assertEqual({'events': 4, 'resources': 2}, api_calls)
+
+    @mock.patch('heatclient.common.utils.resource_nested_identifier',
+                side_effect=lambda resource: resource.nested)
+    def test_nested_stacks_markers(self, mock_nested):
+        root = [self._event('r1', '2020-01-01T00:00:01')]
+        compute = [self._event('c1', '2020-01-01T00:00:02', 'compute')]
+        events = {'overcloud': root, 'compute/1': compute}
+        resources = {'overcloud': [mock.Mock(nested='compute/1')],
+                     'compute/1': []}
+
+        def list_events(stack_id, **kwargs):
+            stack_events = events[stack_id]
+            if kwargs.get('marker'):
+                ids = [event.id for event in stack_events]
+                stack_events = stack_events[
+                    ids.index(kwargs['marker']) + 1:]
+            return stack_events
+        self.client.events.list.side_effect = list_events
+        self.client.resources.list.side_effect = \
+            lambda stack_id: resources[stack_id]
+        api_calls = collections.Counter()
+        stack_markers = {}
+
+        result = utils.get_stack_events(self.client, 'overcloud',
+                                        nested_depth=1, api_calls=api_calls,
+                                        stack_markers=stack_markers)
+        self.assertEqual(['r1', 'c1'], [event.id for event in result])
+        self.assertEqual({'overcloud': 'r1', 'compute/1': 'c1'},
+                         stack_markers)
+
+        compute.append(self._event('c2', '2020-01-01T00:00:03', 'compute'))
+        self.client.events.list.reset_mock()
+        result = utils.get_stack_events(self.client, 'overcloud',
+                                        nested_depth=1, marker='c1',
+                                        api_calls=api_calls,
+                                        stack_markers=stack_markers)
+
+        self.assertEqual(['c2'], [event.id for event in result])
+        self.assertEqual({'overcloud': 'r1', 'compute/1': 'c2'},
+                         stack_markers)
+        self.client.events.list.assert_has_calls([
+            mock.call(stack_id='overcloud', sort_dir='asc', marker='r1'),
+            mock.call(stack_id='compute/1', sort_dir='asc', marker='c1'),
+        ], any_order=True)
+        self.assertEqual(2, self.client.events.list.call_count)
+        self.assertEqual({'events': 5, 'resources': 2}, api_calls)
+
     def test_check_stack_network_matches_env_files(self):
         stack_reg = {
             'OS::TripleO::Hosts::SoftwareConfig': 'val',
@@ -672,6 +921,297 @@ class TestWaitForStackUtil(TestCase):
         self.assertRaises(ValueError, utils.file_checksum, '/dev/zero')
 
 
+class TestStackState(TestCase):
+
+    def setUp(self):
+        self.state_dir = os.path.join(tempfile.mkdtemp(), 'stacks')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.state_dir))
+
+    def test_save_and_load(self):
+        utils.save_stack_state('overcloud', 'UPDATE', 'e1',
+                               state_dir=self.state_dir)
+        utils.save_stack_state('overcloud', 'UPDATE', 'e2', 'UPDATE_COMPLETE',
+                               state_dir=self.state_dir)
+
+        state = utils.load_stack_state('overcloud', state_dir=self.state_dir)
+        self.assertEqual('UPDATE', state['action'])
+        self.assertEqual('e2', state['marker'])
+        self.assertEqual('UPDATE_COMPLETE', state['status'])
+        self.assertEqual(['overcloud.json'], os.listdir(self.state_dir))
+
+    def test_load_missing(self):
+        self.assertIsNone(utils.load_stack_state('overcloud',
+                                                 state_dir=self.state_dir))
+
+    def test_load_invalid(self):
+        os.makedirs(self.state_dir)
+        with open(os.path.join(self.state_dir, 'overcloud.json'), 'w') as f:
+            f.write('{')
+        self.assertIsNone(utils.load_stack_state('overcloud',
+                                                 state_dir=self.state_dir))
+
+
+class TestRunObjectTransfers(TestCase):
+
+    def setUp(self):
+        self.swift = mock.Mock()
+
+    def test_results_in_order(self):
+        transfers = [(str(i), mock.Mock(return_value=i)) for i in range(20)]
+        results = utils.run_object_transfers(self.swift, transfers,
+                                             concurrency=4)
+        self.assertEqual(list(range(20)), results)
+        for name, func in transfers:
+            func.assert_called_once_with(self.swift)
+
+    def test_no_transfers(self):
+        self.assertEqual([], utils.run_object_transfers(self.swift, []))
+
+    def test_connection_per_thread(self):
+        swift = swift_client.Connection(preauthurl='http://swift/v1/AUTH_x',
+                                        preauthtoken='token', retries=2,
+                                        insecure=True)
+        clients = []
+        lock = threading.Lock()
+
+        def transfer(client):
+            with lock:
+                clients.append((threading.current_thread().ident, client))
+
+        utils.run_object_transfers(swift, [(str(i), transfer)
+                                           for i in range(20)],
+                                   concurrency=4)
+
+        per_thread = {}
+        for ident, client in clients:
+            self.assertIs(client, per_thread.setdefault(ident, client))
+        for client in per_thread.values():
+            self.assertIsNot(swift, client)
+            self.assertIsInstance(client, swift_client.Connection)
+            self.assertEqual('http://swift/v1/AUTH_x', client.url)
+            self.assertEqual('token', client.token)
+            self.assertEqual(2, client.retries)
+            self.assertTrue(client.insecure)
+        self.assertEqual(len(per_thread),
+                         len(set(id(c) for c in per_thread.values())))
+
+    def test_failures_reported_in_order(self):
+        transfers = [
+            ('a', mock.Mock(side_effect=IOError('a failed'))),
+            ('b', mock.Mock(return_value='ok')),
+            ('c', mock.Mock(side_effect=IOError('c failed'))),
+        ]
+        with self.assertRaises(exceptions.ObjectTransferError) as cm:
+            utils.run_object_transfers(self.swift, transfers)
+        self.assertEqual('Failed to transfer 2 object(s):\n'
+                         'a: a failed\nc: c failed', str(cm.exception))
+        for name, func in transfers:
+            func.assert_called_once_with(self.swift)
+
+
+class TestCachePlanObjects(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.swift = mock.Mock()
+        # The ETag header does not match the hash of the listing, as it is
+        # the case for large objects.
+        self.swift.get_object.side_effect = \
+            lambda container, name: ({'etag': '"header-%s"' % name},
+                                     'content of ' + name)
+
+    def _cache(self, objects, names=None):
+        return utils.cache_plan_objects(self.swift, 'overcloud', objects,
+                                        names, cache_dir=self.cache_dir)
+
+    def test_cache_plan_objects(self):
+        objects = [{'name': 'foo.yaml', 'hash': 'etag-foo.yaml'},
+                   {'name': 'bar/baz.yaml', 'hash': 'etag-bar/baz.yaml'},
+                   {'name': 'no-etag.yaml'}]
+        paths = self._cache(objects)
+
+        self.assertEqual(['bar/baz.yaml', 'foo.yaml'], sorted(paths))
+        with open(paths['bar/baz.yaml']) as f:
+            self.assertEqual('content of bar/baz.yaml', f.read())
+        self.assertEqual(2, self.swift.get_object.call_count)
+
+        # Nothing changed, everything comes from the cache
+        self.swift.get_object.reset_mock()
+        self.assertEqual(paths, self._cache(objects))
+        self.swift.get_object.assert_not_called()
+
+    def test_cache_plan_objects_changed_etag(self):
+        self._cache([{'name': 'foo.yaml', 'hash': 'etag-foo.yaml'},
+                     {'name': 'bar.yaml', 'hash': 'etag-bar.yaml'}])
+        self.swift.get_object.reset_mock()
+
+        self._cache([{'name': 'foo.yaml', 'hash': 'new'},
+                     {'name': 'bar.yaml', 'hash': 'etag-bar.yaml'}])
+        self.swift.get_object.assert_called_once_with('overcloud',
+                                                      'foo.yaml')
+
+    def test_cache_plan_objects_modified_copy(self):
+        objects = [{'name': 'foo.yaml', 'hash': 'etag-foo.yaml'}]
+        paths = self._cache(objects)
+        with open(paths['foo.yaml'], 'w') as f:
+            f.write('modified locally')
+        self.swift.get_object.reset_mock()
+
+        self._cache(objects)
+        self.swift.get_object.assert_called_once_with('overcloud',
+                                                      'foo.yaml')
+        with open(paths['foo.yaml']) as f:
+            self.assertEqual('content of foo.yaml', f.read())
+
+    def test_cache_plan_objects_removed(self):
+        paths = self._cache([{'name': 'foo.yaml', 'hash': 'etag-foo.yaml'}])
+        self._cache([{'name': 'bar.yaml', 'hash': 'etag-bar.yaml'}])
+        self.assertFalse(os.path.exists(paths['foo.yaml']))
+
+    def test_cache_plan_objects_names(self):
+        objects = [{'name': 'foo.yaml', 'hash': 'etag-foo.yaml'},
+                   {'name': 'bar.yaml', 'hash': 'etag-bar.yaml'}]
+        paths = self._cache(objects)
+        self.swift.get_object.reset_mock()
+
+        # Only fetching some of the objects keeps the others in the cache
+        self.assertEqual({'foo.yaml': paths['foo.yaml']},
+                         self._cache(objects, ['foo.yaml']))
+        self.assertEqual(paths, self._cache(objects, ['bar.yaml', 'foo.yaml',
+                                                      'unknown.yaml']))
+        self.swift.get_object.assert_not_called()
+
+    def test_cache_plan_objects_no_etags(self):
+        self.assertEqual({}, utils.cache_plan_objects(
+            self.swift, 'overcloud', [{'name': 'foo.yaml'}]))
+        self.swift.get_object.assert_not_called()
+
+
+class TestLinkOrCopy(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.src = os.path.join(self.tmp_dir, 'src')
+        self.dst = os.path.join(self.tmp_dir, 'dst')
+        with open(self.src, 'w') as f:
+            f.write('content')
+
+    def test_link(self):
+        utils.link_or_copy(self.src, self.dst)
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+
+    @mock.patch('os.link', side_effect=OSError('cross-device link'))
+    def test_copy(self, mock_link):
+        utils.link_or_copy(self.src, self.dst)
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+        with open(self.dst) as f:
+            self.assertEqual('content', f.read())
+
+
+class TestCopyTemplatesTree(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.src = os.path.join(self.tmp_dir, 'src')
+        self.dst = os.path.join(self.tmp_dir, 'dst')
+        os.makedirs(os.path.join(self.src, 'environments'))
+        for name in ('overcloud.yaml', 'environments/foo.yaml'):
+            with open(os.path.join(self.src, name), 'w') as f:
+                f.write(name)
+        os.symlink('foo.yaml',
+                   os.path.join(self.src, 'environments', 'bar.yaml'))
+
+    def _assert_copied(self):
+        with open(os.path.join(self.dst, 'environments', 'foo.yaml')) as f:
+            self.assertEqual('environments/foo.yaml', f.read())
+        self.assertEqual('foo.yaml', os.readlink(
+            os.path.join(self.dst, 'environments', 'bar.yaml')))
+
+    @mock.patch('tripleoclient.utils._reflink', autospec=True)
+    def test_reflink(self, mock_reflink):
+        mock_reflink.side_effect = shutil.copy2
+        utils.copy_templates_tree(self.src, self.dst, hardlink=True)
+        self._assert_copied()
+        self.assertEqual(2, mock_reflink.call_count)
+
+    @mock.patch('tripleoclient.utils._reflink', autospec=True,
+                side_effect=IOError('Operation not supported'))
+    def test_hardlink(self, mock_reflink):
+        utils.copy_templates_tree(self.src, self.dst, hardlink=True)
+        self._assert_copied()
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.src, 'overcloud.yaml'),
+            os.path.join(self.dst, 'overcloud.yaml')))
+        # reflink is not attempted again once it failed
+        mock_reflink.assert_called_once()
+
+    @mock.patch('tripleoclient.utils._reflink', autospec=True,
+                side_effect=IOError('Operation not supported'))
+    def test_hardlink_replace_file(self, mock_reflink):
+        utils.copy_templates_tree(self.src, self.dst, hardlink=True)
+        path = os.path.join(self.dst, 'environments', 'foo.yaml')
+        with utils.replace_file(path) as f:
+            f.write('modified')
+        with open(path) as f:
+            self.assertEqual('modified', f.read())
+        with open(os.path.join(self.src, 'environments', 'foo.yaml')) as f:
+            self.assertEqual('environments/foo.yaml', f.read())
+        self.assertEqual(['bar.yaml', 'foo.yaml'], sorted(
+            os.listdir(os.path.join(self.dst, 'environments'))))
+
+    def test_replace_file_error(self):
+        path = os.path.join(self.src, 'overcloud.yaml')
+
+        def write():
+            with utils.replace_file(path) as f:
+                f.write('partial')
+                raise IOError('No space left on device')
+
+        self.assertRaises(IOError, write)
+        with open(path) as f:
+            self.assertEqual('overcloud.yaml', f.read())
+        self.assertEqual(['environments', 'overcloud.yaml'],
+                         sorted(os.listdir(self.src)))
+
+    @mock.patch('os.link', side_effect=OSError('Invalid cross-device link'))
+    @mock.patch('tripleoclient.utils._reflink', autospec=True,
+                side_effect=IOError('Operation not supported'))
+    def test_copy(self, mock_reflink, mock_link):
+        utils.copy_templates_tree(self.src, self.dst, hardlink=True)
+        self._assert_copied()
+        self.assertFalse(os.path.samefile(
+            os.path.join(self.src, 'overcloud.yaml'),
+            os.path.join(self.dst, 'overcloud.yaml')))
+        mock_link.assert_called_once()
+
+    @mock.patch('os.link')
+    @mock.patch('tripleoclient.utils._reflink', autospec=True,
+                side_effect=IOError('Operation not supported'))
+    def test_no_hardlink(self, mock_reflink, mock_link):
+        utils.copy_templates_tree(self.src, self.dst)
+        self._assert_copied()
+        mock_link.assert_not_called()
+
+
+class TestExponentialBackoff(TestCase):
+
+    def test_intervals(self):
+        intervals = utils.exponential_backoff(initial=1, maximum=10,
+                                              jitter=0)
+        self.assertEqual([1, 2, 4, 8, 10, 10],
+                         [next(intervals) for i in range(6)])
+
+    def test_jitter(self):
+        intervals = utils.exponential_backoff(initial=1, maximum=8,
+                                              jitter=0.5)
+        for ceiling in (1, 2, 4, 8, 8):
+            interval = next(intervals)
+            self.assertTrue(ceiling / 2.0 <= interval <= ceiling)
+
+
 class TestEnsureRunAsNormalUser(TestCase):
 
     @mock.patch('os.geteuid')
@@ -757,6 +1297,86 @@ class TestGetStackOutputItem(TestCase):
         val = utils.get_stack_output_item(stack, 'baz')
         self.assertEqual(val, None)
 
+    def test_get_stack_output_item_converts_once(self):
+        stack = mock.MagicMock()
+        stack.to_dict.return_value = {
+            'outputs': [{'output_key': 'foo', 'output_value': 'bar'},
+                        {'output_key': 'KeystoneURL',
+                         'output_value': 'http://foo:5000'}]
+        }
+
+        self.assertEqual('bar', utils.get_stack_output_item(stack, 'foo'))
+        self.assertEqual('http://foo:5000',
+                         utils.get_overcloud_endpoint(stack))
+        self.assertIsNone(utils.get_stack_output_item(stack, 'baz'))
+        stack.to_dict.assert_called_once_with()
+        self.assertFalse(stack.output_show.called)
+
+    def test_get_stack_output_item_refreshed(self):
+        stack = mock.MagicMock(updated_time=None,
+                               stack_status='CREATE_IN_PROGRESS')
+        stack.to_dict.return_value = {
+            'outputs': [{'output_key': 'foo', 'output_value': 'bar'}]}
+        self.assertEqual('bar', utils.get_stack_output_item(stack, 'foo'))
+
+        # The stack was updated and fetched again
+        stack.updated_time = '2019-01-01T00:00:00Z'
+        stack.stack_status = 'UPDATE_COMPLETE'
+        stack.to_dict.return_value = {
+            'outputs': [{'output_key': 'foo', 'output_value': 'baz'}]}
+        self.assertEqual('baz', utils.get_stack_output_item(stack, 'foo'))
+        self.assertEqual('baz', utils.get_stack_output_item(stack, 'foo'))
+        self.assertEqual(2, stack.to_dict.call_count)
+
+    def test_get_stack_output_item_unresolved(self):
+        stack = mock.MagicMock()
+        stack.to_dict.return_value = {'stack_name': 'overcloud'}
+        stack.output_show.return_value = {
+            'output': {'output_key': 'foo', 'output_value': 'bar'}}
+
+        self.assertEqual('bar', utils.get_stack_output_item(stack, 'foo'))
+        self.assertEqual('bar', utils.get_stack_output_item(stack, 'foo'))
+        stack.output_show.assert_called_once_with('foo')
+
+    def test_get_stack_output_item_unresolved_not_found(self):
+        stack = mock.MagicMock()
+        stack.to_dict.return_value = {'stack_name': 'overcloud'}
+        stack.output_show.side_effect = hc_exc.HTTPNotFound()
+
+        self.assertIsNone(utils.get_stack_output_item(stack, 'baz'))
+
+    def test_get_service_ips_unresolved(self):
+        stack = mock.MagicMock()
+        stack.to_dict.return_value = {'stack_name': 'overcloud'}
+        stack.output_list.return_value = {
+            'outputs': [{'output_key': 'RedisVip'},
+                        {'output_key': 'KeystoneURL'}]}
+        stack.output_show.side_effect = lambda key: {
+            'output': {'output_key': key, 'output_value': key.lower()}}
+
+        self.assertEqual({'RedisVip': 'redisvip',
+                          'KeystoneURL': 'keystoneurl'},
+                         utils.get_service_ips(stack))
+
+    def test_get_endpoint_vip(self):
+        stack = mock.MagicMock()
+        stack.to_dict.return_value = {
+            'outputs': [{'output_key': 'KeystoneAdminVip',
+                         'output_value': '192.168.24.8'}]
+        }
+
+        self.assertEqual('192.168.24.8',
+                         utils.get_endpoint('KeystoneAdmin', stack))
+
+    def test_get_stack_unresolved_outputs(self):
+        client = mock.Mock()
+
+        self.assertEqual(client.stacks.get.return_value,
+                         utils.get_stack(client, 'overcloud',
+                                         resolve_outputs=False))
+        client.stacks.get.assert_called_once_with('overcloud',
+                                                  resolve_outputs=False)
+
 
 class TestGetEndpointMap(TestCase):
 
@@ -1009,6 +1629,32 @@ class TestPromptUser(TestCase):
         self.assertFalse(result)
 
 
+class TestLoadYaml(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'env.yaml')
+        with open(self.path, 'w') as f:
+            f.write('resource_registry:\n  OS::Foo: foo.yaml\n'
+                    'parameter_defaults:\n  Bar: [1, 2]\n')
+
+    def test_load_yaml_file(self):
+        self.assertEqual({'resource_registry': {'OS::Foo': 'foo.yaml'},
+                          'parameter_defaults': {'Bar': [1, 2]}},
+                         utils.load_yaml_file(self.path))
+
+    def test_load_yaml_file_missing(self):
+        self.assertRaises(IOError, utils.load_yaml_file,
+                          os.path.join(self.tmp_dir, 'missing.yaml'))
+
+    def test_load_yaml_string(self):
+        self.assertEqual({'foo': ['bar']},
+                         utils.load_yaml_string(u'foo: [bar]'))
+        self.assertEqual({'foo': ['bar']},
+                         utils.load_yaml_string(b'foo: [bar]'))
+
+
 class TestReplaceLinks(TestCase):
 
     def setUp(self):
@@ -1059,6 +1705,138 @@ class TestReplaceLinks(TestCase):
             source, self.link_replacement))
         self.assertEqual(expected_dict, result_dict)
 
+    def test_replace_links_keeps_formatting(self):
+        source = (
+            '# A comment\n'
+            'heat_template_version: rocky\n'
+            'resources:\n'
+            '  script:\n'
+            '    type: OS::Heat::SoftwareConfig\n'
+            '    properties:\n'
+            "      config: {get_file: 'file:///home/stack/test.sh'}\n"
+            '  nested:\n'
+            '    type: file:///usr/share/extra-templates/my.yml  # nested\n'
+            '  other:\n'
+            '    type: file:///home/stack/other.yaml\n'
+        )
+        expected = (
+            '# A comment\n'
+            'heat_template_version: rocky\n'
+            'resources:\n'
+            '  script:\n'
+            '    type: OS::Heat::SoftwareConfig\n'
+            '    properties:\n'
+            "      config: {get_file: 'user-files/home/stack/test.sh'}\n"
+            '  nested:\n'
+            '    type: user-files/usr/share/extra-templates/my.yml  # nested\n'
+            '  other:\n'
+            '    type: file:///home/stack/other.yaml\n'
+        )
+        self.assertEqual(expected, utils.replace_links_in_template_contents(
+            source, self.link_replacement))
+
+    def test_replace_links_quoted(self):
+        link_replacement = {
+            'file:///home/stack/test.sh': "user-files/it's \"quoted\".sh",
+        }
+        for quote in ('"', "'"):
+            source = ('heat_template_version: rocky\n'
+                      'resources:\n'
+                      '  script:\n'
+                      '    properties:\n'
+                      '      config:\n'
+                      '        get_file: %sfile:///home/stack/test.sh%s\n'
+                      '    type: OS::Heat::SoftwareConfig\n' % (quote, quote))
+            result = utils.replace_links_in_template_contents(
+                source, link_replacement)
+            self.assertIn('get_file: %s' % quote, result)
+            self.assertEqual(
+                {'config': {'get_file': "user-files/it's \"quoted\".sh"}},
+                yaml.safe_load(result)['resources']['script']['properties'])
+
+    def test_replace_links_block_scalar(self):
+        for indicator in ('|-', '>-'):
+            source = ('heat_template_version: rocky\n'
+                      'resources:\n'
+                      '  script:\n'
+                      '    properties:\n'
+                      '      config:\n'
+                      '        get_file: %s\n'
+                      '          file:///home/stack/test.sh\n'
+                      '    type: OS::Heat::SoftwareConfig\n' % indicator)
+            result = utils.replace_links_in_template_contents(
+                source, self.link_replacement)
+            self.assertEqual(
+                {'script': {'properties': {'config': {
+                    'get_file': 'user-files/home/stack/test.sh'}},
+                    'type': 'OS::Heat::SoftwareConfig'}},
+                yaml.safe_load(result)['resources'])
+
+    def test_replace_links_anchor_and_tag(self):
+        source = ('heat_template_version: rocky\n'
+                  'resources:\n'
+                  '  a: {type: &link file:///home/stack/test.sh}\n'
+                  '  b:\n'
+                  '    type: !!str file:///usr/share/extra-templates/my.yml\n'
+                  'outputs: {link: {value: *link}}\n')
+        result = yaml.safe_load(utils.replace_links_in_template_contents(
+            source, self.link_replacement))
+        self.assertEqual(
+            {'a': {'type': 'user-files/home/stack/test.sh'},
+             'b': {'type': 'user-files/usr/share/extra-templates/my.yml'}},
+            result['resources'])
+        self.assertEqual({'link': {'value': 'file:///home/stack/test.sh'}},
+                         result['outputs'])
+
+    def test_replace_links_no_links(self):
+        source = ('heat_template_version: rocky\n'
+                  'resources:\n'
+                  '  nested: {type: file:///home/stack/other.yaml}\n')
+        with mock.patch('yaml.compose') as mock_compose:
+            self.assertIs(source, utils.replace_links_in_template_contents(
+                source, self.link_replacement))
+        mock_compose.assert_not_called()
+
+    def test_replace_links_bytes(self):
+        source = (b'heat_template_version: rocky\n'
+                  b'resources:\n'
+                  b'  nested: {type: file:///home/stack/test.sh}\n')
+        self.assertEqual(
+            b'heat_template_version: rocky\n'
+            b'resources:\n'
+            b'  nested: {type: user-files/home/stack/test.sh}\n',
+            utils.replace_links_in_template_contents(
+                source, self.link_replacement))
+
+        other = (b'heat_template_version: rocky\n'
+                 b'resources:\n'
+                 b'  nested: {type: file:///home/stack/other.yaml}\n')
+        self.assertIs(other, utils.replace_links_in_template_contents(
+            other, self.link_replacement))
+
+        binary = b'\x89PNG\r\n\x1a\n\xff\xfe'
+        self.assertIs(binary, utils.replace_links_in_template_contents(
+            binary, self.link_replacement))
+
+    def test_replace_links_not_a_link(self):
+        # The link is mentioned, but not as a get_file or type
+        source = ('heat_template_version: rocky\n'
+                  'description: file:///home/stack/test.sh\n')
+        self.assertEqual(source, utils.replace_links_in_template_contents(
+            source, self.link_replacement))
+
+    def test_replace_links_aliases(self):
+        source = ('heat_template_version: rocky\n'
+                  'resources:\n'
+                  '  a: {type: &link file:///home/stack/test.sh}\n'
+                  '  b: {type: *link}\n')
+        result = yaml.safe_load(utils.replace_links_in_template_contents(
+            source, self.link_replacement))
+        self.assertEqual(
+            {'a': {'type': 'user-files/home/stack/test.sh'},
+             'b': {'type': 'user-files/home/stack/test.sh'}},
+            result['resources'])
+
     def test_replace_links_not_template(self):
         # valid JSON/YAML, but doesn't have heat_template_version
         source = '{"get_file": "file:///home/stack/test.sh"}'
@@ -1260,7 +2038,7 @@ class ProcessMultipleEnvironments(TestCase):
             mock.call(env_path='/twd/templates/environments/myenv.yaml'),
             mock.call(env_path='/tmp/thtroot42/notouch.yaml'),
             mock.call(env_path='./tmp/thtroot/notouch2.yaml'),
-            mock.call(env_path='../outside.yaml')])
+            mock.call(env_path='../outside.yaml')], any_order=True)
 
     @mock.patch('heatclient.common.template_utils.'
                 'process_environment_and_files', return_value=({}, {}),
@@ -1318,6 +2096,232 @@ class ProcessMultipleEnvironments(TestCase):
                                         default_flow_style=False)])
 
 
+class TestEnvironmentCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.tht_root = self._make_templates('tht-1')
+
+    def _make_templates(self, name):
+        tht_root = os.path.join(self.tmp_dir, name)
+        os.makedirs(os.path.join(tht_root, 'environments'))
+        with open(os.path.join(tht_root, 'environments', 'env.yaml'),
+                  'w') as f:
+            f.write('resource_registry:\n'
+                    '  OS::TripleO::Foo: ../foo.yaml\n'
+                    'parameter_defaults:\n'
+                    '  Bar: baz\n')
+        with open(os.path.join(tht_root, 'foo.yaml'), 'w') as f:
+            f.write('heat_template_version: rocky\n'
+                    'resources:\n'
+                    '  config:\n'
+                    '    type: OS::Heat::SoftwareConfig\n'
+                    '    properties:\n'
+                    '      config: {get_file: script.sh}\n')
+        with open(os.path.join(tht_root, 'script.sh'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        return tht_root
+
+    def _process(self, tht_root):
+        env_path = os.path.join(tht_root, 'environments', 'env.yaml')
+        return utils.process_multiple_environments(
+            [env_path], tht_root, tht_root, cache_dir=self.cache_dir)
+
+    def test_cache_hit(self):
+        expected = self._process(self.tht_root)
+        with mock.patch('heatclient.common.template_utils.'
+                        'process_environment_and_files') as mock_process:
+            self.assertEqual(expected, self._process(self.tht_root))
+        mock_process.assert_not_called()
+
+    def test_cache_hit_new_tree(self):
+        self._process(self.tht_root)
+        tht_root = os.path.join(self.tmp_dir, 'tht-2')
+        shutil.copytree(self.tht_root, tht_root)
+        expected = utils.process_multiple_environments(
+            [os.path.join(tht_root, 'environments', 'env.yaml')],
+            tht_root, tht_root)
+        with mock.patch('heatclient.common.template_utils.'
+                        'process_environment_and_files') as mock_process:
+            files, env = self._process(tht_root)
+        mock_process.assert_not_called()
+        self.assertEqual(expected, (files, env))
+        self.assertEqual(
+            'file://%s/foo.yaml' % tht_root,
+            env['resource_registry']['OS::TripleO::Foo'])
+
+    def test_cache_dependency_changed(self):
+        self._process(self.tht_root)
+        with open(os.path.join(self.tht_root, 'script.sh'), 'w') as f:
+            f.write('#!/bin/bash\n')
+        files, env = self._process(self.tht_root)
+        self.assertIn('#!/bin/bash\n', [
+            c.decode('utf-8') if isinstance(c, bytes) else c
+            for c in files.values()])
+
+    def test_cache_non_string_keys(self):
+        with open(os.path.join(self.tht_root, 'environments', 'env.yaml'),
+                  'a') as f:
+            f.write('  Ports:\n'
+                    '    8080: http\n'
+                    '    true: yes\n')
+        expected = self._process(self.tht_root)
+        self.assertEqual({8080: 'http', True: True},
+                         expected[1]['parameter_defaults']['Ports'])
+        self.assertFalse(os.path.exists(self.cache_dir))
+        self.assertEqual(expected, self._process(self.tht_root))
+
+    def test_cache_corrupted(self):
+        expected = self._process(self.tht_root)
+        for name in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, name), 'w') as f:
+                f.write('{')
+        self.assertEqual(expected, self._process(self.tht_root))
+
+
+class TestEnvironmentMerger(TestCase):
+
+    envs = [
+        ('a.yaml', {'resource_registry': {'OS::Foo': 'foo.yaml'},
+                    'parameter_defaults': {'A': 1, 'Nested': {'x': 1},
+                                           'Replaced': {'y': 1},
+                                           'Kept': {'z': 1}}}),
+        ('b.yaml', {'parameter_defaults': {'B': [1], 'Nested': {'y': 2},
+                                           'Replaced': None,
+                                           'Kept': {},
+                                           'Scalar': 1}}),
+        ('c.yaml', {'resource_registry': {'OS::Foo': 'OS::Heat::None'},
+                    'parameter_defaults': {'A': 3, 'Nested': {'x': 3},
+                                           'Scalar': {}}}),
+        ('d.yaml', {}),
+    ]
+
+    def test_same_as_deep_update(self):
+        expected = {}
+        merger = utils.EnvironmentMerger()
+        for source, env in self.envs:
+            template_utils.deep_update(expected, copy.deepcopy(env))
+            merger.merge(env, source)
+        self.assertEqual(expected, merger.env)
+
+    def test_sources_not_modified(self):
+        envs = copy.deepcopy(self.envs)
+        merger = utils.EnvironmentMerger()
+        for source, env in envs:
+            merger.merge(env, source)
+        self.assertEqual(self.envs, envs)
+
+    def test_untouched_trees_not_copied(self):
+        big = {'parameter_defaults': {'Big': {'x': list(range(10))}}}
+        merger = utils.EnvironmentMerger()
+        merger.merge(big, 'big.yaml')
+        merged = merger.env['parameter_defaults']['Big']
+        self.assertIsNot(big['parameter_defaults']['Big'], merged)
+        with mock.patch.object(merger, '_copy',
+                               wraps=merger._copy) as mock_copy:
+            merger.merge({'parameter_defaults': {'Other': 1}}, 'other.yaml')
+            env = merger.env
+        # Only the new value is copied, neither on merge nor on read
+        mock_copy.assert_called_once_with(1)
+        self.assertIs(merged, env['parameter_defaults']['Big'])
+
+    def test_result_can_be_modified(self):
+        envs = copy.deepcopy(self.envs)
+        merger = utils.EnvironmentMerger()
+        for source, env in envs:
+            merger.merge(env, source)
+        env = merger.env
+        env['resource_registry']['OS::Foo'] = 'bar.yaml'
+        env['parameter_defaults']['B'].append(2)
+        env['parameter_defaults']['Nested']['x'] = 4
+        env['parameter_defaults']['Kept']['z'] = 4
+        env.pop('parameter_defaults')
+        self.assertEqual(self.envs, envs)
+
+        merger.merge({'parameter_defaults': {'C': 1}}, 'e.yaml')
+        self.assertEqual({'resource_registry': {'OS::Foo': 'bar.yaml'},
+                          'parameter_defaults': {'C': 1}}, merger.env)
+        self.assertEqual(self.envs, envs)
+
+    def test_source_of(self):
+        merger = utils.EnvironmentMerger()
+        for source, env in self.envs:
+            merger.merge(env, source)
+        self.assertEqual('c.yaml', merger.source_of('resource_registry',
+                                                    'OS::Foo'))
+        self.assertEqual('c.yaml', merger.source_of('parameter_defaults',
+                                                    'A'))
+        self.assertEqual('b.yaml', merger.source_of('parameter_defaults',
+                                                    'B'))
+        self.assertEqual('c.yaml', merger.source_of('parameter_defaults',
+                                                    'Nested', 'x'))
+        self.assertEqual('b.yaml', merger.source_of('parameter_defaults',
+                                                    'Nested', 'y'))
+        self.assertEqual('a.yaml', merger.source_of('parameter_defaults',
+                                                    'Replaced', 'y'))
+        self.assertEqual('b.yaml', merger.source_of('parameter_defaults',
+                                                    'Scalar'))
+        self.assertIsNone(merger.source_of('parameter_defaults', 'Foo'))
+
+
+class TestProcessMultipleEnvironmentsConcurrency(TestCase):
+
+    def setUp(self):
+        self.tht_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tht_root)
+        with open(os.path.join(self.tht_root, 'foo.yaml'), 'w') as f:
+            f.write('heat_template_version: rocky\n')
+        self.env_files = []
+        for i in range(6):
+            path = os.path.join(self.tht_root, 'env-%d.yaml' % i)
+            with open(path, 'w') as f:
+                f.write('resource_registry:\n'
+                        '  OS::TripleO::Foo%d: foo.yaml\n'
+                        '  OS::TripleO::Bar: %s\n'
+                        'parameter_defaults:\n'
+                        '  Shared: %d\n'
+                        '  Nested:\n'
+                        '    key%d: %d\n'
+                        '    last: %d\n'
+                        '  List: [%d]\n'
+                        % (i, 'foo.yaml' if i % 2 else 'OS::Heat::None',
+                           i, i, i, i, i))
+            self.env_files.append(path)
+
+    def _process(self, concurrency):
+        return utils.process_multiple_environments(
+            self.env_files, self.tht_root, self.tht_root,
+            concurrency=concurrency)
+
+    def test_same_result_as_serial(self):
+        serial = self._process(1)
+
+        # Make the first environments finish last
+        process = template_utils.process_environment_and_files
+
+        def slow_process(env_path):
+            time.sleep(0.05 * (6 - int(env_path[-6])))
+            return process(env_path=env_path)
+
+        with mock.patch('heatclient.common.template_utils.'
+                        'process_environment_and_files',
+                        side_effect=slow_process):
+            concurrent = self._process(8)
+
+        self.assertEqual(json.dumps(serial), json.dumps(concurrent))
+        files, env = concurrent
+        self.assertEqual(5, env['parameter_defaults']['Shared'])
+        self.assertEqual([5], env['parameter_defaults']['List'])
+        self.assertEqual(5, env['parameter_defaults']['Nested']['last'])
+        self.assertEqual(7, len(env['parameter_defaults']['Nested']))
+
+    def test_first_error_raised(self):
+        os.unlink(os.path.join(self.tht_root, 'foo.yaml'))
+        self.assertRaises(hc_exc.CommandError, self._process, 8)
+
+
 class GetTripleoAnsibleInventory(TestCase):
 
     def setUp(self):
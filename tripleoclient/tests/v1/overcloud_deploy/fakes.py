@@ -124,7 +124,7 @@ class FakeObjectClient(object):
     def get_object(self, *args):
         return [None, "fake"]
 
-    def get_container(self, *args):
+    def get_container(self, *args, **kwargs):
         return [None, [{"name": "fake"}]]
 
 
@@ -1454,6 +1454,29 @@ class TestDeployOvercloud(fakes.TestDeployOvercloud):
         fixture.mock_config_download.assert_called()
         self.assertEqual(240*60, fixture.mock_config_download.call_args[0][9])
 
+    @mock.patch('tripleoclient.utils._reflink', autospec=True,
+                side_effect=IOError('Operation not supported'))
+    def test_write_user_environment_hardlinked(self, mock_reflink):
+        src = self.tmp_dir.join('src')
+        dst = self.tmp_dir.join('dst')
+        os.makedirs(os.path.join(src, 'user-environments'))
+        src_env = os.path.join(src, 'user-environments',
+                               'tripleoclient-parameters.yaml')
+        with open(src_env, 'w') as f:
+            f.write('original')
+        overcloud_deploy.utils.copy_templates_tree(src, dst, hardlink=True)
+        self.cmd.object_client = mock.Mock()
+
+        env_path, swift_path = self.cmd._write_user_environment(
+            {'parameter_defaults': {'Foo': 'bar'}},
+            'tripleoclient-parameters.yaml', dst, 'overcloud')
+
+        with open(env_path) as f:
+            self.assertEqual({'parameter_defaults': {'Foo': 'bar'}},
+                             yaml.safe_load(f))
+        with open(src_env) as f:
+            self.assertEqual('original', f.read())
+
     def test_download_missing_files_from_plan(self):
         # Restore the real function so we don't accidentally call the mock
         self.cmd._download_missing_files_from_plan = self.real_download_missing
@@ -1465,15 +1488,62 @@ class TestDeployOvercloud(fakes.TestDeployOvercloud):
 
         mock_open = mock.mock_open()
         mock_makedirs = mock.Mock()
+        mock_rename = mock.Mock()
         builtin_mod = six.moves.builtins.__name__
 
         with mock.patch('os.makedirs', mock_makedirs):
-            with mock.patch('%s.open' % builtin_mod, mock_open):
-                self.cmd._download_missing_files_from_plan(dirname,
-                                                           'overcast')
+            with mock.patch('os.rename', mock_rename):
+                with mock.patch('%s.open' % builtin_mod, mock_open):
+                    self.cmd._download_missing_files_from_plan(dirname,
+                                                               'overcast')
 
         mock_makedirs.assert_called_with(dirname)
         mock_open.assert_called()
+        mock_rename.assert_called()
+
+    def test_download_missing_files_from_plan_cached(self):
+        self.cmd._download_missing_files_from_plan = self.real_download_missing
+        self.cmd._setup_clients(mock.Mock())
+        object_client = mock.Mock()
+        object_client.get_container.return_value = (None, [
+            {'name': 'local.yaml', 'hash': 'etag-local'},
+            {'name': 'rendered/role.yaml', 'hash': 'etag-role'},
+            {'name': 'no-etag.yaml'}])
+        object_client.get_object.side_effect = \
+            lambda container, name: ({}, b'content of ' + name.encode())
+        self.cmd.object_client = object_client
+        cache_dir = self.tmp_dir.join('cache')
+
+        def download(name, local_file):
+            tht_dir = self.tmp_dir.join(name)
+            os.makedirs(os.path.dirname(os.path.join(tht_dir, local_file)))
+            with open(os.path.join(tht_dir, local_file), 'w') as f:
+                f.write('local')
+            object_client.get_object.reset_mock()
+            with mock.patch.object(constants, 'PLAN_CACHE_DIRECTORY',
+                                   cache_dir):
+                self.cmd._download_missing_files_from_plan(tht_dir,
+                                                           'overcast')
+            object_client.get_container.assert_called_with(
+                'overcast', full_listing=True)
+            with open(os.path.join(tht_dir, local_file)) as f:
+                self.assertEqual('local', f.read())
+            for missing in ('local.yaml', 'rendered/role.yaml',
+                            'no-etag.yaml'):
+                if missing != local_file:
+                    with open(os.path.join(tht_dir, missing), 'rb') as f:
+                        self.assertEqual(b'content of ' + missing.encode(),
+                                         f.read())
+            return sorted(c[0][1]
+                          for c in object_client.get_object.call_args_list)
+
+        self.assertEqual(['no-etag.yaml', 'rendered/role.yaml'],
+                         download('tht-1', 'local.yaml'))
+        # The cached objects which are not needed this time are kept
+        self.assertEqual(['local.yaml', 'no-etag.yaml'],
+                         download('tht-2', 'rendered/role.yaml'))
+        self.assertEqual(['no-etag.yaml'],
+                         download('tht-3', 'local.yaml'))
 
     def test_validate_args_deprecated(self):
         arglist = ['--control-scale', '3', '--control-flavor', 'control']
@@ -1554,6 +1624,34 @@ class TestDeployOvercloud(fakes.TestDeployOvercloud):
             'overcloud'
         )
 
+    @mock.patch('tripleoclient.workflows.deployment.follow_execution',
+                autospec=True)
+    @mock.patch('tripleoclient.utils.get_stack', autospec=True)
+    def test_follow(self, mock_get_stack, mock_follow):
+        arglist = ['--follow', 'IDID']
+        verifylist = [('follow', 'IDID')]
+        parsed_args = self.check_parser(self.cmd, arglist, verifylist)
+
+        self.cmd.take_action(parsed_args)
+
+        mock_follow.assert_called_once_with(self.app.client_manager, 'IDID')
+        self.assertFalse(mock_get_stack.called)
+
+    @mock.patch('tripleoclient.workflows.deployment.follow_stack',
+                autospec=True)
+    @mock.patch('tripleoclient.utils.get_stack', autospec=True)
+    def test_attach(self, mock_get_stack, mock_follow):
+        arglist = ['--attach', '--stack', 'mystack']
+        verifylist = [('attach', True), ('stack', 'mystack')]
+        parsed_args = self.check_parser(self.cmd, arglist, verifylist)
+
+        self.cmd.take_action(parsed_args)
+
+        mock_follow.assert_called_once_with(
+            self.cmd.log, self.app.client_manager, 'mystack',
+            self.cmd.app_args.verbose_level)
+        self.assertFalse(mock_get_stack.called)
+
     @mock.patch('subprocess.Popen', autospec=True)
     def test__get_undercloud_host_entry(self, mock_popen):
         mock_process = mock.Mock()
@@ -1639,6 +1737,32 @@ class TestGetDeploymentStatus(utils.TestCommand):
 
         self.assertEqual(expected, self.cmd.app.stdout.getvalue())
 
+    @mock.patch(
+        'tripleoclient.workflows.deployment.get_deployment_status',
+        autospec=True)
+    @mock.patch('tripleoclient.workflows.deployment.follow_stack',
+                autospec=True)
+    def test_get_deployment_status_follow(self, mock_follow,
+                                          mock_get_deployment_status):
+        self.cmd.app_args = mock.Mock(verbose_level=1)
+        parsed_args = self.check_parser(self.cmd, ['--follow'],
+                                        [('follow', True)])
+        self.cmd.app.stdout = six.StringIO()
+        mock_get_deployment_status.return_value = {
+            'workflow_status': {
+                'payload': {
+                    'plan_name': 'overcloud',
+                    'deployment_status': 'DEPLOY_SUCCESS'
+                }
+            }
+        }
+
+        self.cmd.take_action(parsed_args)
+
+        mock_follow.assert_called_once_with(
+            self.cmd.log, self.app.client_manager, 'overcloud', 1)
+        self.assertIn('DEPLOY_SUCCESS', self.cmd.app.stdout.getvalue())
+
 
 class TestGetDeploymentFailures(utils.TestCommand):
 
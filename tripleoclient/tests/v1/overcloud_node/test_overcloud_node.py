@@ -1188,9 +1188,9 @@ class TestUnprovisionNode(fakes.TestOvercloudNode):
             }
         })
 
-        self.workflow.action_executions.create.side_effect = [
-            rv, rv_provisioned
-        ]
+        self.workflow.action_executions.create.side_effect = \
+            lambda action, input_, **kwargs: (
+                rv_provisioned if input_['provisioned'] else rv)
         with tempfile.NamedTemporaryFile() as inp:
             inp.write(b'- name: Compute\n- name: Controller\n')
             inp.flush()
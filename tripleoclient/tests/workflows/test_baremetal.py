@@ -12,6 +12,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
 import mock
 
 from osc_lib.tests import utils
@@ -377,3 +378,22 @@ class TestBaremetalWorkflows(utils.TestCommand):
             'tripleo.baremetal.v1.clean_manageable_nodes',
             workflow_input={}
         )
+
+    def test_expand_roles_multi(self):
+
+        def create(action, input_, **kwargs):
+            return mock.Mock(state='SUCCESS', output=json.dumps(
+                {'result': {'provisioned': input_['provisioned']}}))
+        self.workflow.action_executions.create.side_effect = create
+
+        results = baremetal.expand_roles_multi(
+            self.app.client_manager, roles=[{'name': 'Compute'}],
+            stackname='overcloud', provisioned_states=[False, True])
+
+        self.assertEqual([{'provisioned': False}, {'provisioned': True}],
+                         results)
+        self.workflow.action_executions.create.assert_any_call(
+            'tripleo.baremetal_deploy.expand_roles',
+            {'roles': [{'name': 'Compute'}], 'stackname': 'overcloud',
+             'provisioned': True},
+            save_result=True, run_sync=True)
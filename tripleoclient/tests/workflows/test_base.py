@@ -12,12 +12,17 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import functools
 import json
 import mock
+import six
+import threading
+import unittest
 
 from osc_lib.tests import utils
 
 from tripleoclient import exceptions as ex
+from tripleoclient import plugin
 from tripleoclient.workflows import base
 
 
@@ -176,6 +181,63 @@ class TestBaseWorkflows(utils.TestCommand):
         self.assertRaises(ex.WorkflowActionError,
                           base.call_action, mistral, action)
 
+    def _action_results(self, mistral, states):
+        def create(action, input_, **kwargs):
+            result = mock.Mock()
+            result.output = json.dumps({'result': input_['value'] * 2})
+            result.state = states.get(input_['value'], 'SUCCESS')
+            return result
+        mistral.action_executions.create.side_effect = create
+
+    def test_call_actions(self):
+        mistral = mock.Mock()
+        self._action_results(mistral, {})
+
+        results = base.call_actions(
+            mistral, [('test-action', {'value': i}) for i in range(5)])
+
+        self.assertEqual([0, 2, 4, 6, 8], results)
+        self.assertEqual(5, mistral.action_executions.create.call_count)
+        mistral.action_executions.create.assert_any_call(
+            'test-action', {'value': 3}, save_result=True, run_sync=True)
+
+    def test_call_actions_at_once(self):
+        mistral = mock.Mock()
+        barrier = threading.Barrier(2, timeout=5) if six.PY3 else None
+        result = mock.Mock(output='{"result": "ok"}', state='SUCCESS')
+
+        def create(action, input_, **kwargs):
+            if barrier:
+                barrier.wait()
+            return result
+        mistral.action_executions.create.side_effect = create
+
+        self.assertEqual(['ok', 'ok'], base.call_actions(
+            mistral, [('a', {}), ('b', {})]))
+
+    def test_call_actions_errors(self):
+        mistral = mock.Mock()
+        self._action_results(mistral, {1: 'ERROR', 3: 'ERROR'})
+        actions = [('test-action', {'value': i}) for i in range(4)]
+
+        results = base.call_actions(mistral, actions,
+                                    return_exceptions=True)
+        self.assertEqual(0, results[0])
+        self.assertIsInstance(results[1], ex.WorkflowActionError)
+        self.assertEqual(4, results[2])
+        self.assertIsInstance(results[3], ex.WorkflowActionError)
+
+        mistral.action_executions.create.reset_mock()
+        self.assertRaises(ex.WorkflowActionError,
+                          base.call_actions, mistral, actions)
+        # the other actions still ran
+        self.assertEqual(4, mistral.action_executions.create.call_count)
+
+    def test_call_actions_empty(self):
+        mistral = mock.Mock()
+        self.assertEqual([], base.call_actions(mistral, []))
+        self.assertFalse(mistral.action_executions.create.called)
+
     def test_wait_for_messages_execution_complete(self):
         payload_a = {
             'status': 'RUNNING',
@@ -203,3 +265,189 @@ class TestBaseWorkflows(utils.TestCommand):
         mistral.executions.get.assert_called_with('aaaa')
 
         websocket.wait_for_messages.assert_called_with(timeout=None)
+
+    def _subscription(self, payloads):
+        websocket = mock.Mock(spec=plugin.WebsocketSubscription)
+
+        def wait_for_messages(timeout, execution_id, wakeup):
+            self.wakeups = []
+            for payload in payloads:
+                self.wakeups.append(wakeup())
+                yield payload
+        websocket.wait_for_messages.side_effect = wait_for_messages
+        return websocket
+
+    @mock.patch('tripleoclient.workflows.base.time.time')
+    def test_wait_for_messages_status_check_rate_limited(self, mock_time):
+        mock_time.return_value = 1000.0
+        progress = {'status': 'RUNNING', 'execution_id': 'aaaa'}
+        done = {'status': 'SUCCESS', 'execution_id': 'aaaa'}
+        websocket = self._subscription([progress] * 5 + [done])
+        mistral = mock.Mock()
+        mistral.executions.get.return_value = mock.Mock(id='aaaa',
+                                                        state='RUNNING')
+        execution = mock.Mock(id='aaaa')
+
+        messages = list(base.wait_for_messages(mistral, websocket, execution))
+
+        self.assertEqual([progress] * 5 + [done], messages)
+        # only the first progress message lead to a lookup
+        mistral.executions.get.assert_called_once_with('aaaa')
+        # and a deferred lookup was then due at the end of the interval
+        self.assertEqual([None, None, 10, 10, 10, 10], self.wakeups)
+
+    @mock.patch('tripleoclient.workflows.base.time.time')
+    def test_wait_for_messages_deferred_status_check(self, mock_time):
+        mock_time.return_value = 1000.0
+        progress = {'status': 'RUNNING', 'execution_id': 'aaaa'}
+        output = {'status': 'SUCCESS', 'execution_id': 'aaaa'}
+        # the final message is missed, the wait times out for the lookup
+        websocket = self._subscription([progress, progress, None])
+        mistral = mock.Mock()
+        running = mock.Mock(id='aaaa', state='RUNNING')
+        success = mock.Mock(id='aaaa', state='SUCCESS',
+                            output=json.dumps(output))
+        mistral.executions.get.side_effect = [running, success]
+        execution = mock.Mock(id='aaaa')
+
+        messages = list(base.wait_for_messages(mistral, websocket, execution))
+
+        self.assertEqual([progress, progress, output], messages)
+        self.assertEqual(2, mistral.executions.get.call_count)
+
+    @mock.patch('tripleoclient.workflows.base.time.time')
+    def test_wait_for_messages_status_check_after_interval(self, mock_time):
+        clock = [1000.0]
+        mock_time.side_effect = lambda: clock[0]
+        progress = {'status': 'RUNNING', 'execution_id': 'aaaa'}
+
+        def payloads():
+            for i in range(3):
+                clock[0] += 6
+                yield progress
+        websocket = self._subscription(payloads())
+        mistral = mock.Mock()
+        mistral.executions.get.return_value = mock.Mock(id='aaaa',
+                                                        state='RUNNING')
+        execution = mock.Mock(id='aaaa')
+
+        list(base.wait_for_messages(mistral, websocket, execution))
+
+        # at 1006 and 1018, not at 1012
+        self.assertEqual(2, mistral.executions.get.call_count)
+
+    def _closing_subscription(self, reconnect_errors, payloads):
+        websocket = mock.Mock(spec=plugin.WebsocketSubscription)
+        websocket.reconnect.side_effect = reconnect_errors
+
+        def wait_for_messages(timeout, execution_id, wakeup):
+            if websocket.reconnect.call_count == 0:
+                raise ex.WebSocketConnectionClosed()
+            for payload in payloads:
+                yield payload
+        websocket.wait_for_messages.side_effect = wait_for_messages
+        return websocket
+
+    @mock.patch('tripleoclient.workflows.base.time.sleep')
+    def test_wait_for_messages_reconnect(self, mock_sleep):
+        done = {'status': 'SUCCESS', 'execution_id': 'aaaa'}
+        websocket = self._closing_subscription(
+            [ex.WebSocketConnectionClosed(), None], [done])
+        mistral = mock.Mock()
+        mistral.executions.get.return_value = mock.Mock(id='aaaa',
+                                                        state='RUNNING')
+        execution = mock.Mock(id='aaaa')
+
+        messages = list(base.wait_for_messages(mistral, websocket, execution))
+
+        self.assertEqual([done], messages)
+        self.assertEqual(2, websocket.reconnect.call_count)
+        # the state is checked once reconnected, messages may have been lost
+        mistral.executions.get.assert_called_once_with('aaaa')
+
+    @mock.patch('tripleoclient.workflows.base.time.sleep')
+    def test_wait_for_messages_reconnect_finished(self, mock_sleep):
+        output = {'status': 'SUCCESS', 'execution_id': 'aaaa'}
+        websocket = self._closing_subscription([None], [])
+        mistral = mock.Mock()
+        mistral.executions.get.return_value = mock.Mock(
+            id='aaaa', state='SUCCESS', output=json.dumps(output))
+        execution = mock.Mock(id='aaaa')
+
+        messages = list(base.wait_for_messages(mistral, websocket, execution))
+
+        self.assertEqual([output], messages)
+        self.assertEqual(1, websocket.wait_for_messages.call_count)
+
+    @mock.patch('tripleoclient.workflows.base.time.sleep')
+    def test_wait_for_messages_poll_fallback(self, mock_sleep):
+        output = {'status': 'SUCCESS', 'execution_id': 'aaaa'}
+        websocket = self._closing_subscription(
+            ex.WebSocketConnectionClosed(), [])
+        mistral = mock.Mock()
+        mistral.executions.get.side_effect = [
+            mock.Mock(id='aaaa', state='RUNNING'),
+            mock.Mock(id='aaaa', state='RUNNING'),
+            mock.Mock(id='aaaa', state='SUCCESS', output=json.dumps(output))]
+        execution = mock.Mock(id='aaaa')
+
+        messages = list(base.wait_for_messages(mistral, websocket, execution))
+
+        self.assertEqual([output], messages)
+        self.assertEqual(5, websocket.reconnect.call_count)
+        self.assertEqual(3, mistral.executions.get.call_count)
+
+    @mock.patch('tripleoclient.workflows.base.time.sleep')
+    @mock.patch('tripleoclient.workflows.base.time.time')
+    def test_wait_for_messages_poll_fallback_timeout(self, mock_time,
+                                                     mock_sleep):
+        clock = [1000.0]
+        mock_time.side_effect = lambda: clock[0]
+        mock_sleep.side_effect = \
+            lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+        websocket = self._closing_subscription(
+            ex.WebSocketConnectionClosed(), [])
+        mistral = mock.Mock()
+        mistral.executions.get.return_value = mock.Mock(id='aaaa',
+                                                        state='RUNNING')
+        execution = mock.Mock(id='aaaa')
+
+        self.assertRaises(ex.WebSocketTimeout, list,
+                          base.wait_for_messages(mistral, websocket,
+                                                 execution, 60))
+
+    def test_wait_for_messages_closed_no_reconnect(self):
+        websocket = mock.Mock()
+        websocket.wait_for_messages.side_effect = \
+            ex.WebSocketConnectionClosed()
+        mistral = mock.Mock()
+        execution = mock.Mock(id='aaaa')
+
+        self.assertRaises(ex.WebSocketConnectionClosed, list,
+                          base.wait_for_messages(mistral, websocket,
+                                                 execution))
+        mistral.executions.get.assert_called_once_with('aaaa')
+
+    def test_run_concurrently(self):
+        calls = [mock.Mock(return_value=i) for i in range(3)]
+        self.assertEqual([0, 1, 2], base.run_concurrently(*calls))
+
+    @unittest.skipIf(six.PY2, "threading.Barrier requires Python 3")
+    def test_run_concurrently_at_once(self):
+        # Each call waits for the other one, so they can only finish when
+        # they run at the same time
+        barrier = threading.Barrier(2, timeout=5)
+
+        def call(result):
+            barrier.wait()
+            return result
+
+        self.assertEqual([0, 1], base.run_concurrently(
+            functools.partial(call, 0), functools.partial(call, 1)))
+
+    def test_run_concurrently_error(self):
+        second = mock.Mock(return_value=2)
+        self.assertRaises(ex.WorkflowServiceError, base.run_concurrently,
+                          mock.Mock(side_effect=ex.WorkflowServiceError),
+                          second)
+        self.assertTrue(second.called)
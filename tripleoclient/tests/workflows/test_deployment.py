@@ -12,7 +12,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import errno
 import mock
+import six
+import socket
+import subprocess
+import time
 
 from osc_lib.tests import utils
 
@@ -33,6 +38,7 @@ class TestDeploymentWorkflows(utils.TestCommand):
         self.websocket.__exit__ = lambda s, *exc: None
         self.tripleoclient.messaging_websocket.return_value = self.websocket
         self.app.client_manager.tripleoclient = self.tripleoclient
+        self.app.client_manager.orchestration = mock.Mock()
 
         self.message_success = iter([{
             "execution": {"id": "IDID"},
@@ -46,14 +52,20 @@ class TestDeploymentWorkflows(utils.TestCommand):
             "message": "Fail.",
         }])
 
-    @mock.patch('tripleoclient.workflows.deployment.wait_for_ssh_port')
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.call',
+                return_value=0)
+    @mock.patch('tripleoclient.workflows.deployment.wait_for_ssh_ports')
     @mock.patch('tripleoclient.workflows.deployment.time.sleep')
     @mock.patch('tripleoclient.workflows.deployment.shutil.rmtree')
     @mock.patch('tripleoclient.workflows.deployment.open')
     @mock.patch('tripleoclient.workflows.deployment.tempfile')
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.'
+                'check_output')
     @mock.patch('tripleoclient.workflows.deployment.subprocess.check_call')
-    def test_enable_ssh_admin(self, mock_check_call, mock_tempfile, mock_open,
-                              mock_rmtree, mock_sleep, mock_wait_for_ssh_port):
+    def test_enable_ssh_admin(self, mock_check_call, mock_check_output,
+                              mock_tempfile, mock_open, mock_rmtree,
+                              mock_sleep, mock_wait_for_ssh_port,
+                              mock_call):
         log = mock.Mock()
         hosts = 'a', 'b', 'c'
         ssh_user = 'test-user'
@@ -61,15 +73,33 @@ class TestDeploymentWorkflows(utils.TestCommand):
 
         mock_tempfile.mkdtemp.return_value = '/foo'
         mock_open.side_effect = [FakeFile('DEVNULL'), FakeFile('pubkey'),
-                                 FakeFile('key')]
+                                 FakeFile('key'), FakeFile('DEVNULL')]
         mock_state = mock.Mock()
         mock_state.state = 'SUCCESS'
         self.workflow.executions.get.return_value = mock_state
         deployment.enable_ssh_admin(log, self.app.client_manager,
                                     'overcloud', hosts, ssh_user, ssh_key)
 
-        # once for ssh-keygen, then twice per host
-        self.assertEqual(7, mock_check_call.call_count)
+        # once for ssh-keygen
+        self.assertEqual(1, mock_check_call.call_count)
+        # three times per host: insert and remove the key, close the master
+        self.assertEqual(9, mock_check_output.call_count)
+        commands = [c[0][0] for c in mock_check_output.call_args_list]
+        for command in commands:
+            self.assertIn('ControlPath=/foo/cm-%C', command)
+            self.assertIn('ControlMaster=no', command)
+        self.assertEqual(3, len([c for c in commands if '-O' in c]))
+        # the master connections are started on their own, without a pipe
+        self.assertEqual(3, mock_call.call_count)
+        for (command,), kwargs in mock_call.call_args_list:
+            self.assertEqual(['ssh', '-o', 'ControlMaster=yes', '-N', '-f'],
+                             command[:5])
+            self.assertIn('ControlPath=/foo/cm-%C', command)
+            self.assertEqual('DEVNULL', kwargs['stdout'].contents)
+            self.assertEqual('DEVNULL', kwargs['stderr'].contents)
+        self.assertEqual(['a', 'b', 'c'],
+                         sorted(c[0][0][-1] for c in mock_call.call_args_list))
+        mock_wait_for_ssh_port.assert_called_once_with(hosts)
 
         # execution ran
         self.assertEqual(1, self.workflow.executions.create.call_count)
@@ -86,15 +116,20 @@ class TestDeploymentWorkflows(utils.TestCommand):
         self.assertEqual(1, mock_rmtree.call_count)
         self.assertEqual('/foo', mock_rmtree.call_args[0][0])
 
-    @mock.patch('tripleoclient.workflows.deployment.wait_for_ssh_port')
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.call',
+                return_value=0)
+    @mock.patch('tripleoclient.workflows.deployment.wait_for_ssh_ports')
     @mock.patch('tripleoclient.workflows.deployment.time.sleep')
     @mock.patch('tripleoclient.workflows.deployment.shutil.rmtree')
     @mock.patch('tripleoclient.workflows.deployment.open')
     @mock.patch('tripleoclient.workflows.deployment.tempfile')
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.'
+                'check_output')
     @mock.patch('tripleoclient.workflows.deployment.subprocess.check_call')
-    def test_enable_ssh_admin_error(self, mock_check_call, mock_tempfile,
-                                    mock_open, mock_rmtree, mock_sleep,
-                                    mock_wait_for_ssh_port):
+    def test_enable_ssh_admin_error(self, mock_check_call, mock_check_output,
+                                    mock_tempfile, mock_open, mock_rmtree,
+                                    mock_sleep, mock_wait_for_ssh_port,
+                                    mock_call):
         log = mock.Mock()
         hosts = 'a', 'b', 'c'
         ssh_user = 'test-user'
@@ -102,7 +137,7 @@ class TestDeploymentWorkflows(utils.TestCommand):
 
         mock_tempfile.mkdtemp.return_value = '/foo'
         mock_open.side_effect = [FakeFile('DEVNULL'), FakeFile('pubkey'),
-                                 FakeFile('privkey')]
+                                 FakeFile('privkey'), FakeFile('DEVNULL')]
         mock_state = mock.Mock()
         mock_state.state = 'ERROR'
         mock_state.to_dict.return_value = dict(state_info='an error')
@@ -113,6 +148,307 @@ class TestDeploymentWorkflows(utils.TestCommand):
                           'overcloud',
                           hosts, ssh_user, ssh_key)
 
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.call',
+                return_value=0)
+    @mock.patch('tripleoclient.workflows.deployment.wait_for_ssh_ports')
+    @mock.patch('tripleoclient.workflows.deployment.time.sleep')
+    @mock.patch('tripleoclient.workflows.deployment.shutil.rmtree')
+    @mock.patch('tripleoclient.workflows.deployment.open')
+    @mock.patch('tripleoclient.workflows.deployment.tempfile')
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.'
+                'check_output')
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.check_call')
+    def test_enable_ssh_admin_backoff(self, mock_check_call,
+                                      mock_check_output, mock_tempfile,
+                                      mock_open, mock_rmtree, mock_sleep,
+                                      mock_wait_for_ssh_port, mock_call):
+        mock_tempfile.mkdtemp.return_value = '/foo'
+        mock_open.side_effect = [FakeFile('DEVNULL'), FakeFile('pubkey'),
+                                 FakeFile('key'), FakeFile('DEVNULL')]
+        states = ['RUNNING'] * 6 + ['SUCCESS']
+        self.workflow.executions.get.side_effect = [
+            mock.Mock(state=state) for state in states]
+
+        with mock.patch('random.uniform', return_value=0):
+            deployment.enable_ssh_admin(mock.Mock(), self.app.client_manager,
+                                        'overcloud', ['a'], 'test-user',
+                                        'test-key')
+
+        self.assertEqual(7, self.workflow.executions.get.call_count)
+        self.assertEqual([1, 2, 4, 8, 15, 15, 15],
+                         [c[0][0] for c in mock_sleep.call_args_list])
+
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.call',
+                return_value=0)
+    @mock.patch('tripleoclient.workflows.deployment.wait_for_ssh_ports')
+    @mock.patch('tripleoclient.workflows.deployment.shutil.rmtree')
+    @mock.patch('tripleoclient.workflows.deployment.open')
+    @mock.patch('tripleoclient.workflows.deployment.tempfile')
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.'
+                'check_output')
+    @mock.patch('tripleoclient.workflows.deployment.subprocess.check_call')
+    def test_enable_ssh_admin_host_failures(self, mock_check_call,
+                                            mock_check_output, mock_tempfile,
+                                            mock_open, mock_rmtree,
+                                            mock_wait_for_ssh_port,
+                                            mock_call):
+        mock_tempfile.mkdtemp.return_value = '/foo'
+        mock_open.side_effect = [FakeFile('DEVNULL'), FakeFile('pubkey'),
+                                 FakeFile('key'), FakeFile('DEVNULL')]
+
+        def check_output(command, **kwargs):
+            if command[-2] in ('b', 'c') and '-O' not in command:
+                raise subprocess.CalledProcessError(
+                    255, command, b'Permission denied (publickey).')
+            return b''
+        mock_check_output.side_effect = check_output
+
+        with mock.patch('sys.stdout', new_callable=six.StringIO) as stdout:
+            error = self.assertRaises(subprocess.CalledProcessError,
+                                      deployment.enable_ssh_admin,
+                                      mock.Mock(), self.app.client_manager,
+                                      'overcloud', ['a', 'b', 'c'],
+                                      'test-user', 'test-key')
+
+        # every host was tried, the error of the first failed one is raised
+        self.assertEqual('b', error.cmd[-2])
+        mock_wait_for_ssh_port.assert_called_once_with(['a', 'b', 'c'])
+        self.assertEqual(0, self.workflow.executions.create.call_count)
+        output = stdout.getvalue()
+        self.assertIn('Permission denied (publickey).', output)
+        self.assertIn('Inserting TripleO short term key failed for 2 of 3 '
+                      'hosts: b, c', output)
+        # the master connections are closed and the keys removed locally
+        self.assertEqual(3, len([c for c in mock_check_output.call_args_list
+                                 if '-O' in c[0][0]]))
+        self.assertEqual(1, mock_rmtree.call_count)
+
+    def test_follow_execution(self):
+        self.workflow.executions.get.return_value = mock.Mock(
+            id='IDID', state='RUNNING',
+            workflow_name='tripleo.deployment.v1.config_download_deploy')
+        self.websocket.wait_for_messages.return_value = iter([
+            {'execution_id': 'IDID', 'status': 'RUNNING',
+             'message': 'TASK [Gathering Facts]'},
+            {'execution_id': 'IDID', 'status': 'SUCCESS',
+             'message': 'Done'}])
+
+        with mock.patch('sys.stdout', new_callable=six.StringIO) as stdout:
+            deployment.follow_execution(self.app.client_manager, 'IDID')
+
+        self.workflow.executions.get.assert_any_call('IDID')
+        output = stdout.getvalue()
+        self.assertIn('TASK [Gathering Facts]\nDone\n', output)
+        self.assertIn('Execution IDID completed.', output)
+
+    def test_follow_execution_failed(self):
+        self.workflow.executions.get.return_value = mock.Mock(
+            id='IDID', state='RUNNING', workflow_name='wf')
+        self.websocket.wait_for_messages.return_value = iter([
+            {'execution_id': 'IDID', 'status': 'FAILED',
+             'message': 'Failed'}])
+
+        self.assertRaises(exceptions.DeploymentError,
+                          deployment.follow_execution,
+                          self.app.client_manager, 'IDID')
+
+    def test_follow_execution_sub_workflow_status(self):
+        finished = mock.Mock(id='IDID', state='ERROR', workflow_name='wf',
+                             output='{}')
+        self.workflow.executions.get.side_effect = [
+            mock.Mock(id='IDID', state='RUNNING', workflow_name='wf'),
+            finished, finished]
+        self.websocket.wait_for_messages.return_value = iter([
+            {'execution_id': 'SUB', 'root_execution_id': 'IDID',
+             'status': 'SUCCESS', 'message': 'Sub-workflow done'},
+            {'execution_id': 'IDID', 'message': 'Failed'}])
+
+        with mock.patch('sys.stdout', new_callable=six.StringIO):
+            error = self.assertRaises(exceptions.DeploymentError,
+                                      deployment.follow_execution,
+                                      self.app.client_manager, 'IDID')
+        self.assertIn('status ERROR', str(error))
+
+    def test_follow_execution_finished(self):
+        self.workflow.executions.get.return_value = mock.Mock(
+            id='IDID', state='ERROR', workflow_name='wf')
+
+        error = self.assertRaises(exceptions.DeploymentError,
+                                  deployment.follow_execution,
+                                  self.app.client_manager, 'IDID')
+        self.assertIn('status ERROR', str(error))
+        self.assertFalse(self.websocket.wait_for_messages.called)
+
+    @mock.patch('tripleoclient.utils.wait_for_stack_ready', autospec=True)
+    @mock.patch('tripleoclient.utils.load_stack_state', autospec=True)
+    @mock.patch('tripleoclient.utils.get_stack', autospec=True)
+    def test_follow_stack(self, mock_get_stack, mock_load, mock_wait):
+        mock_get_stack.return_value = mock.Mock(
+            stack_action='UPDATE', stack_status='UPDATE_IN_PROGRESS')
+        mock_load.return_value = {'action': 'UPDATE', 'marker': 'e1'}
+        mock_wait.return_value = True
+
+        deployment.follow_stack(mock.Mock(), self.app.client_manager,
+                                'overcloud', 1)
+
+        mock_wait.assert_called_once_with(
+            self.app.client_manager.orchestration, 'overcloud', 'e1',
+            'UPDATE', True, save_state=True)
+
+    @mock.patch('heatclient.common.event_utils.get_events', autospec=True)
+    @mock.patch('tripleoclient.utils.wait_for_stack_ready', autospec=True)
+    @mock.patch('tripleoclient.utils.load_stack_state', autospec=True)
+    @mock.patch('tripleoclient.utils.get_stack', autospec=True)
+    def test_follow_stack_no_state(self, mock_get_stack, mock_load,
+                                   mock_wait, mock_events):
+        mock_get_stack.return_value = mock.Mock(
+            stack_action='CREATE', stack_status='CREATE_IN_PROGRESS')
+        # the saved progress is about a previous action
+        mock_load.return_value = {'action': 'UPDATE', 'marker': 'e1'}
+        mock_events.return_value = [mock.Mock(id='e9')]
+        mock_wait.return_value = True
+
+        deployment.follow_stack(mock.Mock(), self.app.client_manager,
+                                'overcloud', 0)
+
+        mock_wait.assert_called_once_with(
+            self.app.client_manager.orchestration, 'overcloud', 'e9',
+            'CREATE', False, save_state=True)
+
+    @mock.patch('tripleoclient.utils.get_stack_events', autospec=True)
+    @mock.patch('openstackclient.shell.OpenStackShell.run', autospec=True)
+    @mock.patch('tripleoclient.utils.wait_for_stack_ready', autospec=True)
+    @mock.patch('tripleoclient.utils.load_stack_state', autospec=True)
+    @mock.patch('tripleoclient.utils.get_stack', autospec=True)
+    def test_follow_stack_finished(self, mock_get_stack, mock_load,
+                                   mock_wait, mock_run, mock_events):
+        mock_get_stack.return_value = mock.Mock(
+            stack_action='UPDATE', stack_status='UPDATE_FAILED')
+        mock_load.return_value = {'action': 'UPDATE', 'marker': 'e1'}
+        mock_events.return_value = [
+            mock.Mock(stack_name='overcloud-Compute-0', resource_name='0',
+                      resource_status='UPDATE_FAILED',
+                      resource_status_reason='Error: deployment failed'),
+            mock.Mock(stack_name='overcloud', resource_name='overcloud',
+                      resource_status='UPDATE_FAILED',
+                      resource_status_reason='Resource failed')]
+
+        with mock.patch('sys.stdout', new_callable=six.StringIO) as stdout:
+            self.assertRaises(exceptions.DeploymentError,
+                              deployment.follow_stack, mock.Mock(),
+                              self.app.client_manager, 'overcloud', 0)
+
+        self.assertIn('Stack overcloud is UPDATE_FAILED', stdout.getvalue())
+        self.assertIn('Failed resources of stack overcloud:\n'
+                      '  overcloud-Compute-0/0: Error: deployment failed\n',
+                      stdout.getvalue())
+        self.assertNotIn('Resource failed', stdout.getvalue())
+        mock_events.assert_called_once_with(
+            self.app.client_manager.orchestration, 'overcloud',
+            nested_depth=5, marker='e1')
+        self.assertFalse(mock_wait.called)
+        mock_run.assert_called_once_with(
+            mock.ANY, ['stack', 'failures', 'list', 'overcloud'])
+
+    @mock.patch('tripleoclient.utils.get_stack', autospec=True,
+                return_value=None)
+    def test_follow_stack_no_stack(self, mock_get_stack):
+        self.assertRaises(exceptions.DeploymentError,
+                          deployment.follow_stack, mock.Mock(),
+                          self.app.client_manager, 'overcloud', 0)
+
+    def test_get_stack_progress(self):
+        stack = mock.Mock(id='overcloud/ID', stack_name='overcloud',
+                          parameters={'ComputeCount': '2'})
+        orchestration = self.app.client_manager.orchestration
+        orchestration.stacks.template.return_value = {'resources': {
+            'Compute': {'type': 'OS::Heat::ResourceGroup',
+                        'properties': {'count': {
+                            'get_param': 'ComputeCount'}}}}}
+
+        with mock.patch('tripleoclient.stack_progress.StackHistory',
+                        autospec=True) as mock_history:
+            mock_history.return_value.runs.return_value = []
+            progress = deployment.get_stack_progress(
+                mock.Mock(), orchestration, stack, 'UPDATE')
+
+        orchestration.stacks.template.assert_called_once_with('overcloud/ID')
+        self.assertEqual('overcloud', progress.stack_name)
+        self.assertEqual('UPDATE', progress.action)
+        self.assertEqual(2, progress.nodes)
+
+    def test_get_stack_progress_error(self):
+        log = mock.Mock()
+        orchestration = self.app.client_manager.orchestration
+        orchestration.stacks.template.side_effect = RuntimeError('boom')
+
+        self.assertIsNone(deployment.get_stack_progress(
+            log, orchestration, mock.Mock(), 'UPDATE'))
+        self.assertTrue(log.warning.called)
+
+    def _listen(self):
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(8)
+        return sock.getsockname()[1]
+
+    def test_wait_for_ssh_ports(self):
+        port = self._listen()
+        deployment.wait_for_ssh_ports(['127.0.0.1', 'localhost'], port=port,
+                                      timeout=5)
+
+    @mock.patch('select.select', side_effect=ValueError(
+        'filedescriptor out of range in select()'))
+    def test_wait_for_ssh_ports_no_select(self, mock_select):
+        port = self._listen()
+        deployment.wait_for_ssh_ports(['127.0.0.1'], port=port, timeout=5)
+        mock_select.assert_not_called()
+
+    @mock.patch('tripleoclient.workflows.deployment.time')
+    def test_wait_for_ssh_ports_retries(self, mock_time):
+        clock = [1000.0]
+        mock_time.time.side_effect = lambda: clock[0]
+        mock_time.sleep.side_effect = \
+            lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+        port = self._listen()
+        connect_ex = socket.socket.connect_ex
+        attempts = []
+
+        def refuse_twice(sock, address):
+            attempts.append(address)
+            if len(attempts) <= 2:
+                return errno.ECONNREFUSED
+            return connect_ex(sock, address)
+
+        with mock.patch('random.uniform', return_value=0), \
+                mock.patch.object(socket.socket, 'connect_ex',
+                                  refuse_twice, create=True):
+            deployment.wait_for_ssh_ports(['127.0.0.1'], port=port,
+                                          timeout=5)
+
+        self.assertEqual(3, len(attempts))
+        self.assertEqual([1, 2],
+                         [c[0][0] for c in mock_time.sleep.call_args_list])
+
+    def test_wait_for_ssh_ports_stragglers(self):
+        port = self._listen()
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+
+        error = self.assertRaises(exceptions.DeploymentError,
+                                  deployment.wait_for_ssh_ports,
+                                  ['127.0.0.1'], port=closed_port,
+                                  timeout=0.2)
+        self.assertEqual('Timed out waiting for port %d from 127.0.0.1' %
+                         closed_port, str(error))
+        # the reachable host does not wait for the unreachable one
+        start = time.time()
+        deployment.wait_for_ssh_ports(['127.0.0.1'], port=port, timeout=5)
+        self.assertLess(time.time() - start, 1)
+
     @mock.patch('tripleoclient.utils.get_blacklisted_ip_addresses')
     @mock.patch('tripleoclient.utils.get_role_net_ip_map')
     def test_get_overcloud_hosts(self, mock_role_net_ip_map,
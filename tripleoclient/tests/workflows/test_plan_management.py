@@ -12,9 +12,16 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
+import io
+import os
+import tarfile
+
+import fixtures
 import mock
 
 from osc_lib.tests import utils
+from oslo_concurrency import processutils
 from swiftclient import exceptions as swift_exc
 
 from tripleoclient import exceptions
@@ -237,6 +244,60 @@ class TestPlanCreationWorkflows(utils.TestCommand):
                             'generate_passwords': False,
                             'validate_stack': False})
 
+    @mock.patch('tripleoclient.workflows.plan_management._tarball_stream',
+                autospec=True)
+    @mock.patch('tripleoclient.workflows.plan_management.tarball',
+                autospec=True)
+    def test_create_plan_from_templates_stream_upload(self, mock_tarball,
+                                                      mock_stream):
+        output = mock.Mock(output='{"result": ""}')
+        output.id = "IDID"
+        self.workflow.action_executions.create.return_value = output
+        self.workflow.executions.create.return_value = output
+        self.websocket.wait_for_messages.return_value = self.message_success
+
+        plan_management.create_plan_from_templates(
+            self.app.client_manager,
+            'test-overcloud',
+            '/tht-root/',
+            validate_stack=False,
+            stream_upload=True)
+
+        mock_tarball.create_tarball.assert_not_called()
+        mock_stream.assert_called_once_with('/tht-root/')
+        self.tripleoclient.object_store.put_object.assert_called_once_with(
+            container='test-overcloud', obj='',
+            contents=mock_stream.return_value,
+            query_string='extract-archive=tar.gz',
+            headers={'X-Detect-Content-Type': 'true'})
+
+
+class TestTarballStream(base.TestCase):
+
+    def setUp(self):
+        super(TestTarballStream, self).setUp()
+        self.tht_root = self.useFixture(fixtures.TempDir()).path
+        os.makedirs(os.path.join(self.tht_root, 'environments'))
+        os.makedirs(os.path.join(self.tht_root, '.git'))
+        for name in ('overcloud.yaml', 'environments/foo.yaml',
+                     '.git/HEAD', 'bar.pyc'):
+            with open(os.path.join(self.tht_root, name), 'w') as f:
+                f.write(name)
+
+    def test_tarball_stream(self):
+        data = b''.join(plan_management._tarball_stream(self.tht_root,
+                                                        chunk_size=16))
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+            names = sorted(m.name for m in tar.getmembers() if m.isfile())
+        self.assertEqual(['./environments/foo.yaml', './overcloud.yaml'],
+                         names)
+
+    def test_tarball_stream_error(self):
+        self.assertRaises(
+            processutils.ProcessExecutionError, b''.join,
+            plan_management._tarball_stream(
+                os.path.join(self.tht_root, 'missing')))
+
 
 class TestPlanUpdateWorkflows(base.TestCommand):
 
@@ -380,6 +441,91 @@ class TestPlanUpdateWorkflows(base.TestCommand):
         mock_update_passwords.assert_called_with(
             mock.ANY, 'test-overcloud', None)
 
+    @mock.patch('tripleoclient.workflows.plan_management.tarball',
+                autospec=True)
+    @mock.patch('tripleo_common.utils.swift.empty_container',
+                autospec=True)
+    def test_update_plan_from_templates_delta_sync(
+            self, mock_empty_container, mock_tarball):
+        tht_root = self.useFixture(fixtures.TempDir()).path
+        os.makedirs(os.path.join(tht_root, 'environments'))
+        os.makedirs(os.path.join(tht_root, '.git'))
+        for name, content in (('roles_data.yaml', 'unchanged'),
+                              ('environments/new.yaml', 'new'),
+                              ('.git/HEAD', 'ignored')):
+            with open(os.path.join(tht_root, name), 'w') as f:
+                f.write(content)
+
+        self.object_store.get_container.return_value = (
+            {},
+            [
+                {'name': 'plan-environment.yaml', 'hash': 'abc'},
+                {'name': 'roles_data.yaml',
+                 'hash': hashlib.md5(b'unchanged').hexdigest()},
+                {'name': 'removed.yaml', 'hash': 'def'},
+            ]
+        )
+
+        plan_management.update_plan_from_templates(
+            self.app.client_manager,
+            'test-overcloud',
+            tht_root,
+            validate_stack=False,
+            delta_sync=True)
+
+        mock_empty_container.assert_not_called()
+        mock_tarball.create_tarball.assert_not_called()
+
+        uploaded = [c[0][1] for c in
+                    self.object_store.put_object.call_args_list]
+        self.assertEqual(['environments/new.yaml', 'plan-environment.yaml'],
+                         uploaded)
+        self.object_store.delete_object.assert_has_calls([
+            mock.call('test-overcloud', 'plan-environment.yaml'),
+            mock.call('test-overcloud', 'removed.yaml'),
+        ])
+
+        self.workflow.executions.create.assert_called_once_with(
+            'tripleo.plan_management.v1.update_deployment_plan',
+            workflow_input={'container': 'test-overcloud',
+                            'generate_passwords': True, 'source_url': None,
+                            'validate_stack': False})
+
+    @mock.patch('tripleoclient.workflows.plan_management._update_passwords',
+                autospec=True)
+    def test_update_plan_from_templates_delta_sync_overrides(
+            self, mock_update_passwords):
+        tht_root = self.useFixture(fixtures.TempDir()).path
+        roles_file = os.path.join(tht_root, 'my_roles.yaml')
+        for name, content in (('roles_data.yaml', 'default'),
+                              ('my_roles.yaml', 'override')):
+            with open(os.path.join(tht_root, name), 'w') as f:
+                f.write(content)
+
+        self.object_store.get_container.return_value = (
+            {},
+            [
+                {'name': 'roles_data.yaml',
+                 'hash': hashlib.md5(b'override').hexdigest()},
+                {'name': 'my_roles.yaml',
+                 'hash': hashlib.md5(b'override').hexdigest()},
+            ]
+        )
+
+        plan_management.update_plan_from_templates(
+            self.app.client_manager,
+            'test-overcloud',
+            tht_root,
+            roles_file=roles_file,
+            validate_stack=False,
+            delta_sync=True)
+
+        # roles_data.yaml is only uploaded from the override
+        uploaded = [c[0][1] for c in
+                    self.object_store.put_object.call_args_list]
+        self.assertEqual(['roles_data.yaml'], uploaded)
+        self.object_store.delete_object.assert_not_called()
+
 
 class TestUpdatePasswords(base.TestCase):
 
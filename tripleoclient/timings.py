@@ -0,0 +1,177 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""Timings of the Mistral workflows and actions run by the client"""
+
+import atexit
+import json
+import logging
+import sys
+import threading
+import time
+
+from prettytable import PrettyTable
+import six
+
+from tripleoclient import constants
+
+LOG = logging.getLogger(__name__)
+
+
+def _name(value):
+    return value if isinstance(value, six.string_types) else None
+
+
+class WaitTimer(object):
+    """Time the messages received while waiting for an execution"""
+
+    def __init__(self, timings, record):
+        self._timings = timings
+        self._record = record
+        self._last = time.time()
+
+    def message(self, payload):
+        now = time.time()
+        record = self._record
+        if record['first_message'] is None:
+            record['first_message'] = round(now - record['started_at'], 3)
+        gap = now - self._last
+        if gap > record['longest_idle']:
+            record['longest_idle'] = round(gap, 3)
+        if gap >= constants.WORKFLOW_TIMINGS_IDLE_GAP:
+            record['idle_gaps'].append(
+                [round(self._last - record['started_at'], 3), round(gap, 3)])
+        record['messages'] += 1
+        if isinstance(payload, dict) and _name(payload.get('status')):
+            record['status'] = payload['status']
+        self._last = now
+
+    def done(self):
+        self._record['duration'] = round(
+            time.time() - self._record['started_at'], 3)
+
+
+class WorkflowTimings(object):
+    """Records of the workflow executions and actions of this process
+
+    Each workflow execution gets a record with the workflow name, the time
+    its start took, the time to its first message, the number of messages,
+    the gaps between messages longer than WORKFLOW_TIMINGS_IDLE_GAP and the
+    time until the wait for it finished, in seconds from its start. Each
+    action gets a record with its name, state and duration.
+
+    Nothing is recorded until enable() was called.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self._executions = {}
+        self._lock = threading.Lock()
+        self._summary = False
+        self._path = None
+        self._registered = False
+
+    def enable(self, summary=False, path=None):
+        """Record the timings and report them when the process exits
+
+        :param summary: print a table of the records to stderr.
+        :param path: append the records to this JSON lines file.
+        """
+        with self._lock:
+            self.enabled = True
+            self._summary = self._summary or summary
+            self._path = path or self._path
+            if not self._registered:
+                atexit.register(self.report)
+                self._registered = True
+
+    def _add(self, record):
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def action(self, name, started_at, state):
+        if self.enabled:
+            self._add({'type': 'action', 'name': _name(name),
+                       'started_at': started_at, 'state': _name(state),
+                       'duration': round(time.time() - started_at, 3)})
+
+    def workflow_started(self, name, execution_id, started_at):
+        if self.enabled:
+            record = self._add(self._workflow_record(name, execution_id,
+                                                     started_at))
+            record['start_duration'] = round(time.time() - started_at, 3)
+            with self._lock:
+                self._executions[execution_id] = record
+
+    def wait(self, execution):
+        """Return a WaitTimer for the messages of an execution, or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            record = self._executions.get(execution.id)
+        if record is None:
+            record = self._add(self._workflow_record(
+                getattr(execution, 'workflow_name', None), execution.id,
+                time.time()))
+            with self._lock:
+                self._executions[execution.id] = record
+        return WaitTimer(self, record)
+
+    @staticmethod
+    def _workflow_record(name, execution_id, started_at):
+        return {'type': 'workflow', 'name': _name(name),
+                'execution_id': _name(execution_id),
+                'started_at': started_at, 'start_duration': None,
+                'first_message': None, 'messages': 0, 'longest_idle': 0,
+                'idle_gaps': [], 'status': None, 'duration': None}
+
+    def summary_table(self):
+        table = PrettyTable(['Type', 'Name', 'Status', 'Duration',
+                             'First message', 'Messages', 'Longest idle'])
+        table.align = 'l'
+        for record in self.records:
+            workflow = record['type'] == 'workflow'
+            table.add_row([
+                record['type'],
+                record['name'] or record.get('execution_id') or '',
+                (record['status'] if workflow else record['state']) or '',
+                record['duration'] if record['duration'] is not None else '',
+                record['first_message'] if workflow and
+                record['first_message'] is not None else '',
+                record['messages'] if workflow else '',
+                record['longest_idle'] if workflow else ''])
+        return table
+
+    def write(self, path):
+        with open(path, 'a') as f:
+            for record in self.records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def report(self):
+        """Print and write the records, as enabled"""
+        if not self.records:
+            return
+        if self._summary:
+            sys.stderr.write('Workflow timings (seconds):\n%s\n' %
+                             self.summary_table())
+        if self._path:
+            try:
+                self.write(self._path)
+            except (IOError, OSError) as e:
+                LOG.warning('Could not write the workflow timings to %s: %s',
+                            self._path, e)
+
+
+TIMINGS = WorkflowTimings()
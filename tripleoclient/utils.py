@@ -21,13 +21,17 @@ try:
 except AttributeError:
     collectionsAbc = collections
 
+import contextlib
 import csv
 import datetime
 import errno
+import fcntl
+import functools
 import getpass
 import glob
 import hashlib
 import logging
+import re
 import shutil
 from six.moves.configparser import ConfigParser
 
@@ -35,6 +39,7 @@ import json
 import netaddr
 import os
 import os.path
+import random
 import simplejson
 import six
 import socket
@@ -42,10 +47,11 @@ import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 import yaml
 
-from heatclient.common import event_utils
+from concurrent import futures
 from heatclient.common import template_utils
 from heatclient.common import utils as heat_utils
 from heatclient.exc import HTTPNotFound
@@ -53,6 +59,7 @@ from osc_lib import exceptions as oscexc
 from osc_lib.i18n import _
 from oslo_concurrency import processutils
 from six.moves import configparser
+from swiftclient import client as swiftclient
 
 from heatclient import exc as hc_exc
 from six.moves.urllib import error as url_error
@@ -481,9 +488,230 @@ def create_tempest_deployer_input(config_name='tempest-deployer-input.conf'):
         config.write(config_file)
 
 
+def _list_stack_events(orchestration_client, stack_id, **event_args):
+    try:
+        events = orchestration_client.events.list(stack_id=stack_id,
+                                                  **event_args)
+    except HTTPNotFound as e:
+        raise oscexc.CommandError(six.text_type(e))
+    default_name = stack_id.split('/')[0]
+    for event in events:
+        # Show which stack the event comes from, as heatclient does
+        links = dict((link.get('rel'), link.get('href'))
+                     for link in getattr(event, 'links', []))
+        href = links.get('stack')
+        event.stack_name = (href.split('/stacks/', 1)[-1].split('/')[0]
+                            if href else default_name)
+    return events
+
+
+def _list_nested_stack_ids(orchestration_client, stack_id):
+    try:
+        resources = orchestration_client.resources.list(stack_id=stack_id)
+    except HTTPNotFound:
+        # The stack was deleted since its parent was listed
+        return []
+    return [nested_id for nested_id in
+            (heat_utils.resource_nested_identifier(r) for r in resources)
+            if nested_id]
+
+
+def get_stack_events(orchestration_client, stack_id, nested_depth=0,
+                     marker=None,
+                     concurrency=constants.STACK_EVENTS_CONCURRENCY,
+                     api_calls=None, stack_markers=None):
+    """Return the events of a stack and of its nested stacks, oldest first
+
+    Heat APIs which support nested_depth return all the events at once.
+    Otherwise the nested stacks are found level by level, and the events
+    of all the stacks are listed, with up to concurrency requests at once.
+    The events are then merged by time and deduplicated by ID.
+
+    :param nested_depth: Depth of the nested stacks whose events are listed
+    :param marker: ID of the last event already seen, only the events
+                   after it are returned
+    :param concurrency: Maximum number of requests made at once
+    :param api_calls: Counter updated with the number of 'events' and
+                      'resources' listings made
+    :param stack_markers: Dictionary updated with the ID of the last event
+                          of each stack, when the stacks are listed one at
+                          a time. When it is passed again, only the events
+                          after these are listed, and the API is not asked
+                          for nested_depth again.
+    """
+    if api_calls is None:
+        api_calls = collections.Counter()
+    if stack_markers is None:
+        stack_markers = {}
+    event_args = {'sort_dir': 'asc'}
+    if marker:
+        event_args['marker'] = marker
+    if not nested_depth:
+        api_calls['events'] += 1
+        return _list_stack_events(orchestration_client, stack_id,
+                                  **event_args)
+
+    if not stack_markers:
+        api_calls['events'] += 1
+        events = _list_stack_events(orchestration_client, stack_id,
+                                    nested_depth=nested_depth, **event_args)
+        if not events or any(link.get('rel') == 'root_stack'
+                             for link in getattr(events[0], 'links', [])):
+            # The API handled the nested stacks
+            return events
+
+    def list_events(nested_id):
+        if nested_id in stack_markers:
+            return _list_stack_events(orchestration_client, nested_id,
+                                      sort_dir='asc',
+                                      marker=stack_markers[nested_id])
+        # The nested stacks do not know about the marker, which is an
+        # event of the root stack
+        return _list_stack_events(orchestration_client, nested_id,
+                                  sort_dir='asc')
+
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        stack_ids = [stack_id]
+        level = [stack_id]
+        for depth in range(nested_depth):
+            api_calls['resources'] += len(level)
+            level = [nested_id for nested_ids in executor.map(
+                functools.partial(_list_nested_stack_ids,
+                                  orchestration_client), level)
+                     for nested_id in nested_ids]
+            if not level:
+                break
+            stack_ids.extend(level)
+        api_calls['events'] += len(stack_ids)
+        event_lists = list(executor.map(list_events, stack_ids))
+
+    # Without stack markers, the events of every stack were listed from the
+    # start and the ones up to marker are dropped below
+    first_listing = not stack_markers
+    for nested_id, event_list in zip(stack_ids, event_lists):
+        if event_list:
+            stack_markers[nested_id] = event_list[-1].id
+
+    events = []
+    seen = set()
+    for event in sorted((event for event_list in event_lists
+                         for event in event_list),
+                        key=lambda event: event.event_time):
+        if event.id not in seen:
+            seen.add(event.id)
+            events.append(event)
+    if marker and first_listing:
+        ids = [event.id for event in events]
+        if marker in ids:
+            events = events[ids.index(marker) + 1:]
+    return events
+
+
+def _is_stack_event(event, stack_name):
+    if getattr(event, 'resource_name', '') != stack_name:
+        return False
+    phys_id = getattr(event, 'physical_resource_id', '')
+    links = dict((link.get('rel'), link.get('href'))
+                 for link in getattr(event, 'links', []))
+    stack_id = links.get('stack', phys_id).rsplit('/', 1)[-1]
+    return stack_id == phys_id
+
+
+def poll_for_stack_events(orchestration_client, stack_name, action=None,
+                          poll_period=5, marker=None, out=None,
+                          nested_depth=0,
+                          max_poll_period=constants.STACK_POLL_MAX_PERIOD,
+                          api_calls=None, marker_callback=None,
+                          progress=None):
+    """Poll the events of a stack until it reaches a final status
+
+    This does what heatclient's event_utils.poll_for_events does, but the
+    events are listed with get_stack_events, and again after poll_period
+    seconds only while new ones come. Every listing without new events
+    doubles the wait, up to max_poll_period, so long idle phases of an
+    update cost few requests.
+
+    :param api_calls: Counter updated with the number of 'events' and
+                      'resources' listings and 'stack' lookups made
+    :type api_calls: collections.Counter
+
+    :param marker_callback: Called with the ID of the last event seen
+                            after every listing with new events
+    :type marker_callback: callable
+
+    :param progress: Progress of the stack, updated with the new events and
+                     printed when it changed
+    :type progress: tripleoclient.stack_progress.StackProgress
+
+    :returns: tuple of the last stack status and a message about it
+    """
+    if action:
+        stop_status = ('%s_FAILED' % action, '%s_COMPLETE' % action)
+    else:
+        stop_status = None
+
+    def stop_check(status):
+        if stop_status:
+            return status in stop_status
+        return status.endswith('_COMPLETE') or status.endswith('_FAILED')
+
+    if api_calls is None:
+        api_calls = collections.Counter()
+    if out is None:
+        out = sys.stdout
+    msg_template = _("\n Stack %(name)s %(status)s \n")
+    event_log_context = heat_utils.EventLogContext()
+    backoff = exponential_backoff(
+        poll_period, max(poll_period, max_poll_period), jitter=0)
+    empty_polls = 0
+    stack_markers = {}
+
+    while True:
+        events = get_stack_events(orchestration_client, stack_name,
+                                  nested_depth=nested_depth, marker=marker,
+                                  api_calls=api_calls,
+                                  stack_markers=stack_markers)
+
+        if len(events) == 0:
+            empty_polls += 1
+        else:
+            empty_polls = 0
+            backoff = exponential_backoff(
+                poll_period, max(poll_period, max_poll_period), jitter=0)
+            marker = getattr(events[-1], 'id', None)
+            if marker_callback:
+                marker_callback(marker)
+            out.write(heat_utils.event_log_formatter(events,
+                                                     event_log_context))
+            out.write('\n')
+            if progress and progress.update(events):
+                print(progress.status_line())
+            for event in events:
+                if _is_stack_event(event, stack_name):
+                    stack_status = getattr(event, 'resource_status', '')
+                    if stop_check(stack_status):
+                        return stack_status, msg_template % dict(
+                            name=stack_name, status=stack_status)
+
+        if empty_polls >= constants.STACK_POLL_STATUS_CHECK_POLLS:
+            # The final event of the stack may have been missed, look at
+            # the stack itself
+            stack = orchestration_client.stacks.get(stack_name,
+                                                    resolve_outputs=False)
+            api_calls['stack'] += 1
+            stack_status = stack.stack_status
+            if stop_check(stack_status):
+                return stack_status, msg_template % dict(
+                    name=stack_name, status=stack_status)
+            empty_polls = 0
+
+        time.sleep(next(backoff))
+
+
 def wait_for_stack_ready(orchestration_client, stack_name, marker=None,
                          action='CREATE', verbose=False, poll_period=5,
-                         nested_depth=2, max_retries=10):
+                         nested_depth=2, max_retries=10, save_state=False,
+                         progress_factory=None):
     """Check the status of an orchestration stack
 
     Get the status of an orchestration stack and check whether it is complete
@@ -507,58 +735,203 @@ def wait_for_stack_ready(orchestration_client, stack_name, marker=None,
     :param nested_depth: Max depth to look for events
     :type nested_depth: int
 
-    :param poll_period: How often to poll for events
+    :param poll_period: How often to poll for events while new ones come,
+                        the polls back off up to STACK_POLL_MAX_PERIOD
+                        when nothing changes
     :type poll_period: int
 
     :param max_retries: Number of retries in the case of server problems
     :type max_retries: int
+
+    :param save_state: Whether to save the action and the last event seen
+                       with save_stack_state, so that the stack can be
+                       followed again from there by another client
+    :type save_state: boolean
+
+    :param progress_factory: Called with the stack, returns the
+                             StackProgress to show while waiting, which
+                             records the timings of the run once it
+                             succeeded, or None
+    :type progress_factory: callable
     """
     log = logging.getLogger(__name__ + ".wait_for_stack_ready")
     stack = get_stack(orchestration_client, stack_name)
     if not stack:
         return False
     stack_name = "%s/%s" % (stack.stack_name, stack.id)
+    progress = progress_factory(stack) if progress_factory else None
+    # The retries go on from the last event seen
+    last_marker = [marker]
+
+    def marker_seen(marker):
+        last_marker[0] = marker
+        if save_state:
+            save_stack_state(stack.stack_name, action, marker)
+
+    if save_state:
+        save_stack_state(stack.stack_name, action, marker)
 
     if verbose:
         out = sys.stdout
     else:
         out = open(os.devnull, "w")
+    api_calls = collections.Counter()
     retries = 0
-    while retries <= max_retries:
-        try:
-            stack_status, msg = event_utils.poll_for_events(
-                orchestration_client, stack_name, action=action,
-                poll_period=5, marker=marker, out=out,
-                nested_depth=nested_depth)
-            print(msg)
-            return stack_status == '%s_COMPLETE' % action
-        except hc_exc.HTTPException as e:
-            if e.code in [503, 504]:
-                retries += 1
-                log.warning("Server issue while waiting for stack to be ready."
-                            " Attempting retry {} of {}".format(retries,
-                                                                max_retries))
-                time.sleep(retries * 5)
-                continue
-            log.error("Error occured while waiting for stack to be ready.")
-            raise e
-        finally:
-            if not verbose:
-                out.close()
+    try:
+        while retries <= max_retries:
+            try:
+                stack_status, msg = poll_for_stack_events(
+                    orchestration_client, stack_name, action=action,
+                    poll_period=poll_period, marker=last_marker[0], out=out,
+                    nested_depth=nested_depth, api_calls=api_calls,
+                    marker_callback=marker_seen, progress=progress)
+                if save_state:
+                    save_stack_state(stack.stack_name, action,
+                                     last_marker[0], stack_status)
+                if progress:
+                    progress.finish(stack_status)
+                print(msg)
+                return stack_status == '%s_COMPLETE' % action
+            except hc_exc.HTTPException as e:
+                if e.code in [503, 504]:
+                    retries += 1
+                    log.warning("Server issue while waiting for stack to be "
+                                "ready. Attempting retry {} of {}".format(
+                                    retries, max_retries))
+                    time.sleep(retries * 5)
+                    continue
+                log.error("Error occured while waiting for stack to be "
+                          "ready.")
+                raise e
+    finally:
+        log.info("Waited for stack {} with {} Heat API calls: {} event "
+                 "listings, {} resource listings and {} stack "
+                 "lookups".format(stack_name, sum(api_calls.values()),
+                                  api_calls['events'],
+                                  api_calls['resources'],
+                                  api_calls['stack']))
+        if not verbose:
+            out.close()
 
     raise RuntimeError(
         "wait_for_stack_ready: Max retries {} reached".format(max_retries))
 
 
+def _stack_state_path(stack_name, state_dir=None):
+    if state_dir is None:
+        state_dir = constants.STACK_STATE_DIRECTORY
+    return os.path.join(state_dir, '%s.json' % stack_name)
+
+
+def save_stack_state(stack_name, action, marker, status=None,
+                     state_dir=None):
+    """Save the progress of the monitoring of a stack
+
+    :param stack_name: Name of the stack
+    :param action: Stack action being monitored, e.g. UPDATE
+    :param marker: ID of the last event seen, None if there was none
+    :param status: Final status of the stack, once it was reached
+    :param state_dir: Directory of the state files, defaults to
+                      STACK_STATE_DIRECTORY
+    """
+    path = _stack_state_path(stack_name, state_dir)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    state = {'stack': stack_name, 'action': action, 'marker': marker,
+             'status': status, 'updated_at': time.time()}
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+
+
+def load_stack_state(stack_name, state_dir=None):
+    """Return the progress saved by save_stack_state, or None"""
+    try:
+        with open(_stack_state_path(stack_name, state_dir)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+class StackOutputs(object):
+    """The outputs of a stack, indexed by their key
+
+    The stack is converted with to_dict() once, when it is first needed.
+    When the stack was fetched without resolving its outputs, each output
+    is fetched on its own with the output show API the first time it is
+    looked up, so that only the outputs used are transferred.
+
+    Use get_stack_outputs to share the index of a stack object.
+    """
+
+    def __init__(self, stack):
+        self._stack = stack
+        # The outputs indexed are those of this state of the stack
+        self.stack_state = _stack_state(stack)
+        self._index = None
+        self._resolved = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._index is None:
+            outputs = self._stack.to_dict().get('outputs')
+            self._resolved = outputs is not None
+            self._index = dict((output['output_key'],
+                                output.get('output_value'))
+                               for output in outputs or [])
+
+    def _fetch(self, key):
+        try:
+            output = self._stack.output_show(key)['output']
+        except HTTPNotFound:
+            return None
+        if output.get('output_error'):
+            LOG.warning("Error in output %s of stack %s: %s", key,
+                        self._stack.stack_name, output['output_error'])
+        return output.get('output_value')
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._load()
+            if key not in self._index and not self._resolved:
+                self._index[key] = self._fetch(key)
+            value = self._index.get(key)
+        return default if value is None else value
+
+    def to_dict(self):
+        """Return all the outputs, fetching the missing ones"""
+        with self._lock:
+            self._load()
+            keys = list(self._index)
+        if not self._resolved:
+            keys = [output['output_key'] for output in
+                    self._stack.output_list()['outputs']]
+        return dict((key, self.get(key)) for key in keys)
+
+
+def _stack_state(stack):
+    return (getattr(stack, 'updated_time', None),
+            getattr(stack, 'stack_status', None))
+
+
+def get_stack_outputs(stack):
+    """Return the StackOutputs of a stack object, built once per object
+
+    They are built again once the stack object was refreshed, e.g. with
+    stack.get(), and its update time or status changed.
+    """
+    outputs = vars(stack).get('_tripleoclient_outputs')
+    if outputs is None or outputs.stack_state != _stack_state(stack):
+        outputs = StackOutputs(stack)
+        stack._tripleoclient_outputs = outputs
+    return outputs
+
+
 def get_stack_output_item(stack, item):
     if not stack:
         return None
-
-    for output in stack.to_dict().get('outputs', {}):
-        if output['output_key'] == item:
-            return output['output_value']
-    # item not found in outputs
-    return None
+    return get_stack_outputs(stack).get(item)
 
 
 def get_overcloud_endpoint(stack):
@@ -566,10 +939,7 @@ def get_overcloud_endpoint(stack):
 
 
 def get_service_ips(stack):
-    service_ips = {}
-    for output in stack.to_dict().get('outputs', {}):
-        service_ips[output['output_key']] = output['output_value']
-    return service_ips
+    return get_stack_outputs(stack).to_dict()
 
 
 def get_endpoint_map(stack):
@@ -592,17 +962,25 @@ def get_endpoint(key, stack):
     if endpoint_map:
         return endpoint_map[key]['host']
     else:
-        return get_service_ips(stack).get(key + 'Vip')
+        return get_stack_output_item(stack, key + 'Vip')
 
 
-def get_stack(orchestration_client, stack_name):
+def get_stack(orchestration_client, stack_name, resolve_outputs=True):
     """Get the ID for the current deployed overcloud stack if it exists.
 
     Caller is responsible for checking if return is None
+
+    :param resolve_outputs: Whether to fetch all the outputs of the stack
+                            with it. Otherwise get_stack_output_item
+                            fetches each output when it is looked up.
     """
 
     try:
-        stack = orchestration_client.stacks.get(stack_name)
+        if resolve_outputs:
+            stack = orchestration_client.stacks.get(stack_name)
+        else:
+            stack = orchestration_client.stacks.get(stack_name,
+                                                    resolve_outputs=False)
         return stack
     except HTTPNotFound:
         pass
@@ -675,6 +1053,291 @@ def file_checksum(filepath):
     return checksum.hexdigest()
 
 
+def _worker_swift_client(swift_client):
+    """Return a Swift client for the use of a single worker thread
+
+    A swiftclient Connection keeps the response of its last request on its
+    HTTP connection, so it can not be used by several threads at once. A new
+    Connection with the same endpoint, credentials and options is returned
+    for those. Other clients are returned as is.
+    """
+    if not isinstance(swift_client, swiftclient.Connection):
+        return swift_client
+    return swiftclient.Connection(
+        authurl=swift_client.authurl,
+        user=swift_client.user,
+        key=swift_client.key,
+        retries=swift_client.retries,
+        preauthurl=swift_client.url,
+        preauthtoken=swift_client.token,
+        starting_backoff=swift_client.starting_backoff,
+        max_backoff=swift_client.max_backoff,
+        os_options=swift_client.os_options,
+        auth_version=swift_client.auth_version,
+        cacert=swift_client.cacert,
+        insecure=swift_client.insecure,
+        cert=swift_client.cert,
+        cert_key=swift_client.cert_key,
+        ssl_compression=swift_client.ssl_compression,
+        retry_on_ratelimit=swift_client.retry_on_ratelimit,
+        timeout=swift_client.timeout,
+        session=swift_client.session)
+
+
+def run_object_transfers(swift_client, transfers,
+                         concurrency=constants.SWIFT_TRANSFER_CONCURRENCY):
+    """Run Swift object transfers with a bounded pool of threads
+
+    Every worker thread transfers its objects with its own copy of
+    ``swift_client``, which keeps its HTTP connection alive between the
+    objects. Failed requests are retried by the Swift client itself.
+
+    :param swift_client: Swift client
+    :param transfers: List of ``(object_name, callable)`` tuples, where the
+                      callable transfers a single object and takes the Swift
+                      client of the worker as its only argument.
+    :param concurrency: Maximum number of transfers running at once.
+    :returns: List with the result of every transfer, in the order of
+              ``transfers``.
+    :raises ObjectTransferError: Once all the transfers completed, if any of
+                                 them failed. The failures are reported in
+                                 the order of ``transfers``.
+    """
+
+    local = threading.local()
+
+    def _transfer(func):
+        client = getattr(local, 'swift_client', None)
+        if client is None:
+            client = local.swift_client = _worker_swift_client(swift_client)
+        return func(client)
+
+    if not transfers:
+        return []
+
+    workers = max(1, min(concurrency, len(transfers)))
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = [executor.submit(_transfer, func)
+                   for name, func in transfers]
+
+    results = []
+    failures = []
+    for (name, func), future in zip(transfers, pending):
+        error = future.exception()
+        if error is not None:
+            failures.append("{}: {}".format(name, error))
+            results.append(None)
+        else:
+            results.append(future.result())
+
+    if failures:
+        raise exceptions.ObjectTransferError(
+            "Failed to transfer {} object(s):\n{}".format(
+                len(failures), "\n".join(failures)))
+    return results
+
+
+def link_or_copy(src, dst):
+    """Hard link a file to a new location, or copy it if that fails
+
+    Linking fails when both paths are not on the same filesystem, or when the
+    filesystem does not support hard links.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+@contextlib.contextmanager
+def replace_file(path, mode='w'):
+    """Open a new file which replaces path once it has been written
+
+    The file is written next to path and renamed over it, so that when path
+    is hard linked to another file, e.g. in a templates tree made by
+    copy_templates_tree() or a file linked from the plan cache, the link is
+    broken instead of the other file being modified. All the writes to such
+    trees must go through this function.
+    """
+    tmp_path = "%s.%s.%s.tmp" % (path, os.getpid(),
+                                 threading.current_thread().ident)
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _reflink(src, dst):
+    """Clone a file, sharing its data blocks with the source file
+
+    This only works on filesystems with reflink support, e.g. XFS or btrfs,
+    and raises IOError otherwise.
+    """
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), constants.FICLONE,
+                        src_file.fileno())
+    shutil.copystat(src, dst)
+
+
+def copy_templates_tree(src, dst, hardlink=False):
+    """Create a working copy of a templates tree
+
+    The files are cloned with reflinks when the filesystem supports it, which
+    makes the copy almost free while keeping it independent from the source.
+    When it does not and ``hardlink`` is set, the files are hard linked to
+    the source instead. Callers must then write to the copy with
+    replace_file(), as writing to a file in place would modify the source
+    too. The files are copied when neither of these work.
+
+    :param src: Source templates directory
+    :param dst: Destination directory, which must not exist
+    :param hardlink: Whether the files can be hard linked to the source
+    """
+
+    methods = [('reflink', _reflink)]
+    if hardlink:
+        methods.append(('hardlink', os.link))
+
+    def copy_file(src_file, dst_file):
+        while methods:
+            name, method = methods[0]
+            try:
+                return method(src_file, dst_file)
+            except (IOError, OSError) as e:
+                LOG.debug("Unable to %s %s, falling back: %s",
+                          name, src_file, e)
+                if os.path.lexists(dst_file):
+                    os.unlink(dst_file)
+                # Do not try the same method again for the other files
+                methods.pop(0)
+        return shutil.copy2(src_file, dst_file)
+
+    if six.PY2:
+        # The copy function can not be replaced on python 2
+        shutil.copytree(src, dst, symlinks=True)
+    else:
+        shutil.copytree(src, dst, symlinks=True, copy_function=copy_file)
+
+
+def cache_plan_objects(swift_client, container, objects, names=None,
+                       cache_dir=None):
+    """Fetch plan objects through the local plan cache
+
+    The cache keeps a copy of every object previously downloaded from the
+    plan, indexed by the object name and its ETag. Only the objects whose
+    ETag differs from the one in the cache, or which are missing from it,
+    are downloaded again. Cached objects which are no longer in the plan
+    are removed from the cache.
+
+    :param swift_client: Swift client
+    :param container: Name of the plan container
+    :param objects: Full listing of the plan container. Objects without a
+                    ``hash`` (ETag) can not be validated and are not
+                    returned.
+    :param names: Names of the objects to fetch, defaults to all the objects
+                  of the listing.
+    :param cache_dir: Cache directory of the plan, defaults to a directory
+                      named after the plan in the user cache directory.
+    :returns: Dictionary mapping each fetched object name to the path of its
+              cached copy.
+    """
+
+    etags = dict((obj['name'], obj.get('hash')) for obj in objects
+                 if obj.get('hash'))
+    if names is None:
+        names = list(etags)
+    names = [name for name in names if name in etags]
+    if not names:
+        return {}
+
+    if cache_dir is None:
+        cache_dir = os.path.join(constants.PLAN_CACHE_DIRECTORY, container)
+    objects_dir = os.path.join(cache_dir, 'objects')
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.isdir(objects_dir):
+        os.makedirs(objects_dir)
+
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = {}
+
+    def fetch(name, path, client):
+        contents = client.get_object(container, name)[1]
+        if isinstance(contents, six.text_type):
+            contents = contents.encode('utf-8')
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(contents)
+        os.rename(tmp_path, path)
+
+    def cache_entry(path, etag):
+        # The size and mtime make sure the cached copy was not modified
+        # since it was downloaded.
+        st = os.stat(path)
+        return {'etag': etag, 'size': st.st_size, 'mtime': st.st_mtime}
+
+    paths = {}
+    transfers = []
+    for name in names:
+        etag = etags[name]
+        path = os.path.normpath(os.path.join(objects_dir, name))
+        if not path.startswith(objects_dir + os.sep):
+            LOG.warning("Not caching plan object with invalid name %s", name)
+            continue
+        paths[name] = path
+        try:
+            if index.get(name) == cache_entry(path, etag):
+                continue
+        except OSError:
+            pass
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        transfers.append((name, functools.partial(fetch, name, path)))
+
+    LOG.debug("Fetching %d of %d plan objects of %s into the cache",
+              len(transfers), len(paths), container)
+    run_object_transfers(swift_client, transfers)
+
+    # Forget about the objects which are no longer in the plan
+    for name in set(index) - set(etags):
+        del index[name]
+        try:
+            os.unlink(os.path.join(objects_dir, name))
+        except OSError:
+            pass
+    # The ETag of the listing is stored, as this is what the cached copies
+    # are compared with. The ETag header of the object may differ from it,
+    # e.g. for large objects.
+    for name, fetch_object in transfers:
+        index[name] = cache_entry(paths[name], etags[name])
+
+    tmp_index_path = "%s.%s.tmp" % (index_path, os.getpid())
+    with open(tmp_index_path, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp_index_path, index_path)
+
+    return paths
+
+
+def exponential_backoff(initial=1.0, maximum=30.0, factor=2.0, jitter=0.5):
+    """Yield polling intervals growing exponentially, with random jitter
+
+    Each interval is the previous one multiplied by factor, up to maximum,
+    and is then shortened by a random amount of up to jitter times its
+    value, so that clients polling together spread their requests.
+    """
+    interval = initial
+    while True:
+        yield interval - random.uniform(0, jitter * interval)
+        interval = min(interval * factor, maximum)
+
+
 def ensure_run_as_normal_user():
     """Check if the command runs under normal user (EUID!=0)"""
     if os.geteuid() == 0:
@@ -984,6 +1647,54 @@ def prompt_user_for_confirmation(message, logger, positive_response='y'):
     return False
 
 
+# Prefer the LibYAML backed loader, it is several times faster than the
+# pure python one when parsing large environment files.
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_yaml_file(path):
+    """Parse a YAML file, with the LibYAML loader when it is available"""
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=_YAML_LOADER)
+
+
+def load_yaml_string(contents):
+    """Parse a YAML string, with the LibYAML loader when it is available"""
+    return yaml.load(contents, Loader=_YAML_LOADER)
+
+
+_PLAIN_LINK_RE = re.compile(r'^[\w./][\w./-]*$')
+
+
+def _find_template_links(node, link_replacement, found):
+    """Collect the get_file and type scalar nodes to replace under node"""
+    if isinstance(node, yaml.MappingNode):
+        for key, value in node.value:
+            if (isinstance(key, yaml.ScalarNode) and
+                    key.value in ('get_file', 'type') and
+                    isinstance(value, yaml.ScalarNode) and
+                    value.tag == 'tag:yaml.org,2002:str' and
+                    value.value in link_replacement):
+                found.append(value)
+            else:
+                _find_template_links(value, link_replacement, found)
+    elif isinstance(node, yaml.SequenceNode):
+        for value in node.value:
+            _find_template_links(value, link_replacement, found)
+
+
+def _is_heat_template(node):
+    if not isinstance(node, yaml.MappingNode):
+        return False
+    for key, value in node.value:
+        if (isinstance(key, yaml.ScalarNode) and
+                key.value == 'heat_template_version'):
+            return (isinstance(value, yaml.ScalarNode) and
+                    value.tag != 'tag:yaml.org,2002:null' and
+                    bool(value.value))
+    return False
+
+
 def replace_links_in_template_contents(contents, link_replacement):
     """Replace get_file and type file links in Heat template contents
 
@@ -992,23 +1703,73 @@ def replace_links_in_template_contents(contents, link_replacement):
     file paths according to link_replacement dict. (Key/value in
     link_replacement are from/to, respectively.)
 
+    The links are replaced in place, so the rest of the document keeps its
+    formatting, and contents which don't mention any of the links to
+    replace are not parsed at all.
+
     If the string contents don't look like a Heat template, return the
-    contents unmodified.
+    contents unmodified. Bytes contents are returned as bytes, and contents
+    which are not UTF-8 text are returned unmodified.
     """
 
-    template = {}
+    if isinstance(contents, six.binary_type):
+        try:
+            text = contents.decode('utf-8')
+        except UnicodeDecodeError:
+            return contents
+        result = replace_links_in_template_contents(text, link_replacement)
+        return contents if result is text else result.encode('utf-8')
+
+    if not any(link in contents for link in link_replacement):
+        return contents
+
     try:
-        template = yaml.safe_load(contents)
+        root = yaml.compose(contents, Loader=_YAML_LOADER)
     except yaml.YAMLError:
         return contents
 
-    if not (isinstance(template, dict) and
-            template.get('heat_template_version')):
+    if not _is_heat_template(root):
         return contents
 
-    template = replace_links_in_template(template, link_replacement)
+    links = []
+    _find_template_links(root, link_replacement, links)
+    if (len(set(id(node) for node in links)) != len(links) or
+            not all(_can_replace_link(node, contents) for node in links)):
+        # The same node is linked from several places through YAML aliases,
+        # or a link can't be replaced on its own, so expand and dump the
+        # whole document instead.
+        template = replace_links_in_template(load_yaml_string(contents),
+                                             link_replacement)
+        return yaml.safe_dump(template)
+
+    # Replace from the end so that the earlier positions stay valid
+    for node in sorted(links, key=lambda n: n.start_mark.index,
+                       reverse=True):
+        link = _quote_link(link_replacement[node.value], node.style)
+        contents = (contents[:node.start_mark.index] + link +
+                    contents[node.end_mark.index:])
+    return contents
+
+
+def _can_replace_link(node, contents):
+    """Whether the text of a link scalar node can be replaced on its own
+
+    Block scalars span several lines, and the span of a node with an anchor
+    or a tag starts with them, so these are not replaced in place.
+    """
+    if node.style in ('|', '>'):
+        return False
+    return contents[node.start_mark.index:][:1] not in ('&', '!')
+
 
-    return yaml.safe_dump(template)
+def _quote_link(link, style):
+    """Format a link as a YAML scalar of the given style"""
+    if style == "'":
+        return "'%s'" % link.replace("'", "''")
+    # Plain scalars stay plain when the new link allows it
+    if style or not _PLAIN_LINK_RE.match(link):
+        return json.dumps(link)
+    return link
 
 
 def replace_links_in_template(template_part, link_replacement):
@@ -1105,15 +1866,215 @@ def cleanup_tripleo_ansible_inventory_file(path):
         processutils.execute('/usr/bin/rm', '-f', path)
 
 
-def process_multiple_environments(created_env_files, tht_root,
-                                  user_tht_root, cleanup=True):
+_THT_ROOT_PLACEHOLDER = '@THT_ROOT@'
+
+
+def _rebase_paths(data, old, new):
+    """Replace the old directory by new in the paths and URLs in data"""
+    if isinstance(data, dict):
+        return dict((_rebase_paths(k, old, new), _rebase_paths(v, old, new))
+                    for k, v in six.iteritems(data))
+    if isinstance(data, list):
+        return [_rebase_paths(v, old, new) for v in data]
+    if isinstance(data, six.string_types):
+        if data == old or data.startswith(old + '/'):
+            return new + data[len(old):]
+        # URLs, also found inside templates whose links heatclient resolved
+        return data.replace('file://%s/' % old, 'file://%s/' % new)
+    return data
+
+
+def _has_only_string_keys(data):
+    """Whether all the mappings in data have string keys only"""
+    if isinstance(data, dict):
+        return all(isinstance(k, six.string_types) and
+                   _has_only_string_keys(v) for k, v in six.iteritems(data))
+    if isinstance(data, list):
+        return all(_has_only_string_keys(v) for v in data)
+    return True
+
+
+def _dependency_fingerprint(path, previous=None):
+    """Fingerprint a file an environment depends on
+
+    The checksum is only computed again when the mtime or the size changed,
+    e.g. for templates rendered again in a new tree.
+    """
+    st = os.stat(path)
+    if previous and list(previous[:2]) == [st.st_mtime, st.st_size]:
+        return previous
+    return [st.st_mtime, st.st_size, file_checksum(path)]
+
+
+def _environment_cache_path(cache_dir, env_path, tht_root):
+    key = _rebase_paths(os.path.abspath(env_path), tht_root,
+                        _THT_ROOT_PLACEHOLDER)
+    return os.path.join(
+        cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def _load_cached_environment(cache_dir, env_path, tht_root):
+    """Return the cached (files, env) of an environment file
+
+    None is returned when the environment is not cached or when any of the
+    files it depends on changed since it was cached.
+    """
+    try:
+        with open(_environment_cache_path(cache_dir, env_path,
+                                          tht_root)) as f:
+            entry = _rebase_paths(json.load(f), _THT_ROOT_PLACEHOLDER,
+                                  tht_root)
+        for path, fingerprint in six.iteritems(entry['dependencies']):
+            current = _dependency_fingerprint(path, fingerprint)
+            if current[1:] != fingerprint[1:]:
+                return None
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+    files = {}
+    for url, (is_bytes, contents) in six.iteritems(entry['files']):
+        files[url] = contents.encode('utf-8') if is_bytes else contents
+    return files, entry['env']
+
+
+def _store_cached_environment(cache_dir, env_path, tht_root, files, env):
+    """Cache the (files, env) of an environment file with its dependencies"""
+    if not _has_only_string_keys(env):
+        # JSON would turn the other keys into strings, so the environment
+        # loaded from the cache would differ from the processed one.
+        LOG.debug("Not caching environment %s: non-string keys", env_path)
+        return
+    dependencies = [os.path.abspath(env_path)]
+    for url in files:
+        if url.startswith('file://'):
+            dependencies.append(request.url2pathname(url[len('file://'):]))
+    try:
+        entry = {
+            'dependencies': dict((path, _dependency_fingerprint(path))
+                                 for path in dependencies),
+            'files': dict((url, [isinstance(contents, six.binary_type),
+                                 contents.decode('utf-8')
+                                 if isinstance(contents, six.binary_type)
+                                 else contents])
+                          for url, contents in six.iteritems(files)),
+            'env': env,
+        }
+        data = json.dumps(_rebase_paths(entry, tht_root,
+                                        _THT_ROOT_PLACEHOLDER))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        path = _environment_cache_path(cache_dir, env_path, tht_root)
+        tmp_path = "%s.%s.%s.tmp" % (path, os.getpid(),
+                                     threading.current_thread().ident)
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, ValueError, TypeError) as e:
+        LOG.debug("Not caching environment %s: %s", env_path, e)
+
+
+class EnvironmentMerger(object):
+    """Merge Heat environments, recording where each value came from
+
+    Environments are merged with the semantics of heatclient's
+    template_utils.deep_update(). A merge only walks and copies the keys
+    set by the new environment: the sub-trees it adds are copied as they
+    are written, and the ones it does not touch are left as they are. The
+    cost of a merge therefore depends on the size of the new environment,
+    not on the size of the merged tree.
+
+    The merged environment shares nothing with the sources, so callers can
+    modify it in place through env without changing them.
+    """
+
+    def __init__(self):
+        self._env = {}
+        # key -> [source, {child key -> [source, {...}]}]
+        self._provenance = {}
+
+    @property
+    def env(self):
+        """The merged environment, which shares nothing with the sources"""
+        return self._env
+
+    def merge(self, new, source=None):
+        """Merge new, read from source, into the merged environment"""
+        if new:
+            self._merge(self._env, new, source, self._provenance)
+
+    def source_of(self, *path):
+        """Return the source which set the value at the given key path"""
+        source = None
+        value = self._env
+        provenance = self._provenance
+        for key in path:
+            if not isinstance(value, collectionsAbc.Mapping) or \
+                    key not in value:
+                return None
+            value = value[key]
+            # Keys below a sub-tree set at once come from its source
+            if key in provenance:
+                source, provenance = provenance[key]
+            else:
+                provenance = {}
+        return source
+
+    def _copy(self, value):
+        if isinstance(value, collectionsAbc.Mapping):
+            return dict((k, self._copy(v)) for k, v in six.iteritems(value))
+        if isinstance(value, list):
+            return [self._copy(v) for v in value]
+        return value
+
+    def _merge(self, old, new, source, provenance):
+        for k, v in six.iteritems(new):
+            current = old.get(k)
+            if isinstance(v, collectionsAbc.Mapping):
+                if isinstance(current, collectionsAbc.Mapping):
+                    node = provenance.setdefault(k, [source, {}])
+                    self._merge(current, v, source, node[1])
+                    continue
+                if not v and current is not None:
+                    # deep_update() keeps the current value in this case
+                    continue
+            elif v is None and isinstance(current, collectionsAbc.Mapping):
+                # Don't override empty data, to work around yaml syntax issue
+                continue
+            old[k] = self._copy(v)
+            provenance[k] = [source, {}]
+
+
+def process_multiple_environments(
+        created_env_files, tht_root, user_tht_root, cleanup=True,
+        cache_dir=None,
+        concurrency=constants.ENVIRONMENT_PROCESSING_CONCURRENCY,
+        merger=None):
+    """Process environment files and the files they reference
+
+    :param cache_dir: When set, the result of processing each environment
+                      file is cached in this directory, along with the
+                      fingerprints of the files it depends on. Environments
+                      whose dependencies did not change are not processed
+                      again. Paths under tht_root are stored relative to it,
+                      so entries are reused when tht_root is a new copy of
+                      the same templates.
+    :param concurrency: Number of environment files resolved in parallel.
+                        The results are merged in the order of
+                        created_env_files, as when they are processed one
+                        at a time.
+    :param merger: EnvironmentMerger the environments are merged into,
+                   after the environments it already holds. A new one is
+                   used by default.
+    """
     log = logging.getLogger(__name__ + ".process_multiple_environments")
     env_files = {}
-    localenv = {}
+    if merger is None:
+        merger = EnvironmentMerger()
     # Normalize paths for full match checks
     user_tht_root = os.path.normpath(user_tht_root)
     tht_root = os.path.normpath(tht_root)
-    for env_path in created_env_files:
+
+    def process(env_path):
         log.debug("Processing environment files %s" % env_path)
         abs_env_path = os.path.abspath(env_path)
         if (abs_env_path.startswith(user_tht_root) and
@@ -1126,9 +2087,19 @@ def process_multiple_environments(created_env_files, tht_root,
             log.debug("Redirecting env file %s to %s"
                       % (abs_env_path, new_env_path))
             env_path = new_env_path
+        cached = None
+        if cache_dir:
+            cached = _load_cached_environment(cache_dir, env_path, tht_root)
         try:
-            files, env = template_utils.process_environment_and_files(
-                env_path=env_path)
+            if cached:
+                log.debug("Using cached environment file %s" % env_path)
+                files, env = cached
+            else:
+                files, env = template_utils.process_environment_and_files(
+                    env_path=env_path)
+                if cache_dir:
+                    _store_cached_environment(cache_dir, env_path, tht_root,
+                                              files, env)
         except hc_exc.CommandError as ex:
             # This provides fallback logic so that we can reference files
             # inside the resource_registry values that may be rendered via
@@ -1177,14 +2148,27 @@ def process_multiple_environments(created_env_files, tht_root,
                 f.flush()
                 files, env = template_utils.process_environment_and_files(
                     env_path=f.name)
+        return env_path, files, env
+
+    # Resolving an environment walks and parses all the files it references,
+    # so do that concurrently, then merge the results in the original order.
+    if concurrency > 1 and len(created_env_files) > 1:
+        with futures.ThreadPoolExecutor(
+                max_workers=min(concurrency,
+                                len(created_env_files))) as executor:
+            results = list(executor.map(process, created_env_files))
+    else:
+        results = [process(env_path) for env_path in created_env_files]
+
+    for env_path, files, env in results:
         if files:
             log.debug("Adding files %s for %s" % (files, env_path))
             env_files.update(files)
 
         # 'env' can be a deeply nested dictionary, so a simple update is
         # not enough
-        localenv = template_utils.deep_update(localenv, env)
-    return env_files, localenv
+        merger.merge(env, env_path)
+    return env_files, merger.env
 
 
 def run_update_ansible_action(log, clients, nodes, inventory,
@@ -1970,8 +2954,7 @@ def check_file_for_enabled_service(env_file):
     :raises CommandError: If the action is not confirmed
     """
     if os.path.exists(env_file):
-        with open(env_file, "r") as f:
-            content = yaml.load(f)
+        content = load_yaml_file(env_file)
         deprecated_services_enabled = []
         for service in constants.DEPRECATED_SERVICES.keys():
             try:
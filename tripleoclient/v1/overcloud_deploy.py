@@ -15,8 +15,10 @@
 from __future__ import print_function
 
 import argparse
+import functools
 import json
 import logging
+import operator
 import os
 import os.path
 from prettytable import PrettyTable
@@ -47,6 +49,7 @@ from tripleoclient import constants
 from tripleoclient import exceptions
 from tripleoclient import utils
 from tripleoclient.workflows import baremetal
+from tripleoclient.workflows import base as workflow_base
 from tripleoclient.workflows import deployment
 from tripleoclient.workflows import parameters as workflow_params
 from tripleoclient.workflows import plan_management
@@ -169,7 +172,9 @@ class DeployOvercloud(command.Command):
         self.log.debug("user_env_path=%s" % user_env_path)
         if not os.path.exists(user_env_dir):
             os.makedirs(user_env_dir)
-        with open(user_env_path, 'w') as f:
+        # The templates tree may be hard linked to the user's templates or to
+        # the plan cache, so replace the file instead of writing through it.
+        with utils.replace_file(user_env_path) as f:
             self.log.debug("Writing user environment %s" % user_env_path)
             f.write(contents)
 
@@ -332,30 +337,51 @@ class DeployOvercloud(command.Command):
                 os.path.normpath(path[1:]))
 
         # make sure links within files point to new locations, and upload them
+        transfers = []
         for orig_path, reloc_path in file_relocation.items():
             link_replacement = utils.relative_link_replacement(
                 file_relocation, os.path.dirname(reloc_path))
             contents = utils.replace_links_in_template_contents(
                 files_dict[orig_path], link_replacement)
-            self.object_client.put_object(container_name, reloc_path, contents)
+            transfers.append((reloc_path, operator.methodcaller(
+                'put_object', container_name, reloc_path, contents)))
+        utils.run_object_transfers(self.object_client, transfers)
 
         return file_relocation
 
     def _download_missing_files_from_plan(self, tht_dir, plan_name):
         # get and download missing files into tmp directory
-        plan_list = self.object_client.get_container(plan_name)
-        plan_filenames = [f['name'] for f in plan_list[1]]
-        for pf in plan_filenames:
+        plan_list = self.object_client.get_container(plan_name,
+                                                     full_listing=True)
+        missing = [f for f in plan_list[1]
+                   if not os.path.isfile(os.path.join(tht_dir, f['name']))]
+
+        # Objects whose ETag did not change since a previous deploy are
+        # linked from the local plan cache instead of being downloaded.
+        cached = utils.cache_plan_objects(self.object_client, plan_name,
+                                          plan_list[1],
+                                          [f['name'] for f in missing])
+
+        def download(pf, file_path, object_client):
+            contents = object_client.get_object(plan_name, pf)[1]
+            # open in binary as the swiftclient get/put error under
+            # python3 if opened as Text I/O
+            with utils.replace_file(file_path, 'wb') as f:
+                f.write(contents)
+
+        transfers = []
+        for pf in [f['name'] for f in missing]:
             file_path = os.path.join(tht_dir, pf)
-            if not os.path.isfile(file_path):
-                self.log.debug("Missing in templates directory, downloading \
-                               %s from swift into %s" % (pf, file_path))
-                if not os.path.exists(os.path.dirname(file_path)):
-                    os.makedirs(os.path.dirname(file_path))
-                # open in binary as the swiftclient get/put error under
-                # python3 if opened as Text I/O
-                with open(file_path, 'wb') as f:
-                    f.write(self.object_client.get_object(plan_name, pf)[1])
+            self.log.debug("Missing in templates directory, downloading \
+                           %s from swift into %s" % (pf, file_path))
+            if not os.path.exists(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            if pf in cached:
+                utils.link_or_copy(cached[pf], file_path)
+            else:
+                transfers.append(
+                    (pf, functools.partial(download, pf, file_path)))
+        utils.run_object_transfers(self.object_client, transfers)
 
     def _deploy_tripleo_heat_templates_tmpdir(self, stack, parsed_args):
         # copy tht_root to temporary directory because we need to
@@ -366,7 +392,9 @@ class DeployOvercloud(command.Command):
         self.log.debug("Creating temporary templates tree in %s"
                        % new_tht_root)
         try:
-            shutil.copytree(tht_root, new_tht_root, symlinks=True)
+            # Files are only written to the copy with utils.replace_file(),
+            # so it can be hard linked to the templates.
+            utils.copy_templates_tree(tht_root, new_tht_root, hardlink=True)
             self._deploy_tripleo_heat_templates(stack, parsed_args,
                                                 new_tht_root, tht_root)
         finally:
@@ -394,14 +422,17 @@ class DeployOvercloud(command.Command):
                 parsed_args.plan_environment_file,
                 parsed_args.networks_file,
                 type(self)._keep_env_on_update,
-                validate_stack=False)
+                validate_stack=False,
+                delta_sync=parsed_args.plan_delta_sync,
+                stream_upload=parsed_args.plan_stream_upload)
         else:
             plan_management.create_plan_from_templates(
                 self.clients, parsed_args.stack, tht_root,
                 parsed_args.roles_file, generate_passwords,
                 parsed_args.plan_environment_file,
                 parsed_args.networks_file,
-                validate_stack=False)
+                validate_stack=False,
+                stream_upload=parsed_args.plan_stream_upload)
 
         # Get any missing (e.g j2 rendered) files from the plan to tht_root
         self._download_missing_files_from_plan(
@@ -411,7 +442,7 @@ class DeployOvercloud(command.Command):
             os.path.abspath(tht_root)))
 
         self.log.debug("Creating Environment files")
-        env = {}
+        merger = utils.EnvironmentMerger()
         created_env_files = []
 
         created_env_files.extend(
@@ -426,12 +457,13 @@ class DeployOvercloud(command.Command):
                 # If user environment already exist then keep it
                 user_env = yaml.safe_load(self.object_client.get_object(
                     parsed_args.stack, constants.USER_ENVIRONMENT)[1])
-                template_utils.deep_update(env, user_env)
+                merger.merge(user_env, constants.USER_ENVIRONMENT)
             except ClientException:
                 pass
         parameters.update(self._update_parameters(parsed_args, stack))
-        template_utils.deep_update(env, self._create_parameters_env(
-            parameters, tht_root, parsed_args.stack))
+        merger.merge(self._create_parameters_env(
+            parameters, tht_root, parsed_args.stack),
+            'tripleoclient-parameters.yaml')
 
         if parsed_args.environment_files:
             created_env_files.extend(parsed_args.environment_files)
@@ -442,17 +474,25 @@ class DeployOvercloud(command.Command):
                 parsed_args.deployment_python_interpreter
 
         self.log.debug("Processing environment files %s" % created_env_files)
-        env_files, localenv = utils.process_multiple_environments(
+        env_files, _ = utils.process_multiple_environments(
             created_env_files, tht_root, user_tht_root,
-            cleanup=(not parsed_args.no_cleanup))
-        template_utils.deep_update(env, localenv)
+            cleanup=(not parsed_args.no_cleanup),
+            cache_dir=(constants.ENVIRONMENT_CACHE_DIRECTORY
+                       if parsed_args.environment_cache else None),
+            merger=merger)
+        env = merger.env
 
         if stack:
             # note(aschultz): network validation goes here before we deploy
             utils.check_stack_network_matches_env_files(stack, env)
             bp_cleanup = self._create_breakpoint_cleanup_env(
                 tht_root, parsed_args.stack)
-            template_utils.deep_update(env, bp_cleanup)
+            merger.merge(bp_cleanup, 'tripleoclient-breakpoint-cleanup.yaml')
+            env = merger.env
+
+        for name in sorted(env.get('parameter_defaults') or {}):
+            self.log.debug("Parameter %s set by %s" % (
+                name, merger.source_of('parameter_defaults', name)))
 
         # FIXME(shardy) It'd be better to validate this via mistral
         # e.g part of the plan create/update workflow
@@ -733,6 +773,48 @@ class DeployOvercloud(command.Command):
             '--no-cleanup', action='store_true',
             help=_('Don\'t cleanup temporary files, just log their location')
         )
+        parser.add_argument(
+            '--plan-delta-sync',
+            action='store_true',
+            default=False,
+            help=_('When updating an existing plan, only upload the template '
+                   'files which changed and delete the ones which were '
+                   'removed, instead of emptying the plan and uploading all '
+                   'the templates again.')
+        )
+        parser.add_argument(
+            '--plan-stream-upload',
+            action='store_true',
+            default=False,
+            help=_('Stream the templates tarball to the plan while it is '
+                   'created, instead of writing it to a temporary file '
+                   'first.')
+        )
+        parser.add_argument(
+            '--environment-cache',
+            action='store_true',
+            default=False,
+            help=_('Cache the result of processing each environment file in '
+                   'the user cache directory, and reuse it on later runs '
+                   'when none of the files it references changed.')
+        )
+        parser.add_argument(
+            '--follow',
+            metavar='<execution-id>',
+            help=_('Do not deploy, follow the messages of a running '
+                   'deployment workflow execution instead, such as the '
+                   'config-download one of a deploy run from another shell, '
+                   'until it finishes.')
+        )
+        parser.add_argument(
+            '--attach',
+            action='store_true',
+            default=False,
+            help=_('Do not deploy, follow the create or update of the stack '
+                   'run by a previous deploy instead, from the last event '
+                   'it had shown, until it finishes. Use it after the '
+                   'client was interrupted while waiting for the stack.')
+        )
         parser.add_argument(
             '--update-plan-only',
             action='store_true',
@@ -907,6 +989,18 @@ class DeployOvercloud(command.Command):
         sc_logger = logging.getLogger("swiftclient")
         sc_logger.setLevel(logging.CRITICAL)
 
+        if parsed_args.follow:
+            deployment.follow_execution(self.clients, parsed_args.follow)
+            return
+        if parsed_args.attach:
+            deployment.follow_stack(self.log, self.clients,
+                                    parsed_args.stack,
+                                    self.app_args.verbose_level)
+            print("Stack {0} finished, run the deploy again with "
+                  "--config-download-only to configure the "
+                  "overcloud".format(parsed_args.stack))
+            return
+
         self._validate_args(parsed_args)
 
         # Throw warning if deprecated service is enabled and
@@ -989,13 +1083,18 @@ class DeployOvercloud(command.Command):
         # Force fetching of attributes
         stack.get()
 
-        overcloudrcs = deployment.create_overcloudrc(
-            self.clients, container=stack.stack_name,
-            no_proxy=parsed_args.no_proxy)
+        # These workflows are independent, wait for them at once
+        results = workflow_base.run_concurrently(
+            functools.partial(deployment.create_overcloudrc, self.clients,
+                              container=stack.stack_name,
+                              no_proxy=parsed_args.no_proxy),
+            functools.partial(deployment.create_cloudsyaml, self.clients,
+                              container=stack.stack_name),
+            functools.partial(deployment.get_horizon_url, self.clients,
+                              stack=stack.stack_name))
+        overcloudrcs, cloud_data, horizon_url = results
 
         # Create overcloud clouds.yaml
-        cloud_data = deployment.create_cloudsyaml(
-            self.clients, container=stack.stack_name)
         cloud_yaml_dir = os.path.join(constants.CLOUD_HOME_DIR,
                                       constants.CLOUDS_YAML_DIR)
         cloud_user_id = os.stat(constants.CLOUD_HOME_DIR).st_uid
@@ -1016,9 +1115,6 @@ class DeployOvercloud(command.Command):
 
         overcloud_endpoint = utils.get_overcloud_endpoint(stack)
 
-        horizon_url = deployment.get_horizon_url(
-            self.clients, stack=stack.stack_name)
-
         print("Overcloud Endpoint: {0}".format(overcloud_endpoint))
         print("Overcloud Horizon Dashboard URL: {0}".format(horizon_url))
         print("Overcloud rc file: {0}".format(rcpath))
@@ -1036,12 +1132,21 @@ class GetDeploymentStatus(command.Command):
                             help=_('Name of the stack/plan. '
                                    '(default: overcloud)'),
                             default='overcloud')
+        parser.add_argument('--follow', action='store_true', default=False,
+                            help=_('Follow the events of the stack until '
+                                   'its create or update finishes, from '
+                                   'the last event shown by the deploy, '
+                                   'before showing the status.'))
         return parser
 
     def take_action(self, parsed_args):
         self.log.debug("take_action(%s)" % parsed_args)
         plan = parsed_args.plan
 
+        if parsed_args.follow:
+            deployment.follow_stack(self.log, self.app.client_manager, plan,
+                                    self.app_args.verbose_level)
+
         status = deployment.get_deployment_status(
             self.app.client_manager,
             plan=plan
@@ -578,19 +578,12 @@ class UnprovisionNode(command.Command):
             roles = yaml.safe_load(fp)
 
         nodes = []
-        expanded = baremetal.expand_roles(
-            self.app.client_manager,
-            roles=roles,
-            stackname=parsed_args.stack,
-            provisioned=False)
-        nodes.extend(expanded.get('instances', []))
-
-        if parsed_args.all:
-            expanded = baremetal.expand_roles(
+        provisioned_states = [False, True] if parsed_args.all else [False]
+        for expanded in baremetal.expand_roles_multi(
                 self.app.client_manager,
                 roles=roles,
                 stackname=parsed_args.stack,
-                provisioned=True)
+                provisioned_states=provisioned_states):
             nodes.extend(expanded.get('instances', []))
 
         if not nodes:
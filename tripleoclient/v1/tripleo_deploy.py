@@ -291,8 +291,9 @@ class Deploy(command.Command):
                                       "or permission denied" %
                                       source_templates_dir)
         if not os.path.exists(self.tht_render):
-            shutil.copytree(source_templates_dir, self.tht_render,
-                            symlinks=True)
+            # Templates are rendered in place in the copy, so it can not be
+            # hard linked to the source templates.
+            utils.copy_templates_tree(source_templates_dir, self.tht_render)
 
     def _set_default_plan(self):
         """Populate default plan-environment.yaml and capabilities-map.yaml."""
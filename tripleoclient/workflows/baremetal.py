@@ -579,3 +579,14 @@ def expand_roles(clients, roles, stackname, provisioned):
         stackname=stackname,
         provisioned=provisioned
     )
+
+
+def expand_roles_multi(clients, roles, stackname, provisioned_states):
+    """Expand the roles once per provisioned state, concurrently"""
+    workflow_client = clients.workflow_engine
+    return base.call_actions(
+        workflow_client,
+        [('tripleo.baremetal_deploy.expand_roles',
+          dict(roles=roles, stackname=stackname, provisioned=provisioned))
+         for provisioned in provisioned_states]
+    )
@@ -11,8 +11,15 @@
 # under the License.
 import json
 import logging
+import time
 
+from concurrent import futures
+
+from tripleoclient import constants
 from tripleoclient import exceptions
+from tripleoclient import plugin
+from tripleoclient import timings
+from tripleoclient import utils
 
 LOG = logging.getLogger(__name__)
 
@@ -20,9 +27,11 @@ LOG = logging.getLogger(__name__)
 def call_action(workflow_client, action, **input_):
     """Trigger a Mistral action and parse the JSON response"""
 
+    started_at = time.time()
     result = workflow_client.action_executions.create(
         action, input_,
         save_result=True, run_sync=True)
+    timings.TIMINGS.action(action, started_at, result.state)
 
     # Parse the JSON output. Mistral client should do this for us really.
     output = json.loads(result.output)['result']
@@ -32,12 +41,47 @@ def call_action(workflow_client, action, **input_):
     return output
 
 
+def call_actions(workflow_client, actions,
+                 concurrency=constants.MISTRAL_ACTION_CONCURRENCY,
+                 return_exceptions=False):
+    """Trigger several Mistral actions at once
+
+    The actions, a list of (action, input) pairs, are run concurrently over
+    the HTTP session of the Mistral client and their parsed outputs are
+    returned in the same order.
+
+    If return_exceptions is true, the exception raised by a failed action
+    takes its place in the results. Otherwise every action still runs to
+    completion, then the exception of the first failed one is raised.
+    """
+    def call(action_input):
+        action, input_ = action_input
+        try:
+            return call_action(workflow_client, action, **input_)
+        except Exception as e:
+            return e
+
+    if not actions:
+        return []
+    with futures.ThreadPoolExecutor(
+            max_workers=max(1, min(concurrency, len(actions)))) as executor:
+        results = list(executor.map(call, actions))
+
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
+
+
 def start_workflow(workflow_client, identifier, workflow_input):
 
+    started_at = time.time()
     execution = workflow_client.executions.create(
         identifier,
         workflow_input=workflow_input
     )
+    timings.TIMINGS.workflow_started(identifier, execution.id, started_at)
 
     LOG.debug("Started Mistral Workflow {}. Execution ID: {}".format(
               identifier, execution.id))
@@ -56,51 +100,164 @@ def wait_for_messages(mistral, websocket, execution, timeout=None):
 
     If a timeout is reached, called check_execution_status which will look up
     the execution on Mistral and log information about it.
+
+    After a progress message of the execution, its state is looked up in
+    case its final message was missed. On a shared websocket subscription
+    this happens at most every WORKFLOW_STATUS_CHECK_INTERVAL seconds: a
+    deferred lookup is done when the next message arrives or, if none
+    does, once the interval is over.
+
+    If the connection of a shared websocket subscription is closed, the
+    subscription is opened again and the execution followed on it. When
+    that is not possible, the state of the execution is polled instead
+    until it finished, and its output is yielded as the last payload.
     """
+    timer = timings.TIMINGS.wait(execution)
     try:
-        for payload in websocket.wait_for_messages(timeout=timeout):
-            # Ignore messages whose root_execution_id does not match the
-            # id of the execution for which we are waiting
-
-            # New versions of tripleo-common don't sent the execution anymore
-            # but keeping the old way ot getting it is important to keep
-            # backwards compatibility.
-
-            # TODO(apetrich) payload.execution is deprecated and will be
-            # removed from stein. We should keep this until payload.execution
-            #  is removed from the LTS
-            payload_exec_id = payload.get('execution_id') or \
-                payload.get('execution', {}).get('id')
-
-            payload_root_exec_id = payload.get('root_execution_id', '') or \
-                payload.get('execution', {}).get('root_execution_id', '')
-
-            if payload_exec_id != execution.id and \
-                    payload_root_exec_id != execution.id:
-
-                LOG.debug("Ignoring message from execution %s"
-                          % payload_exec_id)
-            else:
-                yield payload
-            # If the message is from a sub-workflow, we just need to pass it
-            # on to be displayed. This should never be the last message - so
-            # continue and wait for the next.
-            if payload_exec_id != execution.id:
-                continue
-            # Check the status of the payload, if we are not given one
-            # default to running and assume it is just an "in progress"
-            # message from the workflow.
-            # Workflows should end with SUCCESS or ERROR statuses.
-            if payload.get('status', 'RUNNING') != "RUNNING":
+        while True:
+            try:
+                for payload in _receive_messages(mistral, websocket,
+                                                 execution, timeout):
+                    if timer is not None:
+                        timer.message(payload)
+                    yield payload
                 return
+            except exceptions.WebSocketConnectionClosed:
+                if not isinstance(websocket, plugin.WebsocketSubscription):
+                    raise
+                LOG.warning("The messaging websocket was closed while "
+                            "waiting for execution %s", execution.id)
+
+            if _reconnect(websocket):
+                # Messages sent without a connection are lost, check
+                # whether the execution finished meanwhile
+                execution = mistral.executions.get(execution.id)
+                if execution.state != "RUNNING":
+                    yield json.loads(execution.output)
+                    return
+                continue
+
+            LOG.warning("Could not reconnect the messaging websocket, "
+                        "polling the state of execution %s", execution.id)
+            execution = _poll_execution(mistral, execution.id, timeout)
+            yield json.loads(execution.output)
+            return
+    except (exceptions.WebSocketTimeout, exceptions.WebSocketConnectionClosed):
+        check_execution_status(mistral, execution.id)
+        raise
+    finally:
+        if timer is not None:
+            timer.done()
+
+
+def _receive_messages(mistral, websocket, execution, timeout):
+    """Yield the messages of an execution, see wait_for_messages"""
+    interval = constants.WORKFLOW_STATUS_CHECK_INTERVAL
+    status_check = {'last': None, 'due': False}
+
+    def check_due_in():
+        if not status_check['due']:
+            return None
+        return max(0, status_check['last'] + interval - time.time())
+
+    if isinstance(websocket, plugin.WebsocketSubscription):
+        # Only receive the messages of this execution from the shared
+        # websocket, the check below is then only a safety net.
+        messages = websocket.wait_for_messages(timeout=timeout,
+                                               execution_id=execution.id,
+                                               wakeup=check_due_in)
+        rate_limited = True
+    else:
+        messages = websocket.wait_for_messages(timeout=timeout)
+        rate_limited = False
+    for payload in messages:
+        if payload is None:
+            # Woken up for a deferred status check
             execution = mistral.executions.get(execution.id)
+            status_check.update(last=time.time(), due=False)
             if execution.state != "RUNNING":
-                # yield the output as the last payload which was missed
                 yield json.loads(execution.output)
                 return
-    except (exceptions.WebSocketTimeout, exceptions.WebSocketConnectionClosed):
-        check_execution_status(mistral, execution.id)
-        raise
+            continue
+        # Ignore messages whose root_execution_id does not match the
+        # id of the execution for which we are waiting
+
+        # New versions of tripleo-common don't sent the execution anymore
+        # but keeping the old way ot getting it is important to keep
+        # backwards compatibility.
+
+        # TODO(apetrich) payload.execution is deprecated and will be
+        # removed from stein. We should keep this until payload.execution
+        #  is removed from the LTS
+        payload_exec_id = payload.get('execution_id') or \
+            payload.get('execution', {}).get('id')
+
+        payload_root_exec_id = payload.get('root_execution_id', '') or \
+            payload.get('execution', {}).get('root_execution_id', '')
+
+        if payload_exec_id != execution.id and \
+                payload_root_exec_id != execution.id:
+
+            LOG.debug("Ignoring message from execution %s"
+                      % payload_exec_id)
+        else:
+            yield payload
+        # If the message is from a sub-workflow, we just need to pass it
+        # on to be displayed. This should never be the last message - so
+        # continue and wait for the next.
+        if payload_exec_id != execution.id:
+            continue
+        # Check the status of the payload, if we are not given one
+        # default to running and assume it is just an "in progress"
+        # message from the workflow.
+        # Workflows should end with SUCCESS or ERROR statuses.
+        if payload.get('status', 'RUNNING') != "RUNNING":
+            return
+        if rate_limited and status_check['last'] is not None and \
+                time.time() - status_check['last'] < interval:
+            status_check['due'] = True
+            continue
+        execution = mistral.executions.get(execution.id)
+        status_check.update(last=time.time(), due=False)
+        if execution.state != "RUNNING":
+            # yield the output as the last payload which was missed
+            yield json.loads(execution.output)
+            return
+
+
+def _reconnect(websocket):
+    """Subscribe again to the messaging websocket, retrying with a backoff
+
+    :returns: True if the subscription was opened again.
+    """
+    intervals = utils.exponential_backoff(
+        maximum=constants.WEBSOCKET_RECONNECT_MAX_INTERVAL)
+    for attempt in range(constants.WEBSOCKET_RECONNECT_ATTEMPTS):
+        time.sleep(next(intervals))
+        try:
+            websocket.reconnect()
+        except exceptions.WebSocketConnectionClosed:
+            continue
+        LOG.info("Reconnected the messaging websocket")
+        return True
+    return False
+
+
+def _poll_execution(mistral, execution_id, timeout=None):
+    """Poll the state of an execution until it is no longer RUNNING
+
+    :raises WebSocketTimeout: if it still runs after timeout seconds.
+    """
+    start = time.time()
+    intervals = utils.exponential_backoff(
+        maximum=constants.WORKFLOW_STATUS_CHECK_INTERVAL)
+    while True:
+        execution = mistral.executions.get(execution_id)
+        if execution.state != "RUNNING":
+            return execution
+        if timeout is not None and time.time() - start > timeout:
+            raise exceptions.WebSocketTimeout()
+        time.sleep(next(intervals))
 
 
 def check_execution_status(workflow_client, execution_id):
@@ -124,3 +281,18 @@ def check_execution_status(workflow_client, execution_id):
 
     LOG.error(("Timed out waiting for messages from Execution "
                "(ID: {}, State: {}). {}").format(execution_id, state, message))
+
+
+def run_concurrently(*calls):
+    """Run blocking calls, such as workflow helpers, concurrently
+
+    Each call runs in its own thread, as the workflow helpers spend most of
+    their time waiting on Mistral and the websocket. The results are
+    returned in the order of the calls. Every call runs to completion, then
+    the exception of the first failed one, in that order, is raised.
+    """
+    if not calls:
+        return []
+    with futures.ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        results = [executor.submit(call) for call in calls]
+    return [result.result() for result in results]
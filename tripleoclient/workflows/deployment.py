@@ -12,19 +12,28 @@
 from __future__ import print_function
 
 import copy
+import errno
+import functools
 import os
 import pprint
+import select
 import shutil
 import socket
 import subprocess
 import tempfile
 import time
 
+from concurrent import futures
 from heatclient.common import event_utils
+from heatclient import exc as hc_exc
 from openstackclient import shell
+from osc_lib import exceptions as oscexc
+from prettytable import PrettyTable
+import six
 
 from tripleoclient import constants
 from tripleoclient import exceptions
+from tripleoclient import stack_progress
 from tripleoclient import utils
 
 from tripleoclient.workflows import base
@@ -100,8 +109,11 @@ def deploy_and_wait(log, clients, stack, plan_name, verbose_level,
     time.sleep(10)
     verbose_events = verbose_level >= 1
     create_result = utils.wait_for_stack_ready(
-        orchestration_client, plan_name, marker, action, verbose_events)
+        orchestration_client, plan_name, marker, action, verbose_events,
+        save_state=True, progress_factory=functools.partial(
+            get_stack_progress, log, orchestration_client, action=action))
     if not create_result:
+        print_failed_resources(log, orchestration_client, plan_name, marker)
         shell.OpenStackShell().run(["stack", "failures", "list", plan_name])
         set_deployment_status(clients, 'failed', plan=plan_name)
         if stack is None:
@@ -110,6 +122,94 @@ def deploy_and_wait(log, clients, stack, plan_name, verbose_level,
             raise exceptions.DeploymentError("Heat Stack update failed.")
 
 
+def get_stack_progress(log, orchestration_client, stack, action):
+    """Return the StackProgress of the running action of a stack, or None
+
+    The expected resources are counted in the template of the stack and
+    the role counts in its parameters.
+    """
+    try:
+        template = orchestration_client.stacks.template(stack.id)
+        return stack_progress.StackProgress(stack.stack_name, action,
+                                            template, stack.parameters)
+    except Exception as e:
+        # The progress is only informative, it must not stop the deploy
+        log.warning("Unable to estimate the progress of stack %s: %s",
+                    stack.stack_name, e)
+        return None
+
+
+def print_failed_resources(log, orchestration_client, plan_name,
+                           marker=None):
+    """Print the resources of the stack and its nested stacks which failed
+
+    Only the failures reported by the events after marker are printed.
+    """
+    try:
+        events = utils.get_stack_events(
+            orchestration_client, plan_name,
+            nested_depth=constants.STACK_FAILURES_NESTED_DEPTH,
+            marker=marker)
+    except (hc_exc.HTTPException, oscexc.CommandError) as e:
+        log.warning("Unable to list the events of stack %s: %s",
+                    plan_name, e)
+        return
+    failed = [event for event in events
+              if event.resource_status.endswith('_FAILED')
+              and event.resource_name != event.stack_name]
+    if failed:
+        print("Failed resources of stack %s:" % plan_name)
+        for event in failed:
+            print("  %s/%s: %s" % (event.stack_name, event.resource_name,
+                                   event.resource_status_reason))
+
+
+def follow_stack(log, clients, plan_name, verbose_level):
+    """Wait for the running action of a stack, from where it was left
+
+    The stack is followed from the last event seen by the previous
+    deploy_and_wait or follow_stack of the stack, when it saved its
+    progress, so that only the new events are listed.
+
+    :raises DeploymentError: if there is no stack or its action failed.
+    """
+    orchestration_client = clients.orchestration
+    stack = utils.get_stack(orchestration_client, plan_name)
+    if stack is None:
+        raise exceptions.DeploymentError(
+            "Heat Stack %s not found." % plan_name)
+
+    action = stack.stack_action
+    state = utils.load_stack_state(plan_name)
+    if state and state['action'] == action:
+        marker = state['marker']
+        log.info("Following the %s of stack %s from event %s",
+                 action, plan_name, marker)
+    else:
+        # Nothing to resume from, only the events to come are shown
+        events = event_utils.get_events(orchestration_client,
+                                        stack_id=plan_name,
+                                        event_args={'sort_dir': 'desc',
+                                                    'limit': 1})
+        marker = events[0].id if events else None
+        log.info("No progress saved for the %s of stack %s, following "
+                 "its new events", action, plan_name)
+
+    if stack.stack_status.endswith('_IN_PROGRESS'):
+        result = utils.wait_for_stack_ready(
+            orchestration_client, plan_name, marker, action,
+            verbose_level >= 1, save_state=True)
+    else:
+        print("Stack %s is %s" % (plan_name, stack.stack_status))
+        result = stack.stack_status == '%s_COMPLETE' % action
+
+    if not result:
+        print_failed_resources(log, orchestration_client, plan_name, marker)
+        shell.OpenStackShell().run(["stack", "failures", "list", plan_name])
+        raise exceptions.DeploymentError(
+            "Heat Stack %s failed." % action.lower())
+
+
 def create_overcloudrc(clients, **workflow_input):
     workflow_client = clients.workflow_engine
     tripleoclients = clients.tripleoclient
@@ -180,29 +280,147 @@ def get_overcloud_hosts(stack, ssh_network):
     return ips
 
 
-def wait_for_ssh_port(host):
-    start = int(time.time())
-    while True:
-        now = int(time.time())
-        if (now - start) > constants.ENABLE_SSH_ADMIN_SSH_PORT_TIMEOUT:
-            raise exceptions.DeploymentError(
-                "Timed out waiting for port 22 from %s" % host)
-        # first check ipv4 then check ipv6
+class _PortProbe(object):
+    """Connection attempts to the ssh port of one host"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sockets = []
+        self.deadline = None
+        self.next_attempt = 0
+        self.intervals = utils.exponential_backoff(
+            maximum=constants.ENABLE_SSH_ADMIN_SSH_PORT_MAX_INTERVAL)
+
+    def connect(self, now):
+        """Start a non-blocking connect to every address of the host
+
+        :returns: True if one of the connections completed immediately.
+        """
         try:
-            sock = socket.socket()
-            sock.connect((host, 22))
-            sock.close()
-            return
+            addresses = socket.getaddrinfo(self.host, self.port, 0,
+                                           socket.SOCK_STREAM)
         except socket.error:
+            addresses = []
+        for family, socktype, proto, _, address in addresses:
             try:
-                sock = socket.socket(socket.AF_INET6)
-                sock.connect((host, 22))
-                sock.close()
-                return
+                sock = socket.socket(family, socktype, proto)
             except socket.error:
-                pass
+                continue
+            sock.setblocking(False)
+            result = sock.connect_ex(address)
+            if result == 0:
+                sock.close()
+                self.close()
+                return True
+            if result in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.sockets.append(sock)
+            else:
+                sock.close()
+        self.deadline = \
+            now + constants.ENABLE_SSH_ADMIN_SSH_PORT_CONNECT_TIMEOUT
+        if not self.sockets:
+            self.retry(now)
+        return False
+
+    def connected(self, sock, now):
+        """Handle a connection attempt that completed
+
+        :returns: True if the connection succeeded.
+        """
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error == 0:
+            self.close()
+            return True
+        self.sockets.remove(sock)
+        sock.close()
+        if not self.sockets:
+            self.retry(now)
+        return False
+
+    def retry(self, now):
+        self.close()
+        self.next_attempt = now + next(self.intervals)
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+
+
+def wait_for_ssh_ports(hosts, port=22,
+                       timeout=constants.ENABLE_SSH_ADMIN_SSH_PORT_TIMEOUT):
+    """Wait until the ssh port of every host accepts connections
+
+    The hosts are probed together with non-blocking connects to each of
+    their addresses, every host being retried with an exponential backoff,
+    so this takes about as long as the slowest host.
+
+    :raises DeploymentError: if some hosts were still unreachable after
+                             timeout seconds, naming them.
+    """
+    probes = [_PortProbe(host, port) for host in sorted(set(hosts))]
+    pending = set(probes)
+    start = time.time()
+    while pending:
+        now = time.time()
+        if (now - start) > timeout:
+            for probe in pending:
+                probe.close()
+            raise exceptions.DeploymentError(
+                "Timed out waiting for port %d from %s" % (
+                    port, ", ".join(probe.host for probe in probes
+                                    if probe in pending)))
+
+        connecting = [probe for probe in pending if probe.sockets]
+        for probe in connecting:
+            if now >= probe.deadline:
+                probe.retry(now)
+        slots = constants.ENABLE_SSH_ADMIN_SSH_PORT_CONCURRENCY - len(
+            [probe for probe in pending if probe.sockets])
+        for probe in probes:
+            if slots <= 0:
+                break
+            if (probe in pending and not probe.sockets and
+                    now >= probe.next_attempt):
+                slots -= 1
+                if probe.connect(now):
+                    pending.discard(probe)
+        if not pending:
+            break
+
+        sockets = {}
+        wakeup = start + timeout
+        for probe in pending:
+            if probe.sockets:
+                wakeup = min(wakeup, probe.deadline)
+                sockets.update((sock, probe) for sock in probe.sockets)
+            else:
+                wakeup = min(wakeup, probe.next_attempt)
+        wait = max(0, wakeup - time.time())
+        if not sockets:
+            time.sleep(wait)
+            continue
 
-        time.sleep(1)
+        # poll() rather than select(), as the descriptors of the probes can
+        # be above FD_SETSIZE once the other connections of the client are
+        # open
+        poller = select.poll()
+        fds = {}
+        for sock in sockets:
+            poller.register(sock, select.POLLOUT)
+            fds[sock.fileno()] = sock
+        events = poller.poll(wait * 1000)
+        now = time.time()
+        for fd, _ in events:
+            sock = fds[fd]
+            probe = sockets[sock]
+            if sock in probe.sockets and probe.connected(sock, now):
+                pending.discard(probe)
+
+
+def wait_for_ssh_port(host):
+    wait_for_ssh_ports([host])
 
 
 def get_hosts_and_enable_ssh_admin(log, clients, stack, overcloud_ssh_network,
@@ -228,6 +446,95 @@ def get_hosts_and_enable_ssh_admin(log, clients, stack, overcloud_ssh_network,
                                                  overcloud_ssh_network))
 
 
+def _run_on_hosts(hosts, step, title,
+                  concurrency=constants.ENABLE_SSH_ADMIN_CONCURRENCY):
+    """Run step(host) for each host in parallel and print the results
+
+    :raises CalledProcessError: the error of the first host, in the order
+                                of hosts, for which the step failed.
+    """
+    def run(host):
+        try:
+            step(host)
+        except (subprocess.CalledProcessError,
+                exceptions.DeploymentError) as e:
+            return e
+
+    with futures.ThreadPoolExecutor(
+            max_workers=max(1, min(concurrency, len(hosts)))) as executor:
+        results = list(executor.map(run, hosts))
+
+    table = PrettyTable(['Host', 'Status', 'Details'])
+    failures = []
+    for host, error in zip(hosts, results):
+        if error is None:
+            table.add_row([host, 'OK', ''])
+            continue
+        failures.append((host, error))
+        if isinstance(error, subprocess.CalledProcessError):
+            output = (error.output or b'').decode('utf-8', 'replace')
+            details = "Return code %d" % error.returncode
+            if output.strip():
+                details += ": %s" % output.strip().splitlines()[-1]
+        else:
+            details = six.text_type(error)
+        table.add_row([host, 'FAILED', details])
+    print(title)
+    print(table)
+
+    if failures:
+        print("%s failed for %d of %d hosts: %s" % (
+            title, len(failures), len(hosts),
+            ", ".join(host for host, error in failures)))
+        host, error = failures[0]
+        if isinstance(error, subprocess.CalledProcessError):
+            raise error
+        raise subprocess.CalledProcessError(255, 'ssh %s' % host,
+                                            six.text_type(error))
+
+
+def _start_ssh_masters(hosts, ssh_user, ssh_key, ssh_options,
+                       concurrency=constants.ENABLE_SSH_ADMIN_CONCURRENCY):
+    """Start an ssh master connection in the background for each host
+
+    The masters are started on their own, with no pipe for their output:
+    before OpenSSH 8.2, a master keeps the stderr it was started with, so a
+    command capturing it would only return once the master exits. The hosts
+    for which the master could not be started are connected to directly,
+    which reports the error.
+    """
+    def start(host, devnull):
+        command = ["ssh", "-o", "ControlMaster=yes", "-N", "-f"]
+        command += ssh_options.split()
+        command += ["-i", ssh_key, "-l", ssh_user, host]
+        subprocess.call(command, stdout=devnull, stderr=devnull)
+
+    with open(os.devnull, 'w') as devnull:
+        with futures.ThreadPoolExecutor(
+                max_workers=max(1, min(concurrency, len(hosts)))) as executor:
+            list(executor.map(functools.partial(start, devnull=devnull),
+                              hosts))
+
+
+def _close_ssh_masters(hosts, ssh_user, ssh_options,
+                       concurrency=constants.ENABLE_SSH_ADMIN_CONCURRENCY):
+    """Ask the ssh master connections of the hosts, if any, to exit"""
+    if "ControlPath=" not in ssh_options:
+        return
+
+    def close(host):
+        command = ["ssh"] + ssh_options.split()
+        command += ["-O", "exit", "-l", ssh_user, host]
+        try:
+            subprocess.check_output(command, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            pass
+
+    with futures.ThreadPoolExecutor(
+            max_workers=max(1, min(concurrency, len(hosts)))) as executor:
+        list(executor.map(close, hosts))
+
+
 def enable_ssh_admin(log, clients, plan_name, hosts, ssh_user, ssh_key):
     print("Enabling ssh admin (tripleo-admin) for hosts:")
     print(" ".join(hosts))
@@ -263,17 +570,29 @@ def enable_ssh_admin(log, clients, plan_name, hosts, ssh_user, ssh_key):
         with open(tmp_key_private) as privkey:
             tmp_key_private_contents = privkey.read()
 
-        for host in hosts:
-            wait_for_ssh_port(host)
+        # Each host gets a master connection before the key is inserted,
+        # which is reused to remove the key once the workflow is done.
+        ssh_options += (" -o ControlMaster=no"
+                        " -o ControlPath=%s"
+                        " -o ControlPersist=%d" % (
+                            os.path.join(tmp_key_dir, 'cm-%C'),
+                            constants.ENABLE_SSH_ADMIN_TIMEOUT + 60))
+
+        wait_for_ssh_ports(hosts)
+        _start_ssh_masters(hosts, ssh_user, ssh_key, ssh_options)
+
+        def insert_tmp_key(host):
             copy_tmp_key_command = ["ssh"] + ssh_options.split()
             copy_tmp_key_command += \
                 ["-o", "StrictHostKeyChecking=no",
                  "-i", ssh_key, "-l", ssh_user, host,
                  "echo -e '\n%s' >> $HOME/.ssh/authorized_keys" %
                  tmp_key_public_contents]
-            print("Inserting TripleO short term key for %s" % host)
-            subprocess.check_call(copy_tmp_key_command,
-                                  stderr=subprocess.STDOUT)
+            subprocess.check_output(copy_tmp_key_command,
+                                    stderr=subprocess.STDOUT)
+
+        _run_on_hosts(hosts, insert_tmp_key,
+                      "Inserting TripleO short term key")
 
         print("Starting ssh admin enablement workflow")
 
@@ -292,21 +611,28 @@ def enable_ssh_admin(log, clients, plan_name, hosts, ssh_user, ssh_key):
             workflow_input=workflow_input
         )
 
-        start = int(time.time())
+        # The workflow does not send a message when it completes, so poll
+        # its state, less and less often as it keeps running.
+        start = time.time()
+        last_status = start
+        intervals = utils.exponential_backoff(
+            maximum=constants.ENABLE_SSH_ADMIN_POLL_MAX_INTERVAL)
         while True:
-            now = int(time.time())
+            now = time.time()
             if (now - start) > constants.ENABLE_SSH_ADMIN_TIMEOUT:
                 raise exceptions.DeploymentError(
                     "ssh admin enablement workflow - TIMED OUT.")
 
-            time.sleep(1)
+            time.sleep(next(intervals))
             execution = workflow_client.executions.get(execution.id)
             state = execution.state
 
             if state == 'RUNNING':
-                if (now - start) % constants.ENABLE_SSH_ADMIN_STATUS_INTERVAL\
-                        == 0:
+                now = time.time()
+                if (now - last_status) >= \
+                        constants.ENABLE_SSH_ADMIN_STATUS_INTERVAL:
                     print("ssh admin enablement workflow - RUNNING.")
+                    last_status = now
                 continue
             elif state == 'SUCCESS':
                 print("ssh admin enablement workflow - COMPLETE.")
@@ -316,15 +642,19 @@ def enable_ssh_admin(log, clients, plan_name, hosts, ssh_user, ssh_key):
                 error += execution.to_dict()['state_info']
                 raise exceptions.DeploymentError(error)
 
-        for host in hosts:
+        def remove_tmp_key(host):
             rm_tmp_key_command = ["ssh"] + ssh_options.split()
             rm_tmp_key_command += \
                 ["-i", ssh_key, "-l", ssh_user, host,
                  "sed -i -e '/%s/d' $HOME/.ssh/authorized_keys" %
                  tmp_key_comment]
-            print("Removing TripleO short term key from %s" % host)
-            subprocess.check_call(rm_tmp_key_command, stderr=subprocess.STDOUT)
+            subprocess.check_output(rm_tmp_key_command,
+                                    stderr=subprocess.STDOUT)
+
+        _run_on_hosts(hosts, remove_tmp_key,
+                      "Removing TripleO short term key")
     finally:
+        _close_ssh_masters(hosts, ssh_user, ssh_options)
         print("Removing short term keys locally")
         shutil.rmtree(tmp_key_dir)
 
@@ -366,6 +696,9 @@ def config_download(log, clients, stack, templates,
             'tripleo.deployment.v1.config_download_deploy',
             workflow_input=workflow_input
         )
+        print("Running config-download (execution %s), it can be followed "
+              "from another shell with 'openstack overcloud deploy "
+              "--follow %s'" % (execution.id, execution.id))
 
         for payload in base.wait_for_messages(workflow_client, ws, execution):
             print(payload['message'])
@@ -376,6 +709,49 @@ def config_download(log, clients, stack, templates,
         raise exceptions.DeploymentError("Overcloud configuration failed.")
 
 
+def follow_execution(clients, execution_id, timeout=None):
+    """Print the messages of a workflow execution until it finished
+
+    The execution may have been started by another client, for example
+    the config-download workflow of an overcloud deploy run in another
+    shell.
+
+    :raises DeploymentError: if the execution did not succeed.
+    """
+    workflow_client = clients.workflow_engine
+    tripleoclients = clients.tripleoclient
+
+    with tripleoclients.messaging_websocket() as ws:
+        # Subscribe before looking the execution up so that no message sent
+        # in between is missed
+        execution = workflow_client.executions.get(execution_id)
+        print("Following execution %s of workflow %s" % (
+            execution.id, execution.workflow_name))
+
+        status = execution.state
+        if status == 'RUNNING':
+            for payload in base.wait_for_messages(workflow_client, ws,
+                                                  execution, timeout):
+                message = payload.get('message')
+                if message:
+                    print(message)
+                # Messages of sub-workflows are printed as well, but only
+                # the execution itself tells its status.
+                # TODO(apetrich) payload.execution is deprecated, see
+                # workflows.base.wait_for_messages
+                payload_execution_id = payload.get('execution_id') or \
+                    payload.get('execution', {}).get('id')
+                if payload_execution_id == execution.id:
+                    status = payload.get('status', status)
+            if status == 'RUNNING':
+                status = workflow_client.executions.get(execution_id).state
+
+    if status != 'SUCCESS':
+        raise exceptions.DeploymentError(
+            "Execution %s finished with status %s." % (execution_id, status))
+    print("Execution %s completed." % execution_id)
+
+
 def config_download_export(clients, **workflow_input):
     workflow_client = clients.workflow_engine
     tripleoclients = clients.tripleoclient
@@ -9,11 +9,16 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import fnmatch
+import functools
 import logging
+import operator
 import os
+import subprocess
 import tempfile
 import yaml
 
+from oslo_concurrency import processutils
 from swiftclient import exceptions as swift_exc
 from tripleo_common.utils import swift as swiftutils
 from tripleo_common.utils import tarball
@@ -33,15 +38,74 @@ LOG = logging.getLogger(__name__)
 # wrong.
 _WORKFLOW_TIMEOUT = 20 * 60  # 20 minutes * 60 seconds
 
+# Size of the chunks read from tar when the templates tarball is streamed to
+# Swift.
+_TARBALL_CHUNK_SIZE = 64 * 1024
+
+
+def _tarball_stream(directory, excludes=tarball.DEFAULT_TARBALL_EXCLUDES,
+                    chunk_size=_TARBALL_CHUNK_SIZE):
+    """Generate the gzipped tarball of a directory, chunk by chunk
+
+    The tarball is read from the output of tar while it walks the directory,
+    so it is never written to disk.
+    """
+
+    cmd = ['/usr/bin/tar', '-C', directory, '-czf', '-']
+    for x in excludes:
+        cmd.extend(['--exclude', x])
+    cmd.extend(['.'])
+    LOG.debug('Streaming tarball of %s' % directory)
+
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            for chunk in iter(lambda: process.stdout.read(chunk_size), b''):
+                yield chunk
+            process.stdout.close()
+            if process.wait() != 0:
+                stderr.seek(0)
+                raise processutils.ProcessExecutionError(
+                    stderr=stderr.read(), exit_code=process.returncode,
+                    cmd=' '.join(cmd))
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
 
 def _upload_templates(swift_client, container_name, tht_root, roles_file=None,
-                      plan_env_file=None, networks_file=None):
-    """tarball up a given directory and upload it to Swift to be extracted"""
+                      plan_env_file=None, networks_file=None, stream=False):
+    """tarball up a given directory and upload it to Swift to be extracted
+
+    When ``stream`` is set the tarball is piped to Swift with a chunked
+    transfer while it is created, instead of being written to a temporary
+    file and uploaded afterwards.
+    """
+
+    if stream:
+        LOG.debug('Streaming %s to Swift container %s' % (
+            tht_root, container_name))
+        swift_client.put_object(
+            container=container_name,
+            obj='',
+            contents=_tarball_stream(tht_root),
+            query_string='extract-archive=tar.gz',
+            headers={'X-Detect-Content-Type': 'true'}
+        )
+    else:
+        with tempfile.NamedTemporaryFile() as tmp_tarball:
+            tarball.create_tarball(tht_root, tmp_tarball.name)
+            tarball.tarball_extract_to_swift_container(
+                swift_client, tmp_tarball.name, container_name)
+
+    _upload_overrides(swift_client, container_name, tht_root, roles_file,
+                      plan_env_file, networks_file)
+
 
-    with tempfile.NamedTemporaryFile() as tmp_tarball:
-        tarball.create_tarball(tht_root, tmp_tarball.name)
-        tarball.tarball_extract_to_swift_container(
-            swift_client, tmp_tarball.name, container_name)
+def _upload_overrides(swift_client, container_name, tht_root, roles_file=None,
+                      plan_env_file=None, networks_file=None):
+    """Upload the files which override the defaults in the templates"""
 
     # Optional override of the roles_data.yaml file
     if roles_file:
@@ -63,6 +127,68 @@ def _upload_templates(swift_client, container_name, tht_root, roles_file=None,
                      constants.PLAN_ENVIRONMENT, plan_env_file)
 
 
+def _template_checksums(tht_root,
+                        excludes=tarball.DEFAULT_TARBALL_EXCLUDES):
+    """Return a mapping of plan object names to the MD5 of the local files
+
+    Only regular files which are not excluded are included, as these are the
+    only members of the templates tarball which end up as objects in the plan
+    container.
+    """
+
+    def excluded(name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in excludes)
+
+    checksums = {}
+    for root, dirs, files in os.walk(tht_root):
+        dirs[:] = [d for d in dirs if not excluded(d)]
+        for filename in files:
+            path = os.path.join(root, filename)
+            if excluded(filename) or os.path.islink(path):
+                continue
+            name = os.path.relpath(path, tht_root).replace(os.sep, '/')
+            checksums[name] = utils.file_checksum(path)
+    return checksums
+
+
+def _sync_templates(swift_client, container_name, tht_root, preserve=()):
+    """Synchronise the plan container with a local templates directory
+
+    The container listing holds the name and MD5 ETag of every object in the
+    plan, so it is used as the manifest of what was uploaded previously. Only
+    the files whose content differs are uploaded and only the objects which
+    no longer exist locally are deleted. Objects named in ``preserve`` are
+    neither uploaded nor deleted, as the caller uploads their content.
+
+    Returns a tuple with the lists of uploaded and deleted object names.
+    """
+
+    manifest = dict((obj['name'], obj.get('hash'))
+                    for obj in swift_client.get_container(
+                        container_name, full_listing=True)[1])
+    checksums = _template_checksums(tht_root)
+
+    uploaded = sorted(name for name, checksum in checksums.items()
+                      if manifest.get(name) != checksum
+                      and name not in preserve)
+    deleted = sorted(name for name in manifest
+                     if name not in checksums and name not in preserve)
+
+    def upload(name, client):
+        _upload_file(client, container_name, name,
+                     os.path.join(tht_root, name))
+
+    LOG.debug("Uploading changed plan files {0}".format(uploaded))
+    utils.run_object_transfers(swift_client, [
+        (name, functools.partial(upload, name)) for name in uploaded])
+    LOG.debug("Deleting removed plan files {0}".format(deleted))
+    utils.run_object_transfers(swift_client, [
+        (name, operator.methodcaller('delete_object', container_name, name))
+        for name in deleted])
+
+    return uploaded, deleted
+
+
 def _create_update_deployment_plan(clients, workflow, **workflow_input):
     workflow_client = clients.workflow_engine
     tripleoclients = clients.tripleoclient
@@ -151,7 +277,8 @@ def create_container(workflow_client, **input_):
 
 def create_plan_from_templates(clients, name, tht_root, roles_file=None,
                                generate_passwords=True, plan_env_file=None,
-                               networks_file=None, validate_stack=True):
+                               networks_file=None, validate_stack=True,
+                               stream_upload=False):
     workflow_client = clients.workflow_engine
     swift_client = clients.tripleoclient.object_store
 
@@ -166,7 +293,7 @@ def create_plan_from_templates(clients, name, tht_root, roles_file=None,
     print("Creating plan from template files in: {}".format(tht_root))
     _upload_templates(swift_client, name, tht_root,
                       utils.rel_or_abs_path(roles_file, tht_root),
-                      plan_env_file, networks_file)
+                      plan_env_file, networks_file, stream=stream_upload)
 
     try:
         create_deployment_plan(clients, container=name,
@@ -180,7 +307,8 @@ def create_plan_from_templates(clients, name, tht_root, roles_file=None,
 def update_plan_from_templates(clients, name, tht_root, roles_file=None,
                                generate_passwords=True, plan_env_file=None,
                                networks_file=None, keep_env=False,
-                               validate_stack=True):
+                               validate_stack=True, delta_sync=False,
+                               stream_upload=False):
     swift_client = clients.tripleoclient.object_store
     passwords = None
     keep_file_contents = {}
@@ -205,10 +333,29 @@ def update_plan_from_templates(clients, name, tht_root, roles_file=None,
     else:
         passwords = _load_passwords(swift_client, name)
 
-    # TODO(dmatthews): Removing the existing plan files should probably be
-    #                  a Mistral action.
-    print("Removing the current plan files")
-    swiftutils.empty_container(swift_client, name)
+    if delta_sync:
+        # Only the files which changed since the last upload are sent,
+        # everything else is left in place in the container.
+        print("Synchronising the plan files with {}".format(tht_root))
+        if keep_env:
+            preserve = set(keep_file_contents)
+        else:
+            overrides = {
+                constants.OVERCLOUD_ROLES_FILE: roles_file,
+                constants.OVERCLOUD_NETWORKS_FILE: networks_file,
+                constants.PLAN_ENVIRONMENT: plan_env_file,
+            }
+            preserve = set(remote_name for remote_name, local_name
+                           in overrides.items() if local_name)
+        uploaded, deleted = _sync_templates(swift_client, name, tht_root,
+                                            preserve=preserve)
+        print("Uploaded {} changed and deleted {} removed plan "
+              "files".format(len(uploaded), len(deleted)))
+    else:
+        # TODO(dmatthews): Removing the existing plan files should probably
+        #                  be a Mistral action.
+        print("Removing the current plan files")
+        swiftutils.empty_container(swift_client, name)
 
     # Until we have a well defined plan update workflow in
     # tripleo-common we need to manually reset the environments and
@@ -223,13 +370,19 @@ def update_plan_from_templates(clients, name, tht_root, roles_file=None,
 
     print("Uploading new plan files")
     if keep_env:
-        _upload_templates(swift_client, name, tht_root)
+        if not delta_sync:
+            _upload_templates(swift_client, name, tht_root,
+                              stream=stream_upload)
         for filename in keep_file_contents:
             _upload_file_content(swift_client, name, filename,
                                  keep_file_contents[filename])
+    elif delta_sync:
+        _upload_overrides(swift_client, name, tht_root, roles_file,
+                          plan_env_file, networks_file)
+        _update_passwords(swift_client, name, passwords)
     else:
         _upload_templates(swift_client, name, tht_root, roles_file,
-                          plan_env_file, networks_file)
+                          plan_env_file, networks_file, stream=stream_upload)
         _update_passwords(swift_client, name, passwords)
 
     update_deployment_plan(clients, container=name,
@@ -243,6 +396,8 @@ def _load_content_or_file(swift_client, container, remote_and_local_map):
     file_contents = {}
 
     plan_files = _list_plan_files(swift_client, container)
+    # names of the plan files which are fetched from Swift
+    remote_names = []
 
     for remote_name in remote_and_local_map:
         LOG.debug("Attempting to load {0}".format(remote_name))
@@ -257,11 +412,19 @@ def _load_content_or_file(swift_client, container, remote_and_local_map):
                 content = local_content.read()
         elif remote_name in plan_files:
             LOG.debug("Preserving plan file {0}".format(remote_name))
-            content = swift_client.get_object(container, remote_name)[1]
+            remote_names.append(remote_name)
 
         if content:
             file_contents[remote_name] = content
 
+    remote_contents = utils.run_object_transfers(swift_client, [
+        (remote_name, operator.methodcaller(
+            'get_object', container, remote_name))
+        for remote_name in remote_names])
+    for remote_name, obj in zip(remote_names, remote_contents):
+        if obj[1]:
+            file_contents[remote_name] = obj[1]
+
     return file_contents
 
 